@@ -5,18 +5,16 @@ stop(vmid)
 
 import os
 import sys
-import time
+import threading
 
 from conpaas.core.controller import Controller
 
 import common
+import templates
+import vmwatcher
 
-def __try_read_file(filename):
-    try:
-        return open(filename).read()
-    except IOError:
-        print "Cannot read contextualization script " + filename
-        return ""
+# Seconds a manager VM is given to obtain an IP address
+BOOT_TIMEOUT = 600
 
 def __specific_or_default_filename(base, service, suffix, force_default=False):
     filename = os.path.join(base, service + suffix)
@@ -26,96 +24,133 @@ def __specific_or_default_filename(base, service, suffix, force_default=False):
 
     return filename.replace(service, 'default')
 
-def __get_context_file(config, cloud, service, service_id):
+def __context_template(config, cloud, service):
     root_dir = config.get('conpaas', 'ROOT_DIR')
     cloud_scripts_dir = os.path.join(root_dir, 'scripts', 'cloud')
     cloud_cfg_dir     = os.path.join(root_dir, 'config', 'cloud')
     mngr_cfg_dir      = os.path.join(root_dir, 'config', 'manager')
     mngr_scripts_dir  = os.path.join(root_dir, 'scripts', 'manager')
 
-    cloud_script = __try_read_file(os.path.join(cloud_scripts_dir, cloud))
-
-    download_url = config.get('director', 'DIRECTOR_URL')
-    mngr_setup   = __try_read_file(os.path.join(mngr_scripts_dir, 
-        "manager-setup"))
-    mngr_setup   = mngr_setup.replace('%FRONTEND_URL%', download_url)
-    mngr_setup   = mngr_setup.replace('%CLOUD%', cloud)
-
-    cloud_cfg = __try_read_file(os.path.join(cloud_cfg_dir, cloud + '.cfg'))
-
-    # The local director.cfg can override values
-    cloud_cfg = cloud_cfg.replace("USER =", 
-        "USER = %s" % config.get("iaas", 'USER'))
-    cloud_cfg = cloud_cfg.replace("PASSWORD =", 
-        "PASSWORD = %s" % config.get("iaas", 'PASSWORD'))
-    cloud_cfg = cloud_cfg.replace("IMAGE_ID =", 
-        "IMAGE_ID = %s" % config.get("iaas", 'IMAGE_ID'))
-
-    if cloud == "ec2":
-        cloud_cfg = cloud_cfg.replace("SECURITY_GROUP_NAME =", 
-            "SECURITY_GROUP_NAME = %s" % config.get("iaas", 
-                'SECURITY_GROUP_NAME'))
-        cloud_cfg = cloud_cfg.replace("KEY_NAME =", 
-            "KEY_NAME = %s" % config.get("iaas", 'KEY_NAME'))
-    # TODO: elif cloud == "opennebula":
-
-    # Start with the default config
-    mngr_cfg_filename = __specific_or_default_filename(mngr_cfg_dir, 
-        service, '-manager.cfg', force_default=True)
-    mngr_cfg = __try_read_file(mngr_cfg_filename)
-
-    # Append service specific config (if any)
-    mngr_cfg_specific_filename = __specific_or_default_filename(mngr_cfg_dir, 
-        service, '-manager.cfg')
-    if mngr_cfg_specific_filename != mngr_cfg_filename:
-        mngr_cfg += __try_read_file(mngr_cfg_specific_filename)
-
-    mngr_cfg = mngr_cfg.replace('%FRONTEND_URL%', download_url)
-    mngr_cfg = mngr_cfg.replace('%CONPAAS_SERVICE_ID%', str(service_id))
-    mngr_cfg = mngr_cfg.replace('%CONPAAS_SERVICE_TYPE%', service)
-
-    mngr_start_filename = __specific_or_default_filename(mngr_scripts_dir, 
-        service, '-manager-start')
-    mngr_start_script = __try_read_file(mngr_start_filename)
-
-    return "%s\n\n%s\n\ncat <<EOF > $ROOT_DIR/config.cfg\n%s\n%s\nEOF\n\n%s\n" % (
-        cloud_script, mngr_setup, cloud_cfg, mngr_cfg, mngr_start_script)
-
-def __getcloud(service_name="php", service_id=1):
-    config = common.config
-    if not config.has_section("manager"):
-        config.add_section("manager")
-
-    config.set("manager", "FE_SERVICE_ID", str(service_id))
-    config.set("manager", "FE_CREDIT_URL", config.get('director', 'DIRECTOR_URL') + "/credit")
-    config.set("manager", "FE_TERMINATE_URL", config.get('director', 'DIRECTOR_URL') + "/terminate")
+    cloud_script = os.path.join(cloud_scripts_dir, cloud)
+    mngr_setup = os.path.join(mngr_scripts_dir, "manager-setup")
+    cloud_cfg = os.path.join(cloud_cfg_dir, cloud + '.cfg')
+
+    # Start with the default config, and append the service specific one
+    mngr_cfg = __specific_or_default_filename(mngr_cfg_dir, service, 
+        '-manager.cfg', force_default=True)
+    mngr_cfg_specific = os.path.join(mngr_cfg_dir, service + '-manager.cfg')
+
+    mngr_start = __specific_or_default_filename(mngr_scripts_dir, service, 
+        '-manager-start', force_default=True)
+    mngr_start_specific = os.path.join(mngr_scripts_dir, 
+        service + '-manager-start')
+
+    def build(files):
+        def contents(filename):
+            if files[filename] is None:
+                print "Cannot read contextualization script " + filename
+                return ""
+            return files[filename]
+
+        # The local director.cfg can override values
+        cfg = contents(cloud_cfg)
+        cfg = cfg.replace("USER =", 
+            "USER = %s" % config.get("iaas", 'USER'))
+        cfg = cfg.replace("PASSWORD =", 
+            "PASSWORD = %s" % config.get("iaas", 'PASSWORD'))
+        cfg = cfg.replace("IMAGE_ID =", 
+            "IMAGE_ID = %s" % config.get("iaas", 'IMAGE_ID'))
+
+        if cloud == "ec2":
+            cfg = cfg.replace("SECURITY_GROUP_NAME =", 
+                "SECURITY_GROUP_NAME = %s" % config.get("iaas", 
+                    'SECURITY_GROUP_NAME'))
+            cfg = cfg.replace("KEY_NAME =", 
+                "KEY_NAME = %s" % config.get("iaas", 'KEY_NAME'))
+        # TODO: elif cloud == "opennebula":
+
+        mngr_cfg_contents = contents(mngr_cfg)
+        if mngr_cfg_specific != mngr_cfg:
+            mngr_cfg_contents += files[mngr_cfg_specific] or ""
+
+        start_script = files[mngr_start_specific]
+        if start_script is None:
+            start_script = contents(mngr_start)
+
+        return templates.Template([
+            (contents(cloud_script) + "\n\n", ()),
+            (contents(mngr_setup), ('FRONTEND_URL', 'CLOUD')),
+            ("\n\ncat <<EOF > $ROOT_DIR/config.cfg\n" + cfg + "\n", ()),
+            (mngr_cfg_contents, ('FRONTEND_URL', 'CONPAAS_SERVICE_ID', 
+                                 'CONPAAS_SERVICE_TYPE')),
+            ("\nEOF\n\n" + start_script + "\n", ()),
+        ])
+
+    return templates.cache.get(('actions', cloud, service), 
+        [ cloud_script, mngr_setup, cloud_cfg, mngr_cfg, mngr_cfg_specific, 
+          mngr_start, mngr_start_specific ], build)
+
+def __get_context_file(config, cloud, service, service_id):
+    return __context_template(config, cloud, service).render({
+        'FRONTEND_URL': config.get('director', 'DIRECTOR_URL'),
+        'CLOUD': cloud,
+        'CONPAAS_SERVICE_ID': str(service_id),
+        'CONPAAS_SERVICE_TYPE': service,
+    })
+
+def __getcloud():
+    # The service ID only goes into the context file: the controller is
+    # shared by all of them. common.config is left untouched.
+    director_url = common.config.get('director', 'DIRECTOR_URL')
+    config = common.ConfigOverlay(common.config, { 'manager': {
+        'FE_CREDIT_URL': director_url + "/credit",
+        'FE_TERMINATE_URL': director_url + "/terminate",
+    }})
 
     controller = Controller(config)
 
     # Mess with private attributes 
     c = controller._Controller__default_cloud 
-    context = __get_context_file(config, config.get("iaas", "DRIVER"), 
-        service_name, service_id)
-    c.set_context_template(context)
 
     # Otherwise it locks forever
     controller._Controller__reservation_map['manager'].stop()
     return c
 
+# driver -> (cloud, VMWatcher), created on first use. Drivers such as the
+# dummy one only list the VMs created through the same connection: VMs are
+# created, watched and killed through a single cloud object, which __lock
+# serializes the calls to.
+__clouds = {}
+__lock = threading.RLock()
+
+def __shared_cloud():
+    driver = common.config.get('iaas', 'DRIVER')
+
+    with __lock:
+        if driver not in __clouds:
+            c = __getcloud()
+            def list_vms():
+                with __lock:
+                    return c.list_vms()
+            __clouds[driver] = c, vmwatcher.VMWatcher(list_vms)
+
+        return __clouds[driver]
+
 def start(service_name, service_id):
-    c = __getcloud(service_name, service_id)
-    new_vm = c.new_instances(1)[0]
+    c, watcher = __shared_cloud()
+    context = __get_context_file(common.config, 
+        common.config.get("iaas", "DRIVER"), service_name, service_id)
+
+    with __lock:
+        c.set_context_template(context)
+        new_vm = c.new_instances(1)[0]
 
     try:
         new_vm_id = new_vm['id']
     except TypeError:
         new_vm_id = new_vm.id
 
-    ip = ''
-    while not ip:
-        vms = c.list_vms()
-        ip = vms[new_vm_id]['ip']
-        time.sleep(1)
+    ip = watcher.watch(new_vm_id, BOOT_TIMEOUT).result()
 
     return ip, new_vm_id
 
@@ -123,23 +158,21 @@ def start(service_name, service_id):
     #controller.create_nodes(1, 'get_service_info', 80, "ec2")
 
 def stop(vmid):
-    c = __getcloud()
-    c._connect()
+    c, _ = __shared_cloud()
     # kill_instance() takes an object with an id attribute on newer versions of
-    # libcloud
+    # libcloud, a string object on older ones
     class Node: pass
     n = Node()
     n.id = vmid
-    c.kill_instance(n)
 
-    # kill_instance() takes a string object on older versions of libcloud
-    vmids = [ vm for vm in c.list_vms().keys() ]
+    with __lock:
+        if not getattr(c, 'connected', False):
+            c._connect()
 
-    if vmid in vmids:
         try:
-            c.kill_instance(vmid)
+            c.kill_instance(n)
         except Exception:
-            pass
+            c.kill_instance(vmid)
 
 if __name__ == "__main__":
     try:
@@ -1,10 +1,14 @@
-from flask import Flask, jsonify, helpers, request, make_response
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask import Flask, Response, abort, jsonify, helpers, request, make_response
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
 
 import os
 import sys
+import time
 import hashlib
+import calendar
 import zipfile
+import traceback
 import simplejson
 from datetime import datetime
 from StringIO import StringIO
@@ -13,21 +17,101 @@ from OpenSSL import crypto
 import common
 # Add ConPaaS src to PYTHONPATH
 common.extend_path()
+import auth
+import artifacts
+import billing
+import cache
 import cloud
+import database
+import jobs
+import metrics
+import proxy
+import warmpool
 import x509cert
 
-from conpaas.core import https
 from conpaas.core.services import manager_services
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = common.config.get(
     'director', 'DATABASE_URI')
-db = SQLAlchemy(app)
+db = database.DirectorSQLAlchemy(app)
 
 if common.config.has_option('director', 'DEBUG'):
     print "Debug mode on"
     app.debug = True
 
+# Maximum number of managers being provisioned at the same time
+PROVISIONING_WORKERS = 5
+if common.config.has_option('director', 'PROVISIONING_WORKERS'):
+    PROVISIONING_WORKERS = common.config.getint('director',
+        'PROVISIONING_WORKERS')
+
+# Maximum number of services started by a single call to /start_batch
+MAX_BATCH_SIZE = 100
+
+# Upper bound for the 'wait' parameter of /job
+MAX_JOB_WAIT = 60
+
+# Maximum number of decrements reported by a single credit batch callback.
+# Their sids are looked up with one query: SQLite takes at most 999 of them.
+MAX_CREDIT_BATCH_SIZE = 500
+
+provisioning = jobs.WorkerPool(PROVISIONING_WORKERS, "provisioning")
+
+# Maximum number of stop requests being served at the same time, and number
+# of times a failed VM termination is retried before leaving it to the
+# reconciler
+TERMINATION_WORKERS = 5
+if common.config.has_option('director', 'TERMINATION_WORKERS'):
+    TERMINATION_WORKERS = common.config.getint('director',
+        'TERMINATION_WORKERS')
+
+STOP_RETRIES = 3
+
+terminating = jobs.WorkerPool(TERMINATION_WORKERS, "termination")
+
+# VMs whose services are gone but which could not be terminated
+orphan_vmids = set()
+
+# Recently verified credentials: size and time to live in seconds
+AUTH_CACHE_SIZE = 1000
+if common.config.has_option('director', 'AUTH_CACHE_SIZE'):
+    AUTH_CACHE_SIZE = common.config.getint('director', 'AUTH_CACHE_SIZE')
+
+AUTH_CACHE_TTL = 60
+if common.config.has_option('director', 'AUTH_CACHE_TTL'):
+    AUTH_CACHE_TTL = common.config.getint('director', 'AUTH_CACHE_TTL')
+
+credentials = auth.CredentialCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+# Persistent connections towards the managers proxied by /manager: at most
+# PROXY_MAX_CONNECTIONS per manager, idle ones closed after
+# PROXY_IDLE_TIMEOUT seconds
+PROXY_MAX_CONNECTIONS = 4
+if common.config.has_option('director', 'PROXY_MAX_CONNECTIONS'):
+    PROXY_MAX_CONNECTIONS = common.config.getint('director', 
+        'PROXY_MAX_CONNECTIONS')
+
+PROXY_IDLE_TIMEOUT = 30
+if common.config.has_option('director', 'PROXY_IDLE_TIMEOUT'):
+    PROXY_IDLE_TIMEOUT = common.config.getint('director', 
+        'PROXY_IDLE_TIMEOUT')
+
+def __proxy_cert_file(name):
+    # The director authenticates to the managers with its own certificate,
+    # and checks theirs against the CA certificate, when available
+    filename = os.path.join(common.config.get('conpaas', 'CERT_DIR'), name)
+    if os.path.isfile(filename):
+        return filename
+
+manager_connections = proxy.ConnectionPool(PROXY_MAX_CONNECTIONS, 
+    PROXY_IDLE_TIMEOUT, key_file=__proxy_cert_file('key.pem'), 
+    cert_file=__proxy_cert_file('cert.pem'),
+    ca_file=__proxy_cert_file('ca_cert.pem'))
+
+# sid -> manager address, invalidated when the service is stopped
+manager_addresses = cache.LRUCache(10000)
+
 def create_user(username, fname, lname, email, affiliation, password, credit):
     """Create a new user with the given attributes. Return a new User object
     in case of successful creation. None otherwise."""
@@ -36,7 +120,7 @@ def create_user(username, fname, lname, email, affiliation, password, credit):
                 lname=lname, 
                 email=email, 
                 affiliation=affiliation, 
-                password=hashlib.md5(password).hexdigest(), 
+                password=auth.hash_password(password), 
                 credit=credit)
 
     db.session.add(user)
@@ -47,17 +131,64 @@ def create_user(username, fname, lname, email, affiliation, password, credit):
     except Exception:
         db.session.rollback()
 
+@metrics.timed('auth')
+def auth_uid(username, password):
+    """Return the uid of the user if the specified (username, password)
+    combination is valid, None otherwise. Recently verified credentials are
+    checked without touching the database."""
+    uid = credentials.lookup(username, password)
+    if uid is not None:
+        return uid
+
+    user = User.query.filter_by(username=username).first()
+    if not user or not auth.check_password(password, user.password):
+        return None
+
+    if auth.needs_rehash(user.password):
+        # Transparently upgrade legacy MD5 hashes
+        user.password = auth.hash_password(password)
+        db.session.commit()
+
+    credentials.store(username, password, user.uid)
+    return user.uid
+
 def auth_user(username, password):
     """Return a User object if the specified (username, password) combination
     is valid. False otherwise."""
-    res = User.query.filter_by(username=username, 
-        password=hashlib.md5(password).hexdigest()).first()
+    uid = auth_uid(username, password)
+    if uid is None:
+        return False
 
+    res = User.query.get(uid)
     if res:
         return res
 
+    # The user has been removed
+    credentials.invalidate(username)
     return False
 
+def set_password(user, password):
+    """Change the password of the given user"""
+    user.password = auth.hash_password(password)
+    db.session.commit()
+    credentials.invalidate(user.username)
+    revoke_user_certs(user.uid)
+
+def manager_address(sid):
+    """Return the address of the manager of service 'sid', None if there is
+    no such service or if its manager is not running yet."""
+    address = manager_addresses.get(sid)
+    if address is not None:
+        return address
+
+    service = Service.query.filter_by(sid=sid).first()
+    if not service or not service.manager or service.state == 'STOPPING':
+        return None
+
+    address = str(service.manager)
+    manager_addresses.set(sid, address)
+    return address
+
 def build_response(data):
     response = make_response(data)
     response.headers['Access-Control-Allow-Origin'] = '*'
@@ -65,25 +196,66 @@ def build_response(data):
 
 @app.route("/login", methods=['POST'])
 def login():
-    user = auth_user(request.values.get('username', ''), 
+    uid = auth_uid(request.values.get('username', ''), 
         request.values.get('password', ''))
 
-    if not user:
+    if uid is None:
         # Authentication failed
         return build_response(simplejson.dumps(False))
 
     return build_response(simplejson.dumps(True))
 
+# Certificates issued by /getcerts are handed out again, to at most
+# CERT_CACHE_SIZE users, until CERT_REUSE_FRACTION of their validity has
+# passed
+CERT_CACHE_SIZE = 1000
+if common.config.has_option('director', 'CERT_CACHE_SIZE'):
+    CERT_CACHE_SIZE = common.config.getint('director', 'CERT_CACHE_SIZE')
+
+CERT_REUSE_FRACTION = 0.5
+if common.config.has_option('director', 'CERT_REUSE_FRACTION'):
+    CERT_REUSE_FRACTION = common.config.getfloat('director', 
+        'CERT_REUSE_FRACTION')
+
+# uid -> (zip archive, CA certificate)
+cert_bundles = cache.LRUCache(CERT_CACHE_SIZE)
+
 @app.route("/getcerts", methods=['GET'])
 def get_user_certs():
-    user = auth_user(request.values.get('username', ''), 
+    """GET /getcerts
+
+    GET parameters must contain username and password. Returns a zip archive
+    holding a certificate for the user, its key and the CA certificate.
+    The same archive is returned until part of its validity has passed:
+    add renew=1 to get new certificates.
+    """
+    uid = auth_uid(request.values.get('username', ''),
         request.values.get('password', ''))
 
-    if not user:
+    if uid is None:
         # Authentication failed
         return simplejson.dumps(False)
 
-    # Creates new certificates for this user
+    bundle = None
+    if request.values.get('renew', '') != '1':
+        bundle = cert_bundles.get(uid)
+
+    ca_cert = x509cert.get_ca(common.config.get('conpaas', 'CERT_DIR')).cert_pem
+    if bundle is None or bundle[1] != ca_cert:
+        # Issue new certificates for this user
+        user = auth_user(request.values.get('username', ''),
+            request.values.get('password', ''))
+        if not user:
+            return simplejson.dumps(False)
+        bundle = __build_cert_bundle(user)
+
+    # Send zip archive to the client
+    return helpers.send_file(StringIO(bundle[0]), mimetype="application/zip",
+        as_attachment=True, attachment_filename='certs.zip')
+
+def __build_cert_bundle(user):
+    # Return a (zip archive, CA certificate) tuple with new certificates for
+    # the given user, and cache it for CERT_REUSE_FRACTION of their validity
     certs = x509cert.generate_certificate(
         cert_dir=common.config.get('conpaas', 'CERT_DIR'),
         uid=str(user.uid),
@@ -103,11 +275,471 @@ def get_user_certs():
         archive.writestr(name + '.pem', data)
 
     archive.close()
-    zipdata.seek(0)
 
-    # Send zip archive to the client
-    return helpers.send_file(zipdata, mimetype="application/zip",
-        as_attachment=True, attachment_filename='certs.zip')
+    bundle = (zipdata.getvalue(), certs['ca_cert'])
+
+    cert = crypto.load_certificate(crypto.FILETYPE_PEM, certs['cert'])
+    not_before, not_after = [ calendar.timegm(time.strptime(value, 
+        '%Y%m%d%H%M%SZ')) for value in (cert.get_notBefore(), 
+            cert.get_notAfter()) ]
+
+    cert_bundles.set(user.uid, bundle, not_before + CERT_REUSE_FRACTION * 
+        (not_after - not_before) - time.time())
+
+    return bundle
+
+def revoke_user_certs(uid):
+    """Stop handing out the cached certificates of user 'uid': the next call
+    to /getcerts issues new ones"""
+    cert_bundles.pop(uid)
+
+def provision(serviceids, servicetype, uid):
+    """Boot the managers of the given services, all of type 'servicetype'
+    and owned by user 'uid'. Runs on the provisioning worker pool and moves
+    Service.state from PROVISIONING to RUNNING, or to FAILED if the manager
+    could not be started. Services stopped meanwhile are torn down."""
+    try:
+        services = Service.query.filter(Service.sid.in_(serviceids)).all()
+
+        for s in services[:]:
+            if s.state == 'STOPPING':
+                # Stopped before we got a chance to start them
+                db.session.delete(s)
+                services.remove(s)
+            else:
+                s.state = 'PROVISIONING'
+        db.session.commit()
+
+        if not services:
+            return
+
+        # Managers taken from the warm pool only need their configuration,
+        # the others are booted now
+        results = {}
+        cold = []
+        for s in services:
+            results[s.sid] = claim_warm_manager(servicetype, s.sid, uid)
+            if results[s.sid] is None:
+                cold.append(s.sid)
+
+        try:
+            if cold:
+                results.update(cloud.start_batch(servicetype, cold, uid))
+        except Exception, err:
+            traceback.print_exc()
+            results.update((sid, err) for sid in cold)
+
+        # Pick up the services stopped meanwhile
+        services = dict((s.sid, s) for s in
+            Service.query.filter(Service.sid.in_(serviceids)
+                ).populate_existing().all())
+
+        orphans = []
+        stopping = []
+        for sid, result in results.items():
+            failed = isinstance(result, Exception)
+            if failed:
+                print "Cannot start manager for service %s: %s" % (sid, result)
+
+            if sid not in services:
+                # The service has been deleted while its manager was booting
+                if not failed:
+                    orphans.append(result[1])
+            elif failed:
+                if services[sid].state == 'STOPPING':
+                    db.session.delete(services[sid])
+                else:
+                    services[sid].state = 'FAILED'
+            else:
+                s = services[sid]
+                s.manager, s.vmid = result
+                manager_addresses.pop(sid)
+                if s.state == 'STOPPING':
+                    # Stopped while its manager was booting
+                    stopping.append(sid)
+                else:
+                    s.state = 'RUNNING'
+
+        db.session.commit()
+
+        if stopping:
+            terminating.submit_batch(stopping, teardown, stopping)
+
+        if orphans:
+            killed = cloud.stop_batch(orphans, STOP_RETRIES)
+            orphan_vmids.update(vmid for vmid in orphans
+                                if isinstance(killed[vmid], Exception))
+    finally:
+        db.session.remove()
+
+def teardown(serviceids):
+    """Terminate the managers of the given services and delete them. Runs on
+    the termination worker pool. Only services in state STOPPING are
+    considered: those whose VM cannot be terminated stay so, and are
+    retried by the reconciler."""
+    try:
+        services = Service.query.filter(Service.sid.in_(serviceids),
+            Service.state == 'STOPPING').all()
+
+        # Services without a VM yet are left to their provisioning job
+        services = [ s for s in services 
+                     if s.vmid or not provisioning.is_pending(s.sid) ]
+
+        vmids = [ s.vmid for s in services if s.vmid ]
+        killed = vmids and cloud.stop_batch(vmids, STOP_RETRIES) or {}
+
+        for s in services:
+            if s.vmid and isinstance(killed[s.vmid], Exception):
+                print "Cannot stop service %s: %s" % (s.sid, killed[s.vmid])
+                continue
+
+            db.session.delete(s)
+
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+def request_stop(services):
+    """Move the given services to state STOPPING and have their managers
+    terminated in the background. Stopping a service twice is harmless."""
+    sids = []
+    for s in services:
+        s.state = 'STOPPING'
+        manager_addresses.pop(s.sid)
+        if not terminating.is_pending(s.sid):
+            sids.append(s.sid)
+
+    db.session.commit()
+
+    if sids:
+        terminating.submit_batch(sids, teardown, sids)
+
+def reconcile():
+    """Compare the cloud inventory with the services being stopped, once,
+    and finish their termination in bulk. Services whose VM is already gone
+    are deleted without calling the cloud, as are the services stopped
+    while being provisioned. VMs left behind by deleted services are
+    terminated again.
+
+    VMs unknown to the director are never touched: service managers start
+    their agents with the same cloud credentials."""
+    try:
+        vms = cloud.list_vms()
+
+        services = [ s for s in Service.query.filter_by(state='STOPPING')
+                     if not terminating.is_pending(s.sid) 
+                        and not provisioning.is_pending(s.sid) ]
+
+        retry = []
+        for s in services:
+            if s.vmid in vms:
+                retry.append(s.sid)
+            else:
+                db.session.delete(s)
+        db.session.commit()
+
+        if retry:
+            terminating.submit_batch(retry, teardown, retry)
+
+        for vmid in list(orphan_vmids):
+            if vmid not in vms:
+                # Gone meanwhile
+                orphan_vmids.discard(vmid)
+
+        if orphan_vmids:
+            killed = cloud.stop_batch(list(orphan_vmids))
+            for vmid, result in killed.items():
+                if not isinstance(result, Exception):
+                    orphan_vmids.discard(vmid)
+    finally:
+        db.session.remove()
+
+# Seconds between two runs of the reconciler. 0 disables it.
+RECONCILE_INTERVAL = 300
+if common.config.has_option('director', 'RECONCILE_INTERVAL'):
+    RECONCILE_INTERVAL = common.config.getint('director',
+        'RECONCILE_INTERVAL')
+
+reconciler = jobs.Periodic(RECONCILE_INTERVAL, reconcile, "reconciler")
+
+# Every HEALTH_INTERVAL seconds, the managers of the running services are
+# asked for their state, HEALTH_WORKERS of them at a time, each of them
+# given HEALTH_TIMEOUT seconds to answer. 0 disables the sweeper.
+HEALTH_INTERVAL = 60
+if common.config.has_option('director', 'HEALTH_INTERVAL'):
+    HEALTH_INTERVAL = common.config.getint('director', 'HEALTH_INTERVAL')
+
+HEALTH_WORKERS = 20
+if common.config.has_option('director', 'HEALTH_WORKERS'):
+    HEALTH_WORKERS = common.config.getint('director', 'HEALTH_WORKERS')
+
+HEALTH_TIMEOUT = 10
+if common.config.has_option('director', 'HEALTH_TIMEOUT'):
+    HEALTH_TIMEOUT = common.config.getint('director', 'HEALTH_TIMEOUT')
+
+health_checks = jobs.WorkerPool(HEALTH_WORKERS, "health")
+
+# One connection per manager, separate from those of /manager so that slow
+# managers do not delay the proxied calls
+health_connections = proxy.ConnectionPool(1, HEALTH_INTERVAL +
+    PROXY_IDLE_TIMEOUT, key_file=__proxy_cert_file('key.pem'),
+    cert_file=__proxy_cert_file('cert.pem'),
+    ca_file=__proxy_cert_file('ca_cert.pem'), timeout=HEALTH_TIMEOUT)
+
+# Time the last sweep completed, reported by /status
+last_sweep = [ None ]
+
+def manager_state(address):
+    """Return the state reported by the manager at 'address' (eg: RUNNING,
+    ERROR), or UNREACHABLE if it did not answer properly in time"""
+    try:
+        status, body = health_connections.jsonrpc_get(address, 80, "/",
+            "get_service_info")
+        if status == 200:
+            return str(simplejson.loads(body)['result']['state'])
+    except Exception:
+        pass
+
+    return 'UNREACHABLE'
+
+def health_sweep():
+    """Ask the managers of all the running services for their state, at
+    most HEALTH_WORKERS at a time, and record the states which changed in
+    Service.manager_state with one UPDATE per state. Return the number of
+    services whose manager state changed."""
+    try:
+        services = db.session.query(Service.sid, Service.manager,
+            Service.manager_state).filter(Service.state == 'RUNNING',
+                Service.manager != None).all()
+        db.session.commit()
+
+        states = {}
+        def check(sid, address):
+            states[sid] = manager_state(address)
+
+        for sid, address, _ in services:
+            health_checks.submit(sid, check, sid, address)
+
+        # Each check takes at most HEALTH_TIMEOUT seconds (connecting, then
+        # waiting for the answer)
+        rounds = len(services) / max(HEALTH_WORKERS, 1) + 1
+        deadline = time.time() + 2 * HEALTH_TIMEOUT * rounds
+        for sid, _, _ in services:
+            health_checks.wait(sid, max(deadline - time.time(), 0))
+
+        changed = {}
+        for sid, _, previous in services:
+            state = states.get(sid)
+            if state is not None and state != previous:
+                changed.setdefault(state, []).append(sid)
+
+        for state, sids in changed.items():
+            # Services stopped meanwhile are left alone
+            Service.query.filter(Service.sid.in_(sids),
+                Service.state == 'RUNNING').update(
+                    { Service.manager_state: state },
+                    synchronize_session=False)
+
+        if changed:
+            sids = sum(changed.values(), [])
+            bump_services_version(db.session, [ uid for (uid,) in
+                db.session.query(Service.user_id).filter(
+                    Service.sid.in_(sids)).distinct() ])
+
+        db.session.commit()
+        last_sweep[0] = datetime.now()
+        return sum(len(sids) for sids in changed.values())
+    finally:
+        db.session.remove()
+
+health_sweeper = jobs.Periodic(HEALTH_INTERVAL, health_sweep, "health")
+
+def configure_manager(address, sid, uid):
+    """Push to the manager at 'address', started without any service
+    assigned, the configuration of service 'sid' of user 'uid': the ids and
+    a certificate issued for them. Raise an exception on failure."""
+    certs = x509cert.generate_certificate(
+        common.config.get('conpaas', 'CERT_DIR'), str(uid), str(sid), 
+        "manager", "info@conpaas.eu", "ConPaaS", "Contrail")
+
+    status, body = manager_connections.jsonrpc_post(address, 80, "/", 
+        "set_service_config", { 'service_id': sid, 'user_id': uid, 
+                                'cert': certs['cert'], 'key': certs['key'],
+                                'ca_cert': certs['ca_cert'] })
+
+    if status != 200:
+        raise Exception("HTTP status %s" % status)
+
+    error = simplejson.loads(body).get('error')
+    if error:
+        raise Exception(error)
+
+def manager_capabilities(address):
+    """Return the optional calls (eg: set_service_config) that the manager at
+    'address' lists in the 'capabilities' item of get_service_info. Raise an
+    exception if it does not answer."""
+    status, body = manager_connections.jsonrpc_get(address, 80, "/",
+        "get_service_info")
+
+    if status != 200:
+        raise Exception("HTTP status %s" % status)
+
+    return simplejson.loads(body)['result'].get('capabilities', [])
+
+# Pre-booted managers: WARM_POOL_SIZE of them for each of the service types
+# listed in WARM_POOL_TYPES. Those unclaimed for WARM_POOL_MAX_IDLE seconds
+# are terminated. WARM_POOL_HOURLY_COST is used to report what keeping them
+# idle costs.
+WARM_POOL_SIZE = 0
+if common.config.has_option('director', 'WARM_POOL_SIZE'):
+    WARM_POOL_SIZE = common.config.getint('director', 'WARM_POOL_SIZE')
+
+WARM_POOL_TYPES = []
+if common.config.has_option('director', 'WARM_POOL_TYPES'):
+    WARM_POOL_TYPES = [ servicetype.strip() for servicetype in 
+        common.config.get('director', 'WARM_POOL_TYPES').split(',') ]
+
+WARM_POOL_MAX_IDLE = 3600
+if common.config.has_option('director', 'WARM_POOL_MAX_IDLE'):
+    WARM_POOL_MAX_IDLE = common.config.getint('director', 
+        'WARM_POOL_MAX_IDLE')
+
+WARM_POOL_HOURLY_COST = 0
+if common.config.has_option('director', 'WARM_POOL_HOURLY_COST'):
+    WARM_POOL_HOURLY_COST = common.config.getfloat('director', 
+        'WARM_POOL_HOURLY_COST')
+
+# Seconds a warm manager is given to answer once its VM has an address
+WARM_POOL_PROBE_TIMEOUT = 300
+
+def __warm_manager_capabilities(address):
+    deadline = time.time() + WARM_POOL_PROBE_TIMEOUT
+    while True:
+        try:
+            return manager_capabilities(address)
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(5)
+
+def boot_warm_manager(servicetype):
+    """Start a manager without any service assigned. It is recorded as a
+    Service in state WARM, owned by nobody, so that it survives restarts of
+    the director.
+
+    Raise warmpool.Unsupported, disabling the pool, if the manager does not
+    support set_service_config: stock ConPaaS managers do not."""
+    ip, vmid = cloud.start(servicetype, "", "")
+
+    try:
+        capabilities = __warm_manager_capabilities(ip)
+    except:
+        cloud.stop(vmid)
+        raise
+
+    if 'set_service_config' not in capabilities:
+        cloud.stop(vmid)
+        raise warmpool.Unsupported("%s managers do not support "
+            "set_service_config" % servicetype)
+
+    try:
+        db.session.add(Service(name="Warm %s manager" % servicetype, 
+            type=servicetype, state='WARM', manager=ip, vmid=vmid))
+        db.session.commit()
+    except:
+        cloud.stop(vmid)
+        raise
+    finally:
+        db.session.remove()
+
+    return ip, vmid
+
+def __terminate_warm_manager(vmid):
+    if isinstance(cloud.stop_batch([ vmid ], STOP_RETRIES)[vmid], Exception):
+        orphan_vmids.add(vmid)
+
+def destroy_warm_manager(vmid):
+    # Also called from provisioning jobs (WarmPool.claim() expires managers):
+    # their own session is left alone
+    session = db.create_scoped_session()
+    try:
+        session.query(Service).filter_by(vmid=vmid, state='WARM').delete()
+        session.commit()
+    finally:
+        session.remove()
+
+    __terminate_warm_manager(vmid)
+
+def __warm_pool(servicetype):
+    return warmpool.WarmPool(WARM_POOL_SIZE, WARM_POOL_MAX_IDLE, 
+        lambda: boot_warm_manager(servicetype), destroy_warm_manager, 
+        WARM_POOL_HOURLY_COST, "warmpool-" + servicetype)
+
+# service type -> WarmPool
+warm_pools = {}
+if WARM_POOL_SIZE > 0:
+    warm_pools = dict((servicetype, __warm_pool(servicetype)) 
+        for servicetype in WARM_POOL_TYPES)
+
+def claim_warm_manager(servicetype, sid, uid):
+    """Return the (ip, vmid) tuple of a manager taken from the warm pool and
+    configured for service 'sid' of user 'uid', None if none is available.
+
+    The warm pool of 'servicetype' is disabled as soon as one of its
+    managers cannot be configured: the others were booted the same way and
+    are likely to fail too. Services are then started cold."""
+    pool = warm_pools.get(servicetype)
+    if pool is None:
+        return None
+
+    claimed = pool.claim()
+    if claimed is None:
+        return None
+
+    Service.query.filter_by(vmid=claimed[1], state='WARM').delete()
+    db.session.commit()
+
+    try:
+        configure_manager(claimed[0], sid, uid)
+        return claimed
+    except Exception, err:
+        print "Cannot configure warm manager %s, disabling the %s warm " \
+            "pool: %s" % (claimed[1], servicetype, err)
+        __terminate_warm_manager(claimed[1])
+        pool.disable()
+        return None
+
+def __expire_warm_managers():
+    for pool in warm_pools.values():
+        pool.expire()
+
+warm_pool_keeper = jobs.Periodic(60, __expire_warm_managers, "warmpool")
+
+@app.before_first_request
+def start_reconciler():
+    if RECONCILE_INTERVAL > 0:
+        reconciler.start()
+
+@app.before_first_request
+def start_health_sweeper():
+    if HEALTH_INTERVAL > 0:
+        health_sweeper.start()
+
+@app.before_first_request
+def start_warm_pools():
+    if not warm_pools:
+        return
+
+    # Managers booted before a restart are reused
+    for s in Service.query.filter_by(state='WARM'):
+        if s.type in warm_pools:
+            warm_pools[s.type].adopt(s.manager, s.vmid, 
+                time.mktime(s.created.timetuple()))
+
+    for pool in warm_pools.values():
+        pool.fill()
+
+    warm_pool_keeper.start()
 
 @app.route("/start/<servicetype>", methods=['POST'])
 def start(servicetype):
@@ -115,14 +747,15 @@ def start(servicetype):
 
     POSTed values must contain username and password.
 
-    Returns a dictionary with service data (manager's vmid and IP address,
-    service name and ID) in case of successful authentication and correct
-    service creation. False is returned otherwise.
+    Returns a dictionary with service data (service name and ID, state INIT)
+    in case of successful authentication. False is returned otherwise. The
+    manager is started in the background: use /job/<serviceid> to follow its
+    progress.
     """
-    user = auth_user(request.values.get('username', ''), 
+    uid = auth_uid(request.values.get('username', ''),
         request.values.get('password', ''))
 
-    if not user:
+    if uid is None:
         # Authentication failed
         return build_response(simplejson.dumps(False))
 
@@ -133,13 +766,118 @@ def start(servicetype):
 
     # New service with default name, proper servicetype and user relationship
     s = Service(name="New %s service" % servicetype, type=servicetype, 
-        user=user)
+        user_id=uid)
                 
     db.session.add(s)
-    # flush() is needed to get auto-incremented sid
-    db.session.flush()
-    s.manager, s.vmid = cloud.start(servicetype, s.sid, user.uid)
     db.session.commit()
+
+    # Serialized before the job can change the service
+    data = s.to_dict()
+    provisioning.submit(s.sid, provision, [ s.sid ], servicetype, uid)
+    return build_response(jsonify(data))
+
+@app.route("/start_batch", methods=['POST'])
+def start_batch():
+    """eg: POST /start_batch
+
+    POSTed values must contain username, password and 'services', a JSON
+    list of {"servicetype": ..., "count": ...} items.
+
+    Returns a list with one result per item: the data of the newly created
+    services, or a dictionary with 'error' set to True and a message. False
+    is returned in case of failed authentication or malformed input,
+    including counts below 1 and more than MAX_BATCH_SIZE services in total.
+    As for /start, managers are started in the background.
+    """
+    uid = auth_uid(request.values.get('username', ''),
+        request.values.get('password', ''))
+
+    if uid is None:
+        # Authentication failed
+        return build_response(simplejson.dumps(False))
+
+    try:
+        items = simplejson.loads(request.values.get('services', ''))
+        items = [ (item['servicetype'], int(item.get('count', 1)))
+                  for item in items ]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return build_response(simplejson.dumps(False))
+
+    # Checked before the cap: negative counts would offset it
+    if [ count for _, count in items if count < 1 ] or \
+            sum(count for _, count in items) > MAX_BATCH_SIZE:
+        return build_response(simplejson.dumps(False))
+
+    # All the new services are stored in a single transaction
+    batch = []
+    for servicetype, count in items:
+        if servicetype not in manager_services.keys():
+            batch.append((servicetype, 'Unknown service type'))
+        else:
+            services = [ Service(name="New %s service" % servicetype,
+                                 type=servicetype, user_id=uid)
+                         for _ in range(count) ]
+            db.session.add_all(services)
+            batch.append((servicetype, services))
+
+    db.session.commit()
+
+    results = []
+    for servicetype, services in batch:
+        if isinstance(services, basestring):
+            results.append({ 'error': True, 'servicetype': servicetype,
+                             'msg': services })
+            continue
+
+        # Serialized before the job can change the services. One job per
+        # item: its managers share a cloud connection.
+        results.append({ 'error': False, 'servicetype': servicetype,
+                         'services': [ s.to_dict() for s in services ] })
+        sids = [ s.sid for s in services ]
+        provisioning.submit_batch(sids, provision, sids, servicetype,
+            uid)
+
+    return build_response(simplejson.dumps(results))
+
+@app.route("/job/<int:serviceid>", methods=['GET'])
+def job(serviceid):
+    """eg: GET /job/3?wait=30
+
+    GET parameters must contain username and password. If 'wait' is given,
+    block up to that many seconds (at most MAX_JOB_WAIT) for the provisioning
+    of the service to complete.
+
+    Returns the service data, including its state (INIT, PROVISIONING,
+    RUNNING, FAILED or STOPPING), in case of successful authentication.
+    False is returned otherwise, or once a stopped service is gone. If
+    'wait' is given for a service being stopped, block until it is gone.
+    """
+    uid = auth_uid(request.values.get('username', ''),
+        request.values.get('password', ''))
+
+    if uid is None:
+        # Authentication failed
+        return build_response(simplejson.dumps(False))
+
+    s = Service.query.filter_by(sid=serviceid, user_id=uid).first()
+    if not s:
+        return build_response(simplejson.dumps(False))
+
+    try:
+        wait = min(float(request.values.get('wait', 0)), MAX_JOB_WAIT)
+    except ValueError:
+        wait = 0
+
+    if wait > 0:
+        deadline = time.time() + wait
+        provisioning.wait(serviceid, wait)
+        terminating.wait(serviceid, max(deadline - time.time(), 0))
+        # Pick up the changes made by the workers
+        db.session.expire(s)
+        s = Service.query.filter_by(sid=serviceid).first()
+        if not s:
+            return build_response(simplejson.dumps(False))
+
     return build_response(jsonify(s.to_dict()))
 
 @app.route("/stop/<int:serviceid>", methods=['POST'])
@@ -149,64 +887,295 @@ def stop(serviceid):
     POSTed values must contain username and password.
 
     Returns a boolean value. True in case of successful authentication and
-    proper service termination. False otherwise.
+    if the service exists, False otherwise. The service moves to state
+    STOPPING and its manager is terminated in the background: the service
+    is deleted afterwards (see /job/<serviceid>).
     """
-    user = auth_user(request.values.get('username', ''), 
+    uid = auth_uid(request.values.get('username', ''),
         request.values.get('password', ''))
 
-    if user:
+    if uid is not None:
         # Authentication succeeded
-        s = Service.query.filter_by(sid=serviceid).first()
-        if s and s in user.services:
+        s = Service.query.filter_by(sid=serviceid, user_id=uid).first()
+        if s:
             # If a service with id 'serviceid' exists and user is the owner
-            cloud.stop(s.vmid)
-            db.session.delete(s)
-            db.session.commit()
+            request_stop([ s ])
             return build_response(simplejson.dumps(True))
 
     return build_response(simplejson.dumps(False))
 
+@app.route("/stop_batch", methods=['POST'])
+def stop_batch():
+    """eg: POST /stop_batch
+
+    POSTed values must contain username, password and 'sids', a JSON list of
+    service IDs.
+
+    Returns a dictionary mapping each service ID to True if the service is
+    being stopped, False otherwise. False is returned in case of failed
+    authentication or malformed input. As for /stop, managers are
+    terminated in the background.
+    """
+    uid = auth_uid(request.values.get('username', ''),
+        request.values.get('password', ''))
+
+    if uid is None:
+        # Authentication failed
+        return build_response(simplejson.dumps(False))
+
+    try:
+        sids = [ int(sid) for sid in
+                 simplejson.loads(request.values.get('sids', '')) ]
+    except (ValueError, TypeError):
+        return build_response(simplejson.dumps(False))
+
+    results = dict((sid, False) for sid in sids)
+
+    services = []
+    if sids:
+        services = Service.query.filter(Service.sid.in_(sids),
+            Service.user_id == uid).all()
+
+    # Read before the job is submitted: it may delete them right away
+    for s in services:
+        results[s.sid] = True
+
+    # All of them are torn down by the same job
+    request_stop(services)
+
+    return build_response(simplejson.dumps(results))
+
+def __list_params():
+    # Parameters of /list, validated. Raise ValueError if invalid.
+    limit = None
+    if request.values.get('limit', '') != '':
+        limit = int(request.values.get('limit'))
+        if limit < 1:
+            raise ValueError(limit)
+
+    cursor = int(request.values.get('cursor', 0) or 0)
+
+    fields = request.values.get('fields', '')
+    fields = fields and fields.split(',') or Service.FIELDS
+    for field in fields:
+        if field not in Service.FIELDS:
+            raise ValueError(field)
+
+    filters = {}
+    for name in ('type', 'state', 'manager_state'):
+        if request.values.get(name):
+            filters[name] = request.values.get(name).split(',')
+
+    return limit, cursor, fields, filters
+
 @app.route("/list", methods=['GET'])
 def list_services():
     """GET /list
 
     List running ConPaaS services if the user is authenticated. Return False
     otherwise.
+
+    Optional GET parameters:
+      limit:  return at most this many services, ordered by sid. If there
+              are more, the X-Next-Cursor response header holds the value to
+              be passed as 'cursor' to get the next ones.
+      cursor: only return services with a greater sid.
+      type, state, manager_state: only return services of the given type
+              or in the given state (comma-separated lists). manager_state
+              is the state last reported by their manager, or UNREACHABLE.
+      fields: comma-separated list of the attributes to be returned.
+
+    Responses carry an ETag. If it matches If-None-Match, 304 Not Modified
+    is returned without querying the services.
     """
-    user = auth_user(request.values.get('username', ''), 
+    uid = auth_uid(request.values.get('username', ''), 
         request.values.get('password', ''))
 
-    if not user:
+    if uid is None:
         # Authentication failed
         return build_response(simplejson.dumps(False))
 
-    return build_response(
-            simplejson.dumps([ ser.to_dict() for ser in user.services.all() ]))
+    try:
+        limit, cursor, fields, filters = __list_params()
+    except ValueError:
+        return build_response(simplejson.dumps(False))
+
+    version = db.session.query(User.services_version).filter_by(
+        uid=uid).first()
+    if version is None:
+        # The user has been removed
+        return build_response(simplejson.dumps(False))
+
+    # Changes whenever a service of this user does, or the query does
+    etag = "%d-%d-%s" % (uid, version[0] or 0, 
+        hashlib.sha1(repr((limit, cursor, fields, 
+            sorted(filters.items())))).hexdigest())
+
+    if request.if_none_match.contains(etag):
+        response = build_response("")
+        response.status_code = 304
+        response.set_etag(etag)
+        return response
+
+    query = db.session.query(*[ getattr(Service, field) for field in 
+        fields + [ 'sid' ] ]).filter(Service.user_id == uid, 
+            Service.sid > cursor)
+
+    for name, values in filters.items():
+        query = query.filter(getattr(Service, name).in_(values))
+
+    query = query.order_by(Service.sid)
+    if limit:
+        query = query.limit(limit + 1)
+
+    rows = query.all()
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][-1]
+
+    response = build_response(simplejson.dumps(
+        [ Service.row_to_dict(fields, row) for row in rows ]))
+    response.set_etag(etag)
+
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+
+    return response
+
+@app.route("/status", methods=['GET'])
+def status():
+    """GET /status
+
+    GET parameters must contain username and password. Return the state of
+    all the services of the user as last checked by the health sweeper,
+    without contacting their managers, or False if authentication fails:
+
+        { "checked": time of the last sweep (None if there was none yet),
+          "services": [ { "sid": 1, "type": "php", "state": "RUNNING",
+                          "manager_state": "RUNNING" }, ... ] }
+    """
+    uid = auth_uid(request.values.get('username', ''),
+        request.values.get('password', ''))
+
+    if uid is None:
+        # Authentication failed
+        return build_response(simplejson.dumps(False))
+
+    fields = [ 'sid', 'type', 'state', 'manager_state' ]
+    rows = db.session.query(*[ getattr(Service, field) for field in
+        fields ]).filter(Service.user_id == uid).order_by(Service.sid).all()
+
+    return build_response(simplejson.dumps({
+        'checked': last_sweep[0] and last_sweep[0].isoformat(),
+        'services': [ Service.row_to_dict(fields, row) for row in rows ] }))
 
 @app.route("/manager", methods=['GET','POST'])
 def manager():
+    if request.args.get('stream', '') == '1':
+        return stream_to_manager()
+
     method = request.values.get('method', '')
-    sid = request.values.get('sid', '')
-    params = {}
 
-    service = Service.query.filter_by(sid=sid).one()
+    try:
+        address = manager_address(int(request.values.get('sid', '')))
+    except ValueError:
+        address = None
+
+    if not address:
+        # No such service, or its manager is not running yet
+        return build_response(simplejson.dumps(False))
+
+    with metrics.span('manager_proxy'):
+        if request.method == "POST":
+            _, res = manager_connections.jsonrpc_post(address, 80, "/", 
+                method, request.values.to_dict())
+        else:
+            _, res = manager_connections.jsonrpc_get(address, 80, "/", method)
+
+    return build_response(res)
+
+def stream_to_manager():
+    """Streaming flavour of /manager, eg: POST /manager?stream=1&sid=3
+
+    'sid' and 'method' must be given in the query string. Bodies are
+    forwarded in chunks in both directions, so that large payloads (eg: code
+    archives, logs) are never held in memory. POSTed bodies reach the
+    manager untouched: they must be a JSON-RPC request or an upload the
+    manager understands.
+    """
+    try:
+        address = manager_address(int(request.args.get('sid', '')))
+    except ValueError:
+        address = None
+
+    if not address:
+        # No such service, or its manager is not running yet
+        return build_response(simplejson.dumps(False))
 
     if request.method == "POST":
-        _, res = https.client.jsonrpc_post(str(service.manager), 80, "/", method, 
-        request.values)
+        headers = {}
+        if request.content_type:
+            headers['Content-Type'] = request.content_type
+
+        with metrics.span('manager_proxy'):
+            status, mimetype, body = manager_connections.stream(address, 80,
+                'POST', '/', request.stream, headers, request.content_length)
     else:
-        _, res = https.client.jsonrpc_get(str(service.manager), 80, "/", method)
+        with metrics.span('manager_proxy'):
+            status, mimetype, body = manager_connections.stream(address, 80,
+                'GET', manager_connections.jsonrpc_url('/', 
+                    request.args.get('method', '')))
 
-    return build_response(res)
+    response = Response(body, status=status, mimetype=mimetype, 
+        direct_passthrough=True)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+# How /download transfers the file: by itself, or by letting the web server
+# do it ('x-sendfile' for Apache with mod_xsendfile, 'x-accel-redirect' for
+# nginx, with DOWNLOAD_ACCEL_PREFIX mapped to the director directory)
+DOWNLOAD_OFFLOAD = None
+if common.config.has_option('director', 'DOWNLOAD_OFFLOAD'):
+    DOWNLOAD_OFFLOAD = common.config.get('director', 
+        'DOWNLOAD_OFFLOAD').lower() or None
+
+DOWNLOAD_ACCEL_PREFIX = '/internal'
+if common.config.has_option('director', 'DOWNLOAD_ACCEL_PREFIX'):
+    DOWNLOAD_ACCEL_PREFIX = common.config.get('director', 
+        'DOWNLOAD_ACCEL_PREFIX')
+
+conpaas_tarball = artifacts.Artifact(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "ConPaaS.tar.gz"), 'application/x-gzip')
 
 @app.route("/download/ConPaaS.tar.gz", methods=['GET'])
 def download():
     """GET /download/ConPaaS.tar.gz
 
-    Returns ConPaaS tarball.
+    Returns ConPaaS tarball. The ETag is its SHA-256, also sent in the
+    Digest header: requests with a matching If-None-Match get 304 Not
+    Modified. Range requests are supported.
     """
-    return helpers.send_from_directory(os.path.dirname(__file__), 
-        "ConPaaS.tar.gz")
+    try:
+        return conpaas_tarball.response(request, DOWNLOAD_OFFLOAD, 
+            DOWNLOAD_ACCEL_PREFIX)
+    except (OSError, IOError):
+        abort(404)
+
+@app.route("/download/ConPaaS.tar.gz.sha256", methods=['GET'])
+def download_hash():
+    """GET /download/ConPaaS.tar.gz.sha256
+
+    Returns the SHA-256 of ConPaaS tarball, in the format of sha256sum.
+    Managers holding a copy of the tarball can check it is current without
+    downloading it again.
+    """
+    try:
+        digest = conpaas_tarball.hexdigest()
+    except (OSError, IOError):
+        abort(404)
+
+    return Response("%s  ConPaaS.tar.gz\n" % digest, mimetype='text/plain')
 
 @app.route("/ca/get_cert.php", methods=['POST'])
 def get_manager_cert():
@@ -215,6 +1184,103 @@ def get_manager_cert():
     return x509cert.create_x509_cert(
         common.config.get('conpaas', 'CERT_DIR'), csr)
 
+def __decrement_credit(uid, decrement):
+    # Single conditional UPDATE: concurrent decrements cannot be lost, and
+    # credit never drops below zero
+    return User.query.filter(User.uid == uid, 
+        User.credit - decrement > -1).update(
+            { User.credit: User.credit - decrement }, 
+            synchronize_session=False) == 1
+
+def apply_credit_decrements(decrements):
+    """Apply the given (uid, sid, decrement) tuples in a single transaction
+    and record them in the credit ledger. Decrements of the same user are
+    coalesced into one UPDATE. A fourth item, if present, is the datetime
+    at which the decrement has been reported.
+
+    Return a list of booleans, True for each decrement the user had enough
+    credit for."""
+    verdicts = [ False ] * len(decrements)
+
+    by_user = {}
+    for index, decrement in enumerate(decrements):
+        by_user.setdefault(decrement[0], []).append(index)
+
+    try:
+        for uid, indexes in by_user.items():
+            if len(indexes) == 1:
+                verdicts[indexes[0]] = __decrement_credit(uid, 
+                    decrements[indexes[0]][2])
+            else:
+                # Decide which decrements fit in the current credit. The
+                # user row stays locked until commit on databases supporting
+                # SELECT ... FOR UPDATE (eg: PostgreSQL)...
+                credit = db.session.query(User.credit).filter_by(
+                    uid=uid).with_lockmode('update').scalar()
+
+                accepted = []
+                for index in indexes:
+                    decrement = decrements[index][2]
+                    if credit is not None and credit - decrement > -1:
+                        credit -= decrement
+                        accepted.append(index)
+
+                # ...and apply them at once, unless the credit has been
+                # changed meanwhile by somebody else
+                total = sum(decrements[index][2] for index in accepted)
+                if accepted and __decrement_credit(uid, total):
+                    for index in accepted:
+                        verdicts[index] = True
+                elif accepted:
+                    for index in indexes:
+                        verdicts[index] = __decrement_credit(uid, 
+                            decrements[index][2])
+
+            for index in indexes:
+                if verdicts[index]:
+                    entry = CreditLedger(user_id=uid, 
+                        sid=decrements[index][1], 
+                        decrement=decrements[index][2])
+                    if len(decrements[index]) > 3:
+                        entry.created = decrements[index][3]
+                    db.session.add(entry)
+
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    for uid in by_user:
+        credentials.invalidate_user(uid)
+
+    return verdicts
+
+def __apply_credit_batch(decrements):
+    # Runs on the batcher thread
+    try:
+        return apply_credit_decrements(decrements)
+    finally:
+        db.session.remove()
+
+# Credit callbacks received within CREDIT_BATCH_WINDOW seconds are applied in
+# a single transaction. 0 applies every callback on its own.
+CREDIT_BATCH_WINDOW = 0
+if common.config.has_option('director', 'CREDIT_BATCH_WINDOW'):
+    CREDIT_BATCH_WINDOW = common.config.getfloat('director', 
+        'CREDIT_BATCH_WINDOW')
+
+credit_batcher = None
+if CREDIT_BATCH_WINDOW > 0:
+    credit_batcher = billing.CreditBatcher(CREDIT_BATCH_WINDOW, 
+        __apply_credit_batch)
+
+credit_callbacks_in_flight = metrics.gauge(
+    'director_credit_callbacks_in_flight', 
+    'Credit callbacks being served')
+
+credit_decrements = metrics.counter('director_credit_decrements_total',
+    'Credit decrements reported by managers', ('result',))
+
 @app.route("/callback/decrementUserCredit.php", methods=['POST'])
 def credit():
     """POST /callback/decrementUserCredit.php
@@ -241,16 +1307,139 @@ def credit():
             s.manager)
 
     # Decrement user's credit
-    s.user.credit -= decrement
+    credit_callbacks_in_flight.inc()
+    try:
+        if credit_batcher:
+            enough = credit_batcher.submit(s.user_id, s.sid, decrement)
+        else:
+            enough = apply_credit_decrements([ (s.user_id, s.sid, 
+                decrement) ])[0]
+    finally:
+        credit_callbacks_in_flight.dec()
 
-    if s.user.credit > -1:
-        # User has enough credit
-        db.session.commit()
-        return jsonify({ 'error': False })
+    credit_decrements.inc(result=enough and 'accepted' or 'rejected')
+    return jsonify({ 'error': not enough })
 
-    # User does not have enough credit
-    db.session.rollback()
-    return jsonify({ 'error': True })
+@app.route("/callback/decrementUserCreditBatch.php", methods=['POST'])
+def credit_batch():
+    """POST /callback/decrementUserCreditBatch.php
+
+    POSTed values must contain 'decrements', a JSON list of at most
+    MAX_CREDIT_BATCH_SIZE {"sid": ..., "decrement": ..., "timestamp": ...}
+    items. The timestamp is optional. Decrements are applied in timestamp
+    order, in a single transaction.
+
+    Returns a dictionary with the 'error' attribute set to True in case of
+    malformed input, including decrements which are not positive. Otherwise 'results' holds one {"sid": ..., "error": ...}
+    item per decrement, in the same order, with 'error' set to False if the
+    user had enough credit.
+    """
+    try:
+        items = simplejson.loads(request.values.get('decrements', ''))
+        # Timestamps out of the range of datetime are malformed input too
+        entries = [ (int(item['sid']), int(item['decrement']), 
+                     item.get('timestamp') and 
+                         datetime.fromtimestamp(float(item['timestamp'])))
+                    for item in items ]
+    except (ValueError, TypeError, KeyError, AttributeError, OverflowError):
+        return jsonify({ 'error': True })
+
+    if len(entries) > MAX_CREDIT_BATCH_SIZE or \
+            [ decrement for _, decrement, _ in entries if decrement <= 0 ]:
+        return jsonify({ 'error': True })
+
+    # Validate all the services with one query
+    owners = {}
+    sids = set(sid for sid, _, _ in entries)
+    if sids:
+        owners = dict(db.session.query(Service.sid, Service.user_id).filter(
+            Service.sid.in_(sids)).all())
+
+    for sid in sids - set(owners):
+        print "The service %s does not exist" % sid
+
+    # Oldest first
+    order = sorted(range(len(entries)), 
+        key=lambda index: entries[index][2] or datetime.min)
+    valid = [ index for index in order if entries[index][0] in owners ]
+
+    decrements = []
+    for index in valid:
+        sid, decrement, timestamp = entries[index]
+        if timestamp:
+            decrements.append((owners[sid], sid, decrement, timestamp))
+        else:
+            decrements.append((owners[sid], sid, decrement))
+
+    credit_callbacks_in_flight.inc()
+    try:
+        enough = dict(zip(valid, apply_credit_decrements(decrements)))
+    finally:
+        credit_callbacks_in_flight.dec()
+
+    for index in range(len(entries)):
+        credit_decrements.inc(result=enough.get(index) and 'accepted' 
+            or 'rejected')
+
+    return jsonify({ 'error': False, 'results': [ 
+        { 'sid': sid, 'error': not enough.get(index, False) } 
+        for index, (sid, _, _) in enumerate(entries) ] })
+
+request_latency = metrics.histogram('director_request_seconds',
+    'Time spent serving requests', ('endpoint', 'method', 'status'))
+
+@app.before_request
+def __start_timer():
+    request.environ['director.start'] = time.time()
+
+@app.after_request
+def __record_status(response):
+    request.environ['director.status'] = response.status_code
+    return response
+
+@app.teardown_request
+def __observe_latency(exc):
+    # Unlike after_request hooks, called for unhandled exceptions as well
+    start = request.environ.get('director.start')
+    if start is not None:
+        status = 500
+        if exc is None:
+            status = request.environ.get('director.status', 500)
+        request_latency.observe(time.time() - start, 
+            endpoint=request.endpoint or 'none', method=request.method,
+            status=status)
+
+def __job_stats():
+    stats = {}
+    for pool in (provisioning, terminating):
+        stats[(pool.name, 'active')] = pool.active()
+        stats[(pool.name, 'queued')] = pool.queued()
+    return stats
+
+metrics.gauge('director_jobs', 'Background jobs not completed yet, and those '
+    'among them waiting for a worker', ('pool', 'state'), __job_stats)
+
+metrics.gauge('director_keypool_keys', 'Pre-generated RSA keypairs', 
+    func=lambda: x509cert.keypool.stats()['size'])
+
+metrics.counter('director_keypool_requests_total', 'Keypairs requested from '
+    'the pool, and whether one was available', ('result',), 
+    lambda: { ('hit',): x509cert.keypool.hits, 
+              ('miss',): x509cert.keypool.misses })
+
+metrics.gauge('director_warm_managers', 'Pre-booted managers', 
+    ('type', 'state'), lambda: dict(((servicetype, state), 
+        pool.stats()[state]) for servicetype, pool in warm_pools.items()
+            for state in ('ready', 'booting')))
+
+@app.route("/metrics", methods=['GET'])
+def export_metrics():
+    """GET /metrics
+
+    Returns the director metrics in the Prometheus text format.
+    """
+    return Response(metrics.registry.render(), 
+        mimetype='text/plain; version=0.0.4')
 
 @app.route("/callback/terminateService.php")
 def terminate():
@@ -268,10 +1457,13 @@ class User(db.Model):
     password = db.Column(db.String(256))
     created = db.Column(db.DateTime)
     credit = db.Column(db.Integer)
+    # Incremented whenever any of the user's services changes
+    services_version = db.Column(db.Integer, default=0)
 
     def __init__(self, **kwargs):
         # Default values
         self.credit = 0
+        self.services_version = 0
         self.created = datetime.now()
 
         for key, val in kwargs.items():
@@ -282,15 +1474,20 @@ class Service(db.Model):
         autoincrement=True)
     name = db.Column(db.String(256))
     type = db.Column(db.String(32))
-    state = db.Column(db.String(32))
-    created = db.Column(db.DateTime)
-    manager = db.Column(db.String(512))
-    vmid = db.Column(db.String(256))
+    state = db.Column(db.String(32), index=True)
+    created = db.Column(db.DateTime, index=True)
+    manager = db.Column(db.String(512), index=True)
+    vmid = db.Column(db.String(256), index=True)
+    # Last state reported by the manager (see health_sweep())
+    manager_state = db.Column(db.String(32))
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.uid'))
     user = db.relationship('User', backref=db.backref('services', 
         lazy="dynamic"))
 
+    # Services of a user, in sid order (/list, /stop, credit callbacks)
+    __table_args__ = (db.Index('ix_service_user_id_sid', user_id, sid),)
+
     def __init__(self, **kwargs):
         # Default values
         self.state = "INIT"
@@ -299,15 +1496,76 @@ class Service(db.Model):
         for key, val in kwargs.items():
             setattr(self, key, val)
 
-    def to_dict(self):
-        ret = {}
-        for c in self.__table__.columns:
-            ret[c.name] = getattr(self, c.name)
-            if type(ret[c.name]) is datetime:
-                ret[c.name] = ret[c.name].isoformat()
+    def to_dict(self, fields=None):
+        return self.row_to_dict(fields or self.FIELDS, 
+            [ getattr(self, field) for field in fields or self.FIELDS ])
+
+    @staticmethod
+    def row_to_dict(fields, row):
+        """Return a dictionary mapping the given fields to the values in
+        'row', with datetime values in ISO format"""
+        ret = dict(zip(fields, row))
+
+        if 'created' in ret and ret['created'] is not None:
+            ret['created'] = ret['created'].isoformat()
 
         return ret
 
+class CreditLedger(db.Model):
+    """Append-only record of the credit decrements applied to users"""
+    lid = db.Column(db.Integer, primary_key=True, 
+        autoincrement=True)
+    # Not a foreign key: services are deleted when stopped
+    sid = db.Column(db.Integer, index=True)
+    decrement = db.Column(db.Integer)
+    created = db.Column(db.DateTime)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.uid'))
+
+    # Ledger of a user, in chronological order
+    __table_args__ = (db.Index('ix_credit_ledger_user_id_created', user_id, 
+        created),)
+
+    def __init__(self, **kwargs):
+        # Default values
+        self.created = datetime.now()
+
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+Service.FIELDS = [ c.name for c in Service.__table__.columns ]
+
+def __bump_services_version(session, flush_context):
+    # Every flush changing services increments services_version for their
+    # owners, in the same transaction
+    uids = set(obj.user_id for obj in 
+        list(session.new) + list(session.dirty) + list(session.deleted)
+        if isinstance(obj, Service) and obj.user_id is not None)
+
+    if uids:
+        bump_services_version(session, uids)
+
+def bump_services_version(session, uids):
+    """Increment services_version for the given users, for changes made to
+    their services without going through the ORM (eg: bulk updates)"""
+    users = User.__table__
+    session.execute(users.update().where(users.c.uid.in_(uids)).values(
+        services_version=func.coalesce(users.c.services_version, 0) + 1))
+
+event.listen(Session, 'after_flush', __bump_services_version)
+
+def __commit_started(session):
+    session.info['director.commit'] = time.time()
+
+def __commit_ended(session):
+    start = session.info.pop('director.commit', None)
+    if start is not None:
+        metrics.spans.observe(time.time() - start, span='db_commit')
+
+event.listen(Session, 'before_commit', __commit_started)
+event.listen(Session, 'after_commit', __commit_ended)
+event.listen(Session, 'after_rollback', __commit_ended)
+
 if __name__ == "__main__":
     db.create_all()
     app.run(host="0.0.0.0", debug=True)
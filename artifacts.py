@@ -0,0 +1,124 @@
+"""
+Serving of large static files, such as the ConPaaS.tar.gz fetched by every
+booting manager.
+
+The SHA-256 of a file is computed once per change. It is used both as its
+strong ETag and as a content hash managers can compare with what they
+already have, to skip downloading it again. Range requests are supported,
+and the transfer itself can be offloaded to the web server in front of the
+director (X-Sendfile for Apache with mod_xsendfile, X-Accel-Redirect for
+nginx), so that no worker thread is tied up streaming the file.
+"""
+
+import os
+import base64
+import hashlib
+import threading
+
+from flask import Response
+from werkzeug.wsgi import wrap_file
+
+CHUNK_SIZE = 64 * 1024
+
+def read_range(path, start, stop):
+    """Iterate over bytes start to stop (excluded) of the given file"""
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        left = stop - start
+        while left > 0:
+            chunk = f.read(min(CHUNK_SIZE, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+class Artifact(object):
+
+    def __init__(self, path, mimetype='application/octet-stream'):
+        self.path = path
+        self.mimetype = mimetype
+
+        # ((mtime, size), SHA-256 digest) of the version last hashed
+        self._digest = (None, None)
+        self._lock = threading.Lock()
+
+    def stat(self):
+        """Return the (mtime, size, digest) of the file, hashing it again
+        only if it changed. Raise OSError if it does not exist."""
+        st = os.stat(self.path)
+        version = (st.st_mtime, st.st_size)
+
+        with self._lock:
+            if self._digest[0] != version:
+                sha256 = hashlib.sha256()
+                f = open(self.path, 'rb')
+                try:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                        sha256.update(chunk)
+                finally:
+                    f.close()
+
+                self._digest = (version, sha256.digest())
+
+            return st.st_mtime, st.st_size, self._digest[1]
+
+    def hexdigest(self):
+        return self.stat()[2].encode('hex')
+
+    def response(self, request, offload=None, accel_prefix='/internal'):
+        """Return the response to a GET or HEAD of the file. 'offload' is
+        None, 'x-sendfile' or 'x-accel-redirect'. In the latter case, the
+        web server must map 'accel_prefix' to the directory of the file."""
+        mtime, size, digest = self.stat()
+        etag = digest.encode('hex')
+
+        response = Response(mimetype=self.mimetype)
+        response.set_etag(etag)
+        response.last_modified = mtime
+        response.headers['Digest'] = 'SHA-256=' + base64.b64encode(digest)
+        response.headers['Accept-Ranges'] = 'bytes'
+
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            return response
+
+        if offload == 'x-sendfile':
+            # Ranges are handled by the web server as well
+            response.headers['X-Sendfile'] = os.path.abspath(self.path)
+            return response
+
+        if offload == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = '%s/%s' % (
+                accel_prefix.rstrip('/'), os.path.basename(self.path))
+            return response
+
+        ranges = request.range
+        if_range = request.if_range
+        if ranges and (if_range.etag or if_range.date) and \
+                if_range.etag != etag:
+            # The client has another version: send the whole file
+            ranges = None
+
+        if ranges and len(ranges.ranges) == 1:
+            span = ranges.range_for_length(size)
+            if span is None:
+                response.status_code = 416
+                response.headers['Content-Range'] = 'bytes */%d' % size
+                return response
+
+            start, stop = span
+            response.status_code = 206
+            response.content_range = ranges.make_content_range(size)
+            response.content_length = stop - start
+            response.response = read_range(self.path, start, stop)
+            response.direct_passthrough = True
+            return response
+
+        response.content_length = size
+        response.response = wrap_file(request.environ, open(self.path, 'rb'),
+            CHUNK_SIZE)
+        response.direct_passthrough = True
+        return response
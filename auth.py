@@ -0,0 +1,107 @@
+"""
+Password hashing and verified-credential cache.
+
+Passwords are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>". Rows
+created by older versions of the director hold a plain MD5 hex digest: they
+are still accepted, and upgraded by the caller when needs_rehash() says so.
+"""
+
+import os
+import hmac
+import hashlib
+import binascii
+
+from cache import LRUCache
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 10000
+
+def _bytes(password):
+    # Form values are unicode strings
+    if isinstance(password, unicode):
+        return password.encode('utf-8')
+    return password
+
+def hash_password(password, salt=None, iterations=ITERATIONS):
+    password = _bytes(password)
+
+    if salt is None:
+        salt = binascii.hexlify(os.urandom(16))
+
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt,
+        binascii.hexlify(digest))
+
+def check_password(password, stored):
+    """Return True if 'password' matches the 'stored' hash"""
+    if not stored:
+        return False
+
+    if '$' not in stored:
+        # Legacy MD5 digest
+        return hmac.compare_digest(hashlib.md5(_bytes(password)).hexdigest(),
+            str(stored))
+
+    try:
+        algorithm, iterations, salt, _ = stored.split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return False
+
+    if algorithm != ALGORITHM:
+        return False
+
+    return hmac.compare_digest(hash_password(password, str(salt), iterations),
+        str(stored))
+
+def needs_rehash(stored):
+    """Return True if 'stored' was not hashed with the current scheme"""
+    return not stored.startswith("%s$%d$" % (ALGORITHM, ITERATIONS))
+
+class CredentialCache(object):
+    """Remembers recently verified (username, password) pairs for 'ttl'
+    seconds, so that clients polling the director do not pay for a password
+    hash and a database query on every request.
+
+    Passwords are never stored: entries hold an HMAC of the password keyed
+    with a per-process secret."""
+
+    def __init__(self, maxsize, ttl):
+        self._secret = os.urandom(32)
+        self._cache = LRUCache(maxsize, ttl)
+        # uid -> username, for invalidate_user()
+        self._usernames = LRUCache(maxsize, ttl)
+
+    def _digest(self, password):
+        return hmac.new(self._secret, _bytes(password),
+            hashlib.sha256).digest()
+
+    def lookup(self, username, password):
+        """Return the uid of the given user if the credentials have been
+        verified recently, None otherwise."""
+        entry = self._cache.get(username)
+        if entry is None:
+            return None
+
+        digest, uid = entry
+        if not hmac.compare_digest(digest, self._digest(password)):
+            return None
+
+        return uid
+
+    def store(self, username, password, uid):
+        self._cache.set(username, (self._digest(password), uid))
+        self._usernames.set(uid, username)
+
+    def invalidate(self, username):
+        self._cache.pop(username)
+
+    def invalidate_user(self, uid):
+        username = self._usernames.pop(uid)
+        if username is not None:
+            self.invalidate(username)
+
+    def clear(self):
+        self._cache.clear()
+        self._usernames.clear()
@@ -0,0 +1,457 @@
+"""
+ConPaaS director: benchmark
+
+Measures the throughput and the latency of the director endpoints at a given
+concurrency. The cloud is replaced by an in-process fake driver, whose VMs
+get an IP address BOOT_LATENCY seconds after being requested and whose
+requests fail with probability FAILURE_RATE, and /manager is proxied to a
+local stub manager. Requests go through the Flask test client, or through a
+local WSGI server with --server.
+
+A temporary database is used. The CA found in CERT_DIR (director.cfg) signs
+the certificates requested by /getcerts and /ca/get_cert.php.
+
+Results are printed as JSON, to be compared between commits:
+    python bench.py --requests 200 --concurrency 8 > before.json
+"""
+
+import os
+import sys
+import math
+import time
+import random
+import shutil
+import urllib
+import httplib
+import tempfile
+import threading
+import traceback
+import subprocess
+import simplejson
+import SocketServer
+import BaseHTTPServer
+from Queue import Queue, Empty
+from StringIO import StringIO
+from optparse import OptionParser
+
+from OpenSSL import crypto
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import app
+import cloud
+import common
+import proxy
+import x509cert
+
+USERNAME = "bench"
+PASSWORD = "benchpass"
+
+class FakeDriver(object):
+    """In-process IaaS driver. VMs get an IP address 'boot_latency' seconds
+    after being requested, new_instances() fails with probability
+    'failure_rate'."""
+
+    def __init__(self, boot_latency, failure_rate, ip='127.0.0.1'):
+        self.boot_latency = boot_latency
+        self.failure_rate = failure_rate
+        self.ip = ip
+
+        # vmid -> time it gets its IP address
+        self._vms = {}
+        self._next_vmid = 1
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        pass
+
+    def new_instances(self, count):
+        if random.random() < self.failure_rate:
+            raise Exception("Fake cloud failure")
+
+        nodes = []
+        with self._lock:
+            for _ in range(count):
+                vmid = str(self._next_vmid)
+                self._next_vmid += 1
+                self._vms[vmid] = time.time() + self.boot_latency
+                nodes.append({ 'id': vmid })
+
+        return nodes
+
+    def list_vms(self):
+        now = time.time()
+        with self._lock:
+            return dict((vmid, { 'ip': ready <= now and self.ip or '' })
+                        for vmid, ready in self._vms.items())
+
+    def kill_instance(self, node):
+        with self._lock:
+            self._vms.pop(getattr(node, 'id', node), None)
+
+class FakeController(object):
+    """Stands for cloud.ManagerController: no context file is generated"""
+
+    def __init__(self, driver):
+        self._Controller__default_cloud = driver
+        self.service_config = None
+
+    def generate_context(self, service_name):
+        pass
+
+def install_fake_cloud(driver):
+    """Route every cloud operation of the director to 'driver'"""
+    common.config.set('iaas', 'DRIVER', 'bench')
+    setattr(cloud, '__create_controller', lambda: FakeController(driver))
+    cloud.reset()
+
+class StubManager(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive HTTP server answering every JSON-RPC call successfully"""
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self):
+        body = simplejson.dumps({ 'result': { 'state': 'RUNNING' },
+                                  'error': None, 'id': 1 })
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply()
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Kept-alive connections are served by threads of their own"""
+
+    daemon_threads = True
+
+class StubConnectionPool(proxy.ConnectionPool):
+    """Plain HTTP connections to the stub manager, whatever the address"""
+
+    def __init__(self, port, *args, **kwargs):
+        proxy.ConnectionPool.__init__(self, *args, **kwargs)
+        self.port = port
+
+    def _connect(self, host, port):
+        return httplib.HTTPConnection(host, self.port)
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args):
+        pass
+
+def start_server(handler_class, app=None):
+    """Serve on a random local port in the background. Return the server."""
+    if app is not None:
+        server = make_server('127.0.0.1', 0, app, threaded=True,
+            request_handler=QuietRequestHandler)
+    else:
+        server = StubServer(('127.0.0.1', 0), handler_class)
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+def encode_multipart(fields, files):
+    """Return the (body, content type) of a multipart/form-data request"""
+    boundary = '----director-bench-%d' % random.randint(0, 1 << 30)
+    lines = []
+
+    for name, value in fields.items():
+        lines.extend([ '--' + boundary,
+            'Content-Disposition: form-data; name="%s"' % name, '', value ])
+
+    for name, (filename, content) in files.items():
+        lines.extend([ '--' + boundary,
+            'Content-Disposition: form-data; name="%s"; filename="%s"' % (
+                name, filename),
+            'Content-Type: application/octet-stream', '', content ])
+
+    lines.extend([ '--' + boundary + '--', '' ])
+    return '\r\n'.join(lines), 'multipart/form-data; boundary=' + boundary
+
+class TestClient(object):
+    """Requests through the Flask test client"""
+
+    def __init__(self):
+        self._client = app.app.test_client()
+
+    def request(self, method, path, fields={}, files={}):
+        if method == 'GET':
+            response = self._client.open(path, method=method,
+                query_string=fields)
+            return response.status_code, response.data
+
+        data = dict(fields)
+        for name, (filename, content) in files.items():
+            data[name] = (StringIO(content), filename)
+
+        response = self._client.open(path, method=method, data=data)
+        return response.status_code, response.data
+
+    def close(self):
+        pass
+
+class HTTPClient(object):
+    """Requests to a local WSGI server, over a persistent connection"""
+
+    def __init__(self, port):
+        self._conn = httplib.HTTPConnection('127.0.0.1', port)
+
+    def request(self, method, path, fields={}, files={}):
+        headers = {}
+        body = None
+
+        if files:
+            body, headers['Content-Type'] = encode_multipart(fields, files)
+        elif method == 'GET':
+            if fields:
+                path += '?' + urllib.urlencode(fields)
+        else:
+            body = urllib.urlencode(fields)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        try:
+            self._conn.request(method, path, body, headers)
+            response = self._conn.getresponse()
+            return response.status, response.read()
+        except (httplib.HTTPException, IOError):
+            # Reconnect on next request
+            self._conn.close()
+            raise
+
+    def close(self):
+        self._conn.close()
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def run(clients, requests):
+    """Send the (method, path, fields, files) tuples in 'requests', one
+    thread per client. Return the statistics of the run."""
+    queue = Queue()
+    for req in requests:
+        queue.put(req)
+
+    latencies = []
+    errors = [ 0 ]
+    lock = threading.Lock()
+
+    def work(client):
+        while True:
+            try:
+                method, path, fields, files = queue.get_nowait()
+            except Empty:
+                return
+
+            start = time.time()
+            try:
+                status, _ = client.request(method, path, fields, files)
+                failed = status >= 400
+            except Exception:
+                traceback.print_exc()
+                failed = True
+            elapsed = time.time() - start
+
+            with lock:
+                latencies.append(elapsed)
+                if failed:
+                    errors[0] += 1
+
+    threads = [ threading.Thread(target=work, args=(client,))
+                for client in clients ]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'throughput': elapsed and len(latencies) / elapsed,
+        'mean': latencies and sum(latencies) / len(latencies) or None,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies and latencies[-1] or None,
+    }
+
+def git_commit():
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=dirname,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[
+                0].strip() or None
+    except OSError:
+        return None
+
+def wait_running(client, sids, timeout):
+    """Wait for the given services to be provisioned. Return the sids of
+    those which are RUNNING."""
+    running = []
+    deadline = time.time() + timeout
+    auth = { 'username': USERNAME, 'password': PASSWORD }
+
+    for sid in sids:
+        while True:
+            wait = max(min(deadline - time.time(), app.MAX_JOB_WAIT), 0)
+            _, body = client.request('GET', '/job/%d' % sid,
+                dict(auth, wait=str(wait)))
+            service = simplejson.loads(body)
+            if not service or service['state'] in ('RUNNING', 'FAILED') or \
+                    not wait:
+                break
+
+        if service and service['state'] == 'RUNNING':
+            running.append(sid)
+
+    return running
+
+def benchmark(options):
+    tmpdir = tempfile.mkdtemp(prefix='director-bench-')
+
+    app.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+        tmpdir, 'director.db')
+    app.db.create_all()
+    app.create_user(USERNAME, "", "", "bench@example.org", "", PASSWORD,
+        10 ** 9)
+
+    driver = FakeDriver(options.boot_latency, options.failure_rate)
+    install_fake_cloud(driver)
+
+    manager = start_server(StubManager)
+    app.manager_connections = StubConnectionPool(manager.server_port,
+        app.PROXY_MAX_CONNECTIONS, app.PROXY_IDLE_TIMEOUT)
+
+    server = None
+    if options.server:
+        server = start_server(None, app.app)
+        new_client = lambda: HTTPClient(server.server_port)
+    else:
+        new_client = TestClient
+
+    clients = [ new_client() for _ in range(options.concurrency) ]
+    auth = { 'username': USERNAME, 'password': PASSWORD }
+    n = options.requests
+
+    csr = crypto.dump_certificate_request(crypto.FILETYPE_PEM,
+        x509cert.create_x509_req(x509cert.gen_rsa_keypair(), '1', '1',
+            'Contrail', 'bench@example.org', 'bench', 'manager'))
+
+    results = {}
+    try:
+        results['login'] = run(clients,
+            [ ('POST', '/login', auth, {}) ] * n)
+        results['getcerts'] = run(clients,
+            [ ('GET', '/getcerts', auth, {}) ] * n)
+        results['getcerts_renew'] = run(clients,
+            [ ('GET', '/getcerts', dict(auth, renew='1'), {}) ] * n)
+        results['ca_get_cert'] = run(clients,
+            [ ('POST', '/ca/get_cert.php', {}, { 'csr': ('csr.pem', csr) })
+            ] * n)
+
+        results['start'] = run(clients,
+            [ ('POST', '/start/' + options.service_type, auth, {}) ] * n)
+
+        sids = [ service['sid'] for service in simplejson.loads(
+            clients[0].request('GET', '/list', auth)[1]) ]
+
+        start = time.time()
+        running = wait_running(clients[0], sids, options.boot_timeout)
+        results['provisioning'] = { 'services': len(sids),
+            'running': len(running), 'seconds': time.time() - start }
+
+        if running:
+            results['list'] = run(clients,
+                [ ('GET', '/list', auth, {}) ] * n)
+            results['status'] = run(clients,
+                [ ('GET', '/status', auth, {}) ] * n)
+            results['manager'] = run(clients,
+                [ ('POST', '/manager', { 'sid': str(running[i % len(running)]),
+                    'method': 'get_service_info' }, {}) for i in range(n) ])
+            results['credit'] = run(clients,
+                [ ('POST', '/callback/decrementUserCredit.php', {
+                    'sid': str(running[i % len(running)]), 'decrement': '1' },
+                    {}) for i in range(n) ])
+
+        results['stop'] = run(clients,
+            [ ('POST', '/stop/%d' % sid, auth, {}) for sid in sids ])
+
+        # Let the terminations complete before the database goes away
+        for sid in sids:
+            app.terminating.wait(sid, options.boot_timeout)
+    finally:
+        for client in clients:
+            client.close()
+        app.manager_connections.clear()
+        if server is not None:
+            server.shutdown()
+        manager.shutdown()
+        app.db.session.remove()
+        shutil.rmtree(tmpdir)
+
+    return {
+        'commit': git_commit(),
+        'time': time.time(),
+        'options': {
+            'requests': n,
+            'concurrency': options.concurrency,
+            'server': options.server,
+            'boot_latency': options.boot_latency,
+            'failure_rate': options.failure_rate,
+            'service_type': options.service_type,
+        },
+        'endpoints': results,
+    }
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--requests', type='int', default=100,
+        help="requests per endpoint (default: %default)")
+    parser.add_option('-c', '--concurrency', type='int', default=4,
+        help="concurrent clients (default: %default)")
+    parser.add_option('--server', action='store_true', default=False,
+        help="go through a local WSGI server instead of the test client")
+    parser.add_option('--boot-latency', type='float', default=1.0,
+        help="seconds fake VMs take to boot (default: %default)")
+    parser.add_option('--failure-rate', type='float', default=0.0,
+        help="probability of VM requests failing (default: %default)")
+    parser.add_option('--boot-timeout', type='float', default=120,
+        help="seconds to wait for the services to be provisioned "
+             "(default: %default)")
+    parser.add_option('--service-type', default='php',
+        help="type of the services started (default: %default)")
+    parser.add_option('-o', '--output',
+        help="write the results to this file instead of stdout")
+    options, args = parser.parse_args()
+
+    # Keep what the director prints out of the results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        results = benchmark(options)
+    finally:
+        sys.stdout = stdout
+
+    results = simplejson.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(results + '\n')
+    else:
+        print results
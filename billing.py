@@ -0,0 +1,74 @@
+"""
+Group commit of credit decrements.
+
+Managers report their credit usage through the decrementUserCredit callback.
+When batching is enabled, callbacks received within 'window' seconds are
+applied together in a single transaction, decrements of the same user being
+coalesced. Each caller still gets its own verdict, or the exception raised
+while applying the batch: a failure is not a lack of credit.
+"""
+
+import sys
+import time
+import threading
+import traceback
+
+class CreditBatcher(object):
+
+    def __init__(self, window, apply):
+        """apply(decrements) must apply a list of (uid, sid, decrement)
+        tuples in one transaction and return a list of booleans: True for
+        each decrement the user had enough credit for."""
+        self.window = window
+
+        self._apply = apply
+        self._pending = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, uid, sid, decrement):
+        """Queue a decrement and wait until it has been applied. Return True
+        if the user had enough credit, False otherwise. Raise the exception
+        raised by apply(), if any."""
+        entry = { 'decrement': (uid, sid, decrement), 'verdict': False,
+                  'error': None, 'event': threading.Event() }
+
+        with self._lock:
+            self._pending.append(entry)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name="creditbatcher")
+                self._thread.daemon = True
+                self._thread.start()
+
+        entry['event'].wait()
+        if entry['error'] is not None:
+            raise entry['error'][0], entry['error'][1], entry['error'][2]
+        return entry['verdict']
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+
+            with self._lock:
+                batch, self._pending = self._pending, []
+
+                if not batch:
+                    # Idle: started again by the next submit()
+                    self._thread = None
+                    return
+
+            try:
+                verdicts = self._apply([ entry['decrement']
+                                         for entry in batch ])
+            except Exception:
+                traceback.print_exc()
+                for entry in batch:
+                    entry['error'] = sys.exc_info()
+                    entry['event'].set()
+                continue
+
+            for entry, verdict in zip(batch, verdicts):
+                entry['verdict'] = verdict
+                entry['event'].set()
@@ -0,0 +1,66 @@
+"""
+Small thread-safe in-memory caches.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Mapping holding at most 'maxsize' entries. The least recently used
+    entry is evicted first, and entries expire 'ttl' seconds after having
+    been stored (never if ttl is None)."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.time():
+                return default
+
+            # Most recently used entries are kept at the end
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        if self.maxsize <= 0 or ttl == 0:
+            # Caching disabled
+            return
+
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -1,16 +1,31 @@
 import os
+import time
+import threading
 
 import x509cert
+import cloudpool
+import metrics
+import vmwatcher
 import common
 common.extend_path()
 
+import templates
 from conpaas.core.controller import Controller
-from conpaas.core.misc import file_get_contents
+
+# Seconds a manager VM is given to obtain an IP address
+BOOT_TIMEOUT = 600
 
 class ManagerController(Controller):
 
+    def __init__(self, config_parser, *args, **kwargs):
+        Controller.__init__(self, config_parser, *args, **kwargs)
+
+        # Configuration of the service whose context file is generated next,
+        # as returned by get_service_config()
+        self.service_config = config_parser
+
     def _get_certificate(self, email, cn, org):
-        config_parser = self._Controller__config_parser
+        config_parser = self.service_config
 
         user_id = config_parser.get("manager", "FE_USER_ID")
         service_id = config_parser.get("manager", "FE_SERVICE_ID")
@@ -19,9 +34,9 @@ class ManagerController(Controller):
         return x509cert.generate_certificate(cert_dir, user_id, service_id, 
                                              "manager", email, cn, org)
 
-    def _get_context_file(self, service_name, cloud):
-        """Override default _get_context_file. Here we generate the context
-        file for managers rather than for agents."""
+    def _context_template(self, service_name, cloud):
+        """Return the compiled context file template for the given service
+        type and cloud. Files are only read again when they change."""
         config_parser = self._Controller__config_parser
 
         conpaas_home = config_parser.get('conpaas', 'ROOT_DIR')
@@ -30,146 +45,291 @@ class ManagerController(Controller):
         mngr_scripts_dir  = os.path.join(conpaas_home, 'scripts', 'manager')
         mngr_cfg_dir      = os.path.join(conpaas_home, 'config', 'manager')
 
-        frontend = config_parser.get('director', 'DIRECTOR_URL')
-
-        # Values to be passed to the context file template
-        tmpl_values = {}
-
-        # Get contextualization script for the cloud
-        tmpl_values['cloud_script'] = file_get_contents(
-            os.path.join(cloud_scripts_dir, cloud))
-
-        # Get manager setup file
-        mngr_setup = file_get_contents(
-            os.path.join(mngr_scripts_dir,'manager-setup'))
-
-        tmpl_values['mngr_setup'] = mngr_setup.replace('%FRONTEND_URL%', 
-            frontend)
-
-        # Get cloud config values from director.cfg
-        tmpl_values['cloud_cfg'] = "[iaas]\n"
-        for key, value in config_parser.items("iaas"):
-            tmpl_values['cloud_cfg'] += key.upper() + " = " + value + "\n"
-
-        # Get manager config file 
-        mngr_cfg = file_get_contents(
-            os.path.join(mngr_cfg_dir, 'default-manager.cfg'))
-
-        # Add service-specific config file (if any)
+        cloud_script = os.path.join(cloud_scripts_dir, cloud)
+        mngr_setup = os.path.join(mngr_scripts_dir, 'manager-setup')
+        mngr_cfg = os.path.join(mngr_cfg_dir, 'default-manager.cfg')
         mngr_service_cfg = os.path.join(mngr_cfg_dir, 
             service_name + '-manager.cfg')
+        mngr_start = os.path.join(mngr_scripts_dir, 'default-manager-start')
+        mngr_service_start = os.path.join(mngr_scripts_dir, 
+            service_name + '-manager-start')
 
-        if os.path.isfile(mngr_service_cfg):
-            mngr_cfg += file_get_contents(mngr_service_cfg)
-
-        # Modify manager config file setting the required variables
-        mngr_cfg = mngr_cfg.replace('%FRONTEND_URL%', frontend)
-        mngr_cfg = mngr_cfg.replace('%CONPAAS_SERVICE_TYPE%', service_name)
-        mngr_cfg = mngr_cfg.replace('%CONPAAS_SERVICE_ID%', 
-            config_parser.get("manager", "FE_SERVICE_ID"))
-        mngr_cfg = mngr_cfg.replace('%CONPAAS_USER_ID%', 
-            config_parser.get("manager", "FE_USER_ID"))
-        tmpl_values['mngr_cfg'] = mngr_cfg
-
-        # Add default manager startup script
-        tmpl_values['mngr_start_script'] = file_get_contents(
-            os.path.join(mngr_scripts_dir, 'default-manager-start'))
-
-        # Or the service-specific one (if any)
-        mngr_startup_scriptname = os.path.join(
-            mngr_scripts_dir, service_name + '-manager-start')
+        def build(files):
+            for required in (cloud_script, mngr_setup, mngr_cfg, mngr_start):
+                if files[required] is None:
+                    raise IOError("Cannot read %s" % required)
 
-        if os.path.isfile(mngr_startup_scriptname):
-            tmpl_values['mngr_start_script'] = file_get_contents(
-                mngr_startup_scriptname)
+            # Add service-specific config file (if any)
+            cfg = files[mngr_cfg] + (files[mngr_service_cfg] or "")
 
-        # Get key and a certificate from CA
-        mngr_certs = self._get_certificate(email="info@conpaas.eu", 
-                                           cn="ConPaaS", 
-                                           org="Contrail")
-
-        tmpl_values['mngr_certs_cert']    = mngr_certs['cert']
-        tmpl_values['mngr_certs_key']     = mngr_certs['key']
-        tmpl_values['mngr_certs_ca_cert'] = mngr_certs['ca_cert']
+            # Service-specific startup script (if any) or the default one
+            start_script = files[mngr_service_start] or files[mngr_start]
 
-        # Concatenate the files
-        return """%(cloud_script)s
+            return templates.Template([
+                (files[cloud_script], ()),
+                ("""
 
 cat <<EOF > /tmp/cert.pem
-%(mngr_certs_cert)s
+%MNGR_CERT%
 EOF
 
 cat <<EOF > /tmp/key.pem
-%(mngr_certs_key)s
+%MNGR_KEY%
 EOF
 
 cat <<EOF > /tmp/ca_cert.pem
-%(mngr_certs_ca_cert)s
+%MNGR_CA_CERT%
 EOF
 
-%(mngr_setup)s
+""", ('MNGR_CERT', 'MNGR_KEY', 'MNGR_CA_CERT')),
+                (files[mngr_setup], ('FRONTEND_URL',)),
+                ("""
 
 cat <<EOF > $ROOT_DIR/config.cfg
-%(cloud_cfg)s
-%(mngr_cfg)s
+%CLOUD_CFG%
+""", ('CLOUD_CFG',)),
+                (cfg, ('FRONTEND_URL', 'CONPAAS_SERVICE_TYPE', 
+                       'CONPAAS_SERVICE_ID', 'CONPAAS_USER_ID')),
+                ("""
 EOF
 
-%(mngr_start_script)s""" % tmpl_values
+""", ()),
+                (start_script, ()),
+            ])
 
-def __get_config(service_id, user_id):
-    """Add manager configuration"""
-    config_parser = common.config
+        return templates.cache.get(('manager', cloud, service_name), 
+            [ cloud_script, mngr_setup, mngr_cfg, mngr_service_cfg, 
+              mngr_start, mngr_service_start ], build)
 
-    if not config_parser.has_section("manager"):
-        config_parser.add_section("manager")
+    def _get_context_file(self, service_name, cloud):
+        """Override default _get_context_file. Here we generate the context
+        file for managers rather than for agents."""
+        config_parser = self.service_config
+
+        # Get cloud config values from director.cfg
+        cloud_cfg = "[iaas]\n"
+        for key, value in config_parser.items("iaas"):
+            cloud_cfg += key.upper() + " = " + value + "\n"
 
-    config_parser.set("manager", "FE_SERVICE_ID", service_id)
-    config_parser.set("manager", "FE_USER_ID", user_id)
-    config_parser.set("manager", "FE_CREDIT_URL", 
-        config_parser.get('director', 'DIRECTOR_URL') + "/credit")
-    config_parser.set("manager", "FE_TERMINATE_URL", 
-        config_parser.get('director', 'DIRECTOR_URL') + "/terminate")
-    config_parser.set("manager", "FE_CA_URL", 
-        config_parser.get('director', 'DIRECTOR_URL') + "/ca")
+        # Get key and a certificate from CA
+        mngr_certs = self._get_certificate(email="info@conpaas.eu", 
+                                           cn="ConPaaS", 
+                                           org="Contrail")
 
-    return config_parser
+        return self._context_template(service_name, cloud).render({
+            'FRONTEND_URL': config_parser.get('director', 'DIRECTOR_URL'),
+            'CONPAAS_SERVICE_TYPE': service_name,
+            'CONPAAS_SERVICE_ID': config_parser.get("manager", 
+                "FE_SERVICE_ID"),
+            'CONPAAS_USER_ID': config_parser.get("manager", "FE_USER_ID"),
+            'CLOUD_CFG': cloud_cfg,
+            'MNGR_CERT': mngr_certs['cert'],
+            'MNGR_KEY': mngr_certs['key'],
+            'MNGR_CA_CERT': mngr_certs['ca_cert'],
+        })
+
+def get_service_config(service_id, user_id):
+    """Return a per-service view of director.cfg with the manager
+    configuration added. common.config itself is left untouched, so that
+    concurrent requests do not see each other's values."""
+    director_url = common.config.get('director', 'DIRECTOR_URL')
+
+    return common.ConfigOverlay(common.config, { 'manager': {
+        'FE_SERVICE_ID': service_id,
+        'FE_USER_ID': user_id,
+        'FE_CREDIT_URL': director_url + "/credit",
+        'FE_TERMINATE_URL': director_url + "/terminate",
+        'FE_CA_URL': director_url + "/ca",
+    }})
 
 def __stop_reservation_timer(controller):
     for reservation_timer in controller._Controller__reservation_map.values():
         reservation_timer.stop()
 
-def start(service_name, service_id, user_id):
-    """Start a manager for the given service_name, service_id and user_id"""
-    config_parser = __get_config(str(service_id), str(user_id))
-    # Create a new controller
-    controller = ManagerController(config_parser)
-    # Create a context file for the specific service
-    controller.generate_context(service_name)
-
-    # Only useful for testing purposes if the director is not running on a
-    # public IP
-    controller._Controller__deduct_credit = lambda x: True
+# Connected controllers kept per IaaS driver: at most CLOUD_POOL_SIZE of them,
+# checked if unused for CLOUD_CHECK_INTERVAL seconds
+CLOUD_POOL_SIZE = 4
+if common.config.has_option('director', 'CLOUD_POOL_SIZE'):
+    CLOUD_POOL_SIZE = common.config.getint('director', 'CLOUD_POOL_SIZE')
 
-    # FIXME: test_manager(ip, port) not implemented yet. Just return True.
-    node = controller.create_nodes(1, lambda ip, port: True, None)[0]
+CLOUD_CHECK_INTERVAL = cloudpool.CHECK_INTERVAL
+if common.config.has_option('director', 'CLOUD_CHECK_INTERVAL'):
+    CLOUD_CHECK_INTERVAL = common.config.getint('director', 
+        'CLOUD_CHECK_INTERVAL')
 
-    # Stop the reservation timer or the call will not return
+def __create_controller():
+    controller = ManagerController(get_service_config("", ""))
+
+    # Only useful for testing purposes if the director is not running on
+    # a public IP
+    controller._Controller__deduct_credit = lambda x: True
+
+    # Stop the reservation timer or calls will not return
     __stop_reservation_timer(controller)
 
-    return node.ip, node.id
+    controller._Controller__default_cloud._connect()
+    return controller
+
+def __check_controller(controller):
+    controller._Controller__default_cloud.list_vms()
+
+__pools = {}
+__pools_lock = threading.Lock()
+
+def __controller():
+    """Context manager lending a connected controller for the configured
+    IaaS driver"""
+    driver = common.config.get('iaas', 'DRIVER')
+
+    with __pools_lock:
+        if driver not in __pools:
+            size = CLOUD_POOL_SIZE
+            if driver == 'dummy':
+                # Dummy VMs are only visible through the connection which
+                # created them
+                size = 1
+
+            __pools[driver] = cloudpool.HandlePool(__create_controller,
+                __check_controller, size, CLOUD_CHECK_INTERVAL)
+
+        pool = __pools[driver]
+
+    return pool.handle()
+
+def reset():
+    """Drop the pooled controllers: new ones, with new cloud connections,
+    are created on next use."""
+    with __pools_lock:
+        __pools.clear()
+
+def list_vms():
+    """Return the inventory of the configured cloud"""
+    with __controller() as controller:
+        with metrics.span('cloud_list_vms'):
+            return controller._Controller__default_cloud.list_vms()
+
+def vm_watcher():
+    """Return the VMWatcher shared by all the starts on the configured cloud"""
+    return vmwatcher.get_watcher(common.config.get('iaas', 'DRIVER'), 
+        list_vms)
+
+def __node_id(node):
+    # new_instances() returns dictionaries or objects depending on the driver
+    try:
+        return node['id']
+    except TypeError:
+        return node.id
+
+@metrics.timed('cloud_start')
+def start_batch(service_name, service_ids, user_id):
+    """Start a manager for each of the given service_ids, all of them of type
+    service_name and belonging to user_id. The VMs are requested through the
+    pooled cloud connections and boot in parallel, while a single watcher
+    waits for all of them.
+
+    Return a dictionary mapping each service_id to either a (ip, vmid) tuple
+    or the exception raised while starting its manager."""
+    results = {}
+    futures = {}
+
+    for service_id in service_ids:
+        try:
+            with __controller() as controller:
+                # Create a context file for the specific service
+                controller.service_config = get_service_config(
+                    str(service_id), str(user_id))
+                controller.generate_context(service_name)
+
+                with metrics.span('cloud_new_instances'):
+                    node = controller._Controller__default_cloud.new_instances(
+                        1)[0]
+        except Exception, err:
+            results[service_id] = err
+            continue
+
+        futures[service_id] = vm_watcher().watch(__node_id(node), 
+            BOOT_TIMEOUT)
+
+    for service_id, future in futures.items():
+        try:
+            results[service_id] = (future.result(), future.vmid)
+        except Exception, err:
+            results[service_id] = err
+            try:
+                stop(future.vmid)
+            except Exception:
+                pass
+
+    return results
 
-def stop(vmid):
-    config_parser = __get_config(vmid, "")
-    # Create a new controller
-    controller = ManagerController(config_parser)
-    
-    cloud = controller._Controller__default_cloud
-    cloud._connect()
-    
+def start(service_name, service_id, user_id):
+    """Start a manager for the given service_name, service_id and user_id"""
+    result = start_batch(service_name, [service_id], user_id)[service_id]
+
+    if isinstance(result, Exception):
+        raise result
+
+    return result
+
+def __kill(vmid):
+    # kill_instance() takes an object with an id attribute on newer versions
+    # of libcloud, a string on older ones
     class Node: pass
     n = Node()
     n.id = vmid
-    cloud.kill_instance(n)
 
-    __stop_reservation_timer(controller)
+    with __controller() as controller, metrics.span('cloud_kill'):
+        cloud = controller._Controller__default_cloud
+        try:
+            cloud.kill_instance(n)
+        except Exception:
+            cloud.kill_instance(vmid)
+
+def stop_batch(vmids, retries=0, backoff=1):
+    """Terminate the given VMs through the pooled cloud connections. Failed
+    terminations are retried up to 'retries' times, waiting 'backoff'
+    seconds before the first retry and twice as long before each of the
+    following ones. VMs missing from the inventory count as terminated.
+
+    Return a dictionary mapping each vmid to True or to the exception raised
+    while terminating it."""
+    results = {}
+    pending = list(vmids)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        for vmid in pending:
+            try:
+                __kill(vmid)
+                results[vmid] = True
+            except Exception, err:
+                results[vmid] = err
+
+        pending = [ vmid for vmid in pending 
+                    if isinstance(results[vmid], Exception) ]
+        if not pending:
+            break
+
+        # A single listing tells which of the failed VMs are gone anyway
+        try:
+            existing = list_vms()
+        except Exception:
+            continue
+
+        for vmid in pending[:]:
+            if vmid not in existing:
+                results[vmid] = True
+                pending.remove(vmid)
+
+        if not pending:
+            break
+
+    return results
+
+def stop(vmid):
+    result = stop_batch([vmid])[vmid]
 
+    if isinstance(result, Exception):
+        raise result
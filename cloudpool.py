@@ -0,0 +1,89 @@
+"""
+Pool of long-lived cloud handles (eg: connected ManagerControllers).
+
+Creating a handle means instantiating the cloud driver and connecting it, so
+handles are created once and reused by every start, stop and inventory
+listing. Each of them is used by one thread at a time. A handle that has
+not been used successfully for 'check_interval' seconds, or whose last use
+raised an exception, is checked before being handed out again and replaced
+by a new one (ie: reconnected) if the check fails.
+"""
+
+import time
+import threading
+import traceback
+from contextlib import contextmanager
+
+CHECK_INTERVAL = 60
+
+class HandlePool(object):
+
+    def __init__(self, create, check, size, check_interval=CHECK_INTERVAL):
+        """create() must return a new, connected handle. check(handle) must
+        raise an exception if the handle is not usable anymore."""
+        self.size = size
+        self.check_interval = check_interval
+
+        self._create = create
+        self._check = check
+        # [ (handle, time of its last successful use), ... ]
+        self._idle = []
+        # Handles in existence, idle or not
+        self._count = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def handle(self):
+        """Context manager lending a handle, waiting for one to be released
+        if 'size' of them are already in use"""
+        handle = self._acquire()
+        try:
+            yield handle
+        except:
+            # Possibly a broken connection: check it before the next use
+            self._release(handle, 0)
+            raise
+
+        self._release(handle, time.time())
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._count >= self.size:
+                self._cond.wait()
+
+            if self._idle:
+                # Most recently used first
+                handle, verified = self._idle.pop()
+            else:
+                handle, verified = None, None
+                self._count += 1
+
+        try:
+            if handle is not None and \
+                    time.time() - verified > self.check_interval:
+                try:
+                    self._check(handle)
+                except Exception:
+                    traceback.print_exc()
+                    print "Reconnecting to the cloud"
+                    handle = None
+
+            if handle is None:
+                handle = self._create()
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+        return handle
+
+    def _release(self, handle, verified):
+        with self._cond:
+            self._idle.append((handle, verified))
+            self._cond.notify()
+
+    def stats(self):
+        """Return the number of handles in existence and of idle ones"""
+        with self._cond:
+            return { 'handles': self._count, 'idle': len(self._idle) }
@@ -1,6 +1,6 @@
 import os
 import sys
-from ConfigParser import ConfigParser
+from ConfigParser import ConfigParser, NoSectionError, NoOptionError
 
 dirname = os.path.dirname(__file__)
 CONFFILE = os.path.join(dirname, "director.cfg")
@@ -13,3 +13,89 @@ def extend_path():
     root_dir = config.get('conpaas', 'ROOT_DIR')
     sys.path.append(os.path.join(root_dir, "src"))
     sys.path.append(os.path.join(root_dir, "contrib"))
+
+class ConfigOverlay(object):
+    """Copy-on-write view of a ConfigParser.
+
+    Reads fall through to the underlying ConfigParser unless the option has
+    been set on the overlay. Writes only affect the overlay. This way each
+    request can have its own view of director.cfg without modifying the
+    process-wide 'config' shared by all threads."""
+
+    def __init__(self, base, overrides={}):
+        """'overrides' maps section names to dictionaries of options"""
+        self._base = base
+        self._sections = {}
+
+        for section, options in overrides.items():
+            self.add_section(section)
+            for option, value in options.items():
+                self.set(section, option, value)
+
+    def sections(self):
+        return self._base.sections() + [ section for section in
+            self._sections if not self._base.has_section(section) ]
+
+    def has_section(self, section):
+        return section in self._sections or self._base.has_section(section)
+
+    def add_section(self, section):
+        self._sections.setdefault(section, {})
+
+    def options(self, section):
+        options = []
+        if self._base.has_section(section):
+            options = self._base.options(section)
+
+        if section not in self._sections and not options:
+            raise NoSectionError(section)
+
+        return options + [ option for option in self._sections.get(section,
+            {}) if option not in options ]
+
+    def has_option(self, section, option):
+        option = self._base.optionxform(option)
+        return (option in self._sections.get(section, {}) or
+                self._base.has_option(section, option))
+
+    def get(self, section, option, *args, **kwargs):
+        overridden = self._sections.get(section, {})
+        key = self._base.optionxform(option)
+
+        if key in overridden:
+            return overridden[key]
+
+        if section in self._sections and not self._base.has_section(section):
+            raise NoOptionError(option, section)
+
+        return self._base.get(section, option, *args, **kwargs)
+
+    def getint(self, section, option):
+        return int(self.get(section, option))
+
+    def getfloat(self, section, option):
+        return float(self.get(section, option))
+
+    def getboolean(self, section, option):
+        value = self.get(section, option)
+        if value.lower() not in self._base._boolean_states:
+            raise ValueError('Not a boolean: %s' % value)
+        return self._base._boolean_states[value.lower()]
+
+    def items(self, section, *args, **kwargs):
+        items = []
+        if self._base.has_section(section):
+            items = self._base.items(section, *args, **kwargs)
+        elif section not in self._sections:
+            raise NoSectionError(section)
+
+        overridden = self._sections.get(section, {})
+        return ([ (key, value) for key, value in items 
+                  if key not in overridden ] + overridden.items())
+
+    def set(self, section, option, value=None):
+        if not self.has_section(section):
+            raise NoSectionError(section)
+
+        self._sections.setdefault(section, {})[
+            self._base.optionxform(option)] = value
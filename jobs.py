@@ -0,0 +1,119 @@
+"""
+Bounded pool of background worker threads.
+
+Long-running director operations (eg: booting a manager VM) are submitted here
+so that they do not tie up the thread serving the HTTP request. Periodic runs
+housekeeping tasks (eg: the reconciler) on a thread of their own.
+"""
+
+import time
+import threading
+import traceback
+from Queue import Queue
+
+class WorkerPool(object):
+
+    def __init__(self, size, name="worker"):
+        self.size = size
+        self.name = name
+
+        self._queue = Queue()
+        self._threads = []
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _start_workers(self):
+        # Threads are started lazily so that merely importing a module does
+        # not spawn them (eg: adduser.py)
+        while len(self._threads) < self.size:
+            t = threading.Thread(target=self._work,
+                name="%s-%d" % (self.name, len(self._threads)))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            keys, event, func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._done(keys, event)
+
+    def _done(self, keys, event):
+        with self._lock:
+            for key in keys:
+                if self._events.get(key) is event:
+                    del self._events[key]
+        event.set()
+
+    def submit(self, key, func, *args):
+        """Run func(*args) on one of the workers. 'key' identifies the job
+        for subsequent calls to wait() and is_pending()."""
+        self.submit_batch([key], func, *args)
+
+    def submit_batch(self, keys, func, *args):
+        """Like submit(), for a single job covering all of the given keys"""
+        event = threading.Event()
+
+        with self._lock:
+            self._start_workers()
+            for key in keys:
+                self._events[key] = event
+
+        self._queue.put((keys, event, func, args))
+
+    def is_pending(self, key):
+        with self._lock:
+            return key in self._events
+
+    def wait(self, key, timeout):
+        """Wait up to 'timeout' seconds for job 'key' to complete. Return True
+        if the job is not pending anymore, False otherwise."""
+        with self._lock:
+            event = self._events.get(key)
+
+        if event is None:
+            return True
+
+        event.wait(timeout)
+        return event.is_set()
+
+    def queued(self):
+        """Number of jobs waiting for a free worker"""
+        return self._queue.qsize()
+
+    def active(self):
+        """Number of jobs submitted and not completed yet"""
+        with self._lock:
+            return len(set(self._events.values()))
+
+class Periodic(object):
+    """Run func() every 'interval' seconds on a background thread"""
+
+    def __init__(self, interval, func, name="periodic"):
+        self.interval = interval
+        self.name = name
+
+        self._func = func
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the thread, unless it is running already"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._func()
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,207 @@
+"""
+Lightweight metrics, exported by /metrics in the Prometheus text format.
+
+Recording a value takes a lock and a couple of additions, so instrumentation
+can stay enabled in production. Histograms have fixed buckets; spans() times
+the stages requests go through (authentication, cloud calls, certificate
+generation, database commits...) in a single histogram labelled by stage.
+"""
+
+import time
+import bisect
+import threading
+from functools import wraps
+
+# Seconds: from fast in-memory operations to VM boots
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10, 30, 60, 120, 300, 600)
+
+def __escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, __escape(value))
+                             for name, value in pairs)
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = [ '# HELP %s %s' % (self.name, self.help),
+                  '# TYPE %s %s' % (self.name, self.type) ]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """If 'func' is given, it is called at export time and must return the
+    value, or a dictionary mapping tuples of label values to values."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=(), func=None):
+        Metric.__init__(self, name, help, labels)
+        self._values = {}
+        self._func = func
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self._func is not None:
+            values = self._func()
+            if not isinstance(values, dict):
+                values = { (): values }
+
+            with self._lock:
+                self._values = dict(values)
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [ '%s%s %s' % (self.name, format_labels(self.labels, key),
+                              value) for key, value in values ]
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+        # label values -> [ per bucket counts (last one is +Inf), sum ]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [ [ 0 ] * (len(self.buckets) + 1),
+                                              0.0 ]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, **labels):
+        """Context manager observing the time spent in its block"""
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry and sum(entry[0]) or 0
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name,
+                    format_labels(self.labels, key, [ ('le', bound) ]),
+                    cumulative))
+
+            labels = format_labels(self.labels, key)
+            lines.append('%s_sum%s %r' % (self.name, labels, total))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+
+        return lines
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.time() - self._start, **self._labels)
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = list(self._metrics)
+
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+registry = Registry()
+
+def counter(name, help, labels=(), func=None):
+    return registry.register(Counter(name, help, labels, func))
+
+def gauge(name, help, labels=(), func=None):
+    return registry.register(Gauge(name, help, labels, func))
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+spans = histogram('director_span_seconds',
+    'Time spent in each stage of the director hot paths', ('span',))
+
+def span(name):
+    """Context manager timing its block as stage 'name'"""
+    return spans.time(span=name)
+
+def timed(name):
+    """Decorator timing every call of the decorated function as stage
+    'name'"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with spans.time(span=name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
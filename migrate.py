@@ -0,0 +1,80 @@
+"""
+ConPaaS director: upgrade the schema of an existing database
+
+Migrations are applied in order and the last one applied is recorded in the
+schema_version table. Each of them checks the current schema before changing
+it, so that databases created from scratch by db.create_all() can be
+upgraded (or just stamped) as well.
+
+Usage: python migrate.py
+"""
+
+from sqlalchemy import inspect, Table, Column, Integer, MetaData
+
+import app
+
+def __create_credit_ledger(conn):
+    app.CreditLedger.__table__.create(conn, checkfirst=True)
+
+def __add_services_version(conn):
+    columns = [ c['name'] for c in inspect(conn).get_columns('user') ]
+    if 'services_version' not in columns:
+        conn.execute('ALTER TABLE "user" ADD COLUMN services_version '
+            'INTEGER DEFAULT 0')
+
+def __create_indexes(conn):
+    for table in app.db.metadata.sorted_tables:
+        existing = set(index['name']
+            for index in inspect(conn).get_indexes(table.name))
+
+        for index in table.indexes:
+            if index.name not in existing:
+                print "Creating index %s" % index.name
+                index.create(conn)
+
+def __add_manager_state(conn):
+    columns = [ c['name'] for c in inspect(conn).get_columns('service') ]
+    if 'manager_state' not in columns:
+        conn.execute('ALTER TABLE service ADD COLUMN manager_state '
+            'VARCHAR(32)')
+
+# (version, description, function): append only
+MIGRATIONS = [
+    (1, "credit ledger", __create_credit_ledger),
+    (2, "user.services_version", __add_services_version),
+    (3, "indexes for the hot queries", __create_indexes),
+    (4, "service.manager_state", __add_manager_state),
+]
+
+schema_version = Table('schema_version', MetaData(),
+    Column('version', Integer, nullable=False))
+
+def current_version(conn):
+    schema_version.create(conn, checkfirst=True)
+    return conn.execute(schema_version.select()).scalar() or 0
+
+def upgrade(engine):
+    """Apply the pending migrations to the database behind 'engine'. Return
+    the list of versions applied."""
+    applied = []
+
+    with engine.begin() as conn:
+        version = current_version(conn)
+
+        for number, description, function in MIGRATIONS:
+            if number > version:
+                print "Applying migration %d: %s" % (number, description)
+                function(conn)
+                applied.append(number)
+
+        if applied:
+            conn.execute(schema_version.delete())
+            conn.execute(schema_version.insert().values(version=applied[-1]))
+
+    return applied
+
+if __name__ == "__main__":
+    # Tables not existing at all are simply created
+    app.db.create_all()
+    if not upgrade(app.db.engine):
+        print "The database is up to date"
@@ -0,0 +1,260 @@
+"""
+Opt-in request profiling, enabled from the [director] section of
+director.cfg (see director.cfg.example).
+
+ProfilingMiddleware wraps the director WSGI application. A fraction of the
+requests, configurable per URL prefix, is profiled with cProfile or with a
+sampling profiler. The profiles of the slowest of them are kept in a
+directory: at most 'keep' files and 'max_size' bytes, the fastest profiles
+being removed first. Sending the secret token in the X-Director-Profile
+header or in the _profile query parameter profiles a single request on
+demand; the name of its profile is returned in the X-Director-Profile
+response header.
+
+Only the call to the application is profiled, not the iteration over
+streamed response bodies. When profiling is disabled, wrap() returns the
+application itself: requests do not go through any extra code.
+"""
+
+import os
+import re
+import sys
+import time
+import thread
+import random
+import cProfile
+import threading
+import traceback
+from urlparse import parse_qs
+
+import common
+
+HEADER = 'X-Director-Profile'
+QUERY_PARAM = '_profile'
+
+# Seconds between two stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+class Sampler(object):
+    """Statistical profiler: a background thread records the stack of the
+    profiled thread every 'interval' seconds. Profiles are written in the
+    collapsed stack format understood by flamegraph.pl."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # 'outermost;...;innermost' frame -> number of samples
+        self.stacks = {}
+
+        self._ident = None
+        self._running = False
+        self._thread = None
+
+    def enable(self):
+        self._ident = thread.get_ident()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def disable(self):
+        self._running = False
+        self._thread.join()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+
+            frame = sys._current_frames().get(self._ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                    os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump_stats(self, path):
+        f = open(path, 'w')
+        try:
+            for stack, count in sorted(self.stacks.items(),
+                                       key=lambda item: -item[1]):
+                f.write('%s %d\n' % (stack, count))
+        finally:
+            f.close()
+
+PROFILERS = { 'cprofile': cProfile.Profile, 'sampling': Sampler }
+
+def parse_rates(value):
+    """Parse '/start:1, /list:0.1' into { '/start': 1.0, '/list': 0.1 }"""
+    rates = {}
+    for item in value.split(','):
+        if item.strip():
+            prefix, rate = item.rsplit(':', 1)
+            rates[prefix.strip()] = float(rate)
+    return rates
+
+class ProfilingMiddleware(object):
+
+    def __init__(self, app, directory, profiler='cprofile', rate=0,
+                 routes={}, keep=20, max_size=50 * 1024 * 1024, token=None):
+        """'rate' is the fraction of requests profiled, unless their path
+        starts with one of the prefixes in 'routes', which maps prefixes to
+        their own rate (the longest matching prefix wins)."""
+        if profiler not in PROFILERS:
+            raise ValueError("Unknown profiler: %s" % profiler)
+
+        self.app = app
+        self.directory = directory
+        self.profiler = profiler
+        self.rate = rate
+        self.routes = sorted(routes.items(), key=lambda item: -len(item[0]))
+        self.keep = keep
+        self.max_size = max_size
+        self.token = token
+
+        # [ (elapsed, filename, size), ... ] of the profiles kept, slowest
+        # first
+        self._profiles = []
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def _load(self):
+        # Profiles left by previous runs take part in the rotation
+        for filename in os.listdir(self.directory):
+            match = re.match(r'(\d+)ms-', filename)
+            if match:
+                size = os.path.getsize(os.path.join(self.directory, filename))
+                self._profiles.append((int(match.group(1)) / 1000.0,
+                    filename, size))
+        self._profiles.sort(reverse=True)
+
+    def _rate(self, path):
+        for prefix, rate in self.routes:
+            if path.startswith(prefix):
+                return rate
+        return self.rate
+
+    def _requested(self, environ):
+        if not self.token:
+            return False
+
+        if environ.get('HTTP_X_DIRECTOR_PROFILE') == self.token:
+            return True
+
+        query = environ.get('QUERY_STRING', '')
+        return QUERY_PARAM in query and \
+            self.token in parse_qs(query).get(QUERY_PARAM, [])
+
+    def __call__(self, environ, start_response):
+        requested = self._requested(environ)
+        if not requested and random.random() >= self._rate(
+                environ.get('PATH_INFO', '')):
+            return self.app(environ, start_response)
+
+        started = []
+        written = []
+
+        def delayed_start_response(status, headers, exc_info=None):
+            # Passed on once the profile is saved, to add its name to the
+            # headers
+            started[:] = [ status, headers, exc_info ]
+            return written.append
+
+        profiler = PROFILERS[self.profiler]()
+        start = time.time()
+        profiler.enable()
+        try:
+            app_iter = self.app(environ, delayed_start_response)
+        finally:
+            profiler.disable()
+            elapsed = time.time() - start
+
+            try:
+                name = self._save(profiler, elapsed, environ, requested)
+            except Exception:
+                traceback.print_exc()
+                name = None
+
+        if started:
+            status, headers, exc_info = started
+            if requested and name:
+                headers = headers + [ (HEADER, name) ]
+
+            write = start_response(status, headers, exc_info)
+            for data in written:
+                write(data)
+
+        return app_iter
+
+    def _save(self, profiler, elapsed, environ, requested):
+        """Write the profile if it is among the slowest ones, or if it has
+        been requested. Return its file name, or None."""
+        with self._lock:
+            if not requested and len(self._profiles) >= self.keep and \
+                    elapsed <= self._profiles[-1][0]:
+                return None
+
+        route = re.sub(r'[^A-Za-z0-9]+', '_',
+            environ.get('PATH_INFO', '')).strip('_') or 'root'
+        filename = '%dms-%s-%s-%d.%s' % (elapsed * 1000,
+            environ.get('REQUEST_METHOD', 'GET'), route[:50],
+            random.randint(0, 1 << 30),
+            self.profiler == 'cprofile' and 'prof' or 'txt')
+        path = os.path.join(self.directory, filename)
+
+        profiler.dump_stats(path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self._profiles.append((elapsed, filename, size))
+            self._profiles.sort(reverse=True)
+
+            removed = []
+            total = sum(entry[2] for entry in self._profiles)
+            # Drop the fastest profiles, but never the one just written
+            for entry in reversed(self._profiles):
+                if len(self._profiles) - len(removed) <= self.keep and \
+                        total <= self.max_size:
+                    break
+                if entry[1] != filename:
+                    removed.append(entry)
+                    total -= entry[2]
+
+            for entry in removed:
+                self._profiles.remove(entry)
+
+        for entry in removed:
+            try:
+                os.remove(os.path.join(self.directory, entry[1]))
+            except OSError:
+                pass
+
+        return filename in [ entry[1] for entry in self._profiles ] and \
+            filename or None
+
+def wrap(app, config=common.config):
+    """Return 'app' wrapped in a ProfilingMiddleware configured from
+    director.cfg, or 'app' itself if profiling is disabled"""
+    def option(name, get=config.get, default=None):
+        if config.has_option('director', name):
+            return get('director', name)
+        return default
+
+    profiler = option('PROFILER')
+    if not profiler:
+        return app
+
+    return ProfilingMiddleware(app,
+        directory=option('PROFILE_DIR', default='/var/tmp/director-profiles'),
+        profiler=profiler,
+        rate=option('PROFILE_RATE', config.getfloat, 0),
+        routes=parse_rates(option('PROFILE_ROUTES', default='')),
+        keep=option('PROFILE_KEEP', config.getint, 20),
+        max_size=option('PROFILE_MAX_SIZE', config.getint, 50) * 1024 * 1024,
+        token=option('PROFILE_TOKEN'))
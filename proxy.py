@@ -0,0 +1,258 @@
+"""
+JSON-RPC client for ConPaaS managers with persistent connections.
+
+Requests are encoded as in conpaas.core.https.client, but connections are
+kept alive and reused: at most 'max_per_host' of them are opened towards the
+same manager, and idle ones are closed after 'idle_timeout' seconds.
+
+ConnectionPool.stream() transfers request and response bodies in chunks of
+CHUNK_SIZE bytes instead of holding them in memory.
+"""
+
+import ssl
+import time
+import socket
+import httplib
+import threading
+import simplejson
+from urllib import urlencode
+
+CHUNK_SIZE = 64 * 1024
+
+class StreamedBody(object):
+    """Iterable over the body of a manager response. The connection goes
+    back to the pool once the body has been entirely read, and is closed if
+    the iteration is interrupted."""
+
+    def __init__(self, pool, host, port, conn, response):
+        self._pool = pool
+        self._addr = (host, port)
+        self._conn = conn
+        self._response = response
+        self._done = False
+
+    def __iter__(self):
+        while True:
+            chunk = self._response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+        self._done = True
+        self.close()
+
+    def close(self):
+        # WSGI servers call close() whether or not the body has been read
+        if self._conn is None:
+            return
+
+        conn, self._conn = self._conn, None
+        self._pool.release(self._addr[0], self._addr[1], conn,
+            reuse=self._done and not self._response.will_close)
+
+class ConnectionPool(object):
+
+    def __init__(self, max_per_host, idle_timeout, key_file=None,
+                 cert_file=None, ca_file=None, timeout=None):
+        """Managers are authenticated against the CA certificate in
+        'ca_file', if given. Their certificates are not issued for their
+        addresses: host names are not checked."""
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.ca_file = ca_file
+        self.timeout = timeout
+        self.context = self._context()
+
+        # (host, port) -> [ (connection, last used), ... ]
+        self._idle = {}
+        # (host, port) -> number of connections in use
+        self._busy = {}
+        self._evicted = time.time()
+        self._cond = threading.Condition()
+
+    def _context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.check_hostname = False
+        if self.ca_file:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_verify_locations(self.ca_file)
+        if self.cert_file:
+            context.load_cert_chain(self.cert_file, self.key_file)
+        return context
+
+    def _connect(self, host, port):
+        return httplib.HTTPSConnection(host, port, timeout=self.timeout,
+            context=self.context)
+
+    def _evict(self, now):
+        # Called with self._cond held
+        if now - self._evicted < 1:
+            return
+
+        self._evicted = now
+        for addr, idle in self._idle.items():
+            while idle and now - idle[0][1] > self.idle_timeout:
+                idle.pop(0)[0].close()
+
+            if not idle:
+                del self._idle[addr]
+
+    def acquire(self, host, port):
+        """Return a (connection, reused) tuple for the given manager, waiting
+        for one to be released if max_per_host are already in use."""
+        addr = (host, port)
+
+        with self._cond:
+            self._evict(time.time())
+
+            while True:
+                idle = self._idle.get(addr)
+                if idle:
+                    self._busy[addr] = self._busy.get(addr, 0) + 1
+                    # Most recently used first: older ones are left to expire
+                    return idle.pop()[0], True
+
+                if self._busy.get(addr, 0) < self.max_per_host:
+                    self._busy[addr] = self._busy.get(addr, 0) + 1
+                    break
+
+                self._cond.wait()
+
+        return self._connect(host, port), False
+
+    def release(self, host, port, conn, reuse=True):
+        addr = (host, port)
+
+        with self._cond:
+            self._busy[addr] -= 1
+            if not self._busy[addr]:
+                del self._busy[addr]
+
+            if reuse:
+                self._idle.setdefault(addr, []).append((conn, time.time()))
+            else:
+                conn.close()
+
+            self._cond.notify()
+
+    def clear(self, host=None, port=None):
+        """Close idle connections, towards the given manager only if any"""
+        with self._cond:
+            for addr in self._idle.keys():
+                if host is None or addr == (host, port):
+                    for conn, _ in self._idle.pop(addr):
+                        conn.close()
+
+    def _retry(self, reused, retried, replayable, err):
+        # The manager closed the idle connection: retry once on a fresh one,
+        # if replaying the request is harmless. A timeout is not a stale
+        # connection.
+        return reused and not retried and replayable and \
+            not isinstance(err, socket.timeout)
+
+    def request(self, host, port, method, url, body=None, headers={}):
+        """Perform a HTTP request and return a (status, body) tuple"""
+        retried = False
+        while True:
+            conn, reused = self.acquire(host, port)
+            sent = False
+
+            try:
+                conn.request(method, url, body, headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error), err:
+                self.release(host, port, conn, reuse=False)
+                # Requests with a body (POSTed calls act on the service) are
+                # only replayed if they could not be sent
+                if self._retry(reused, retried, not sent or body is None,
+                               err):
+                    retried = True
+                    continue
+                raise
+            except:
+                self.release(host, port, conn, reuse=False)
+                raise
+
+            self.release(host, port, conn, reuse=not response.will_close)
+            return response.status, data
+
+    def _send_body(self, conn, body, length):
+        if length is not None:
+            while True:
+                chunk = body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                conn.send(chunk)
+            return
+
+        # Unknown length: use chunked transfer encoding
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+
+        conn.send('0\r\n\r\n')
+
+    def stream(self, host, port, method, url, body=None, headers={},
+               length=None):
+        """Perform a HTTP request without buffering either body. 'body' is a
+        file-like object holding 'length' bytes, or an unknown amount if
+        length is None.
+
+        Return a (status, content type, StreamedBody) tuple."""
+        retried = False
+        while True:
+            conn, reused = self.acquire(host, port)
+
+            try:
+                conn.putrequest(method, url, skip_accept_encoding=True)
+                for name, value in headers.items():
+                    conn.putheader(name, value)
+
+                if body is None:
+                    conn.endheaders()
+                else:
+                    if length is None:
+                        conn.putheader('Transfer-Encoding', 'chunked')
+                    else:
+                        conn.putheader('Content-Length', str(length))
+                    conn.endheaders()
+                    self._send_body(conn, body, length)
+
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), err:
+                self.release(host, port, conn, reuse=False)
+                # A streamed body cannot be replayed: it has been read
+                if self._retry(reused, retried, body is None, err):
+                    retried = True
+                    continue
+                raise
+            except:
+                self.release(host, port, conn, reuse=False)
+                raise
+
+            return (response.status, response.getheader('Content-Type'),
+                StreamedBody(self, host, port, conn, response))
+
+    def jsonrpc_url(self, uri, method, params=None):
+        all_params = { 'method': method, 'id': '1' }
+        if params:
+            all_params['params'] = simplejson.dumps(params)
+
+        return '%s?%s' % (uri, urlencode(all_params))
+
+    def jsonrpc_get(self, host, port, uri, method, params=None):
+        return self.request(host, port, 'GET',
+            self.jsonrpc_url(uri, method, params))
+
+    def jsonrpc_post(self, host, port, uri, method, params={}):
+        body = simplejson.dumps({ 'method': method, 'params': params,
+                                  'id': '1' })
+
+        return self.request(host, port, 'POST', uri, body,
+            { 'Content-Type': 'application/json' })
@@ -0,0 +1,71 @@
+"""
+ConPaaS director: asynchronous server
+
+Serves the director with gevent (optional dependency: pip install gevent)
+rather than with a fixed number of threads. Sockets, threads and locks are
+patched to be cooperative, so that requests waiting on cloud APIs, on
+managers (/manager) or on background jobs (/job?wait=...) do not hold a
+thread each: a single process can keep thousands of them open. The routes
+are those of app.py, unchanged.
+
+Code which does not go through Python sockets still blocks the whole
+process while it runs: SQLite queries, RSA key generation, and cloud
+drivers using pycurl. The sampling profiler of profiling.py does not see
+greenlets: use PROFILER = cprofile.
+
+Usage: python serve.py [--host HOST] [--port PORT]
+"""
+
+import sys
+
+try:
+    from gevent import monkey
+except ImportError:
+    sys.exit("serve.py requires gevent (pip install gevent)")
+
+# Before anything else imports socket, threading or time
+monkey.patch_all()
+
+from optparse import OptionParser
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import app
+import common
+import profiling
+
+def __option(name, default, get=common.config.get):
+    if common.config.has_option('director', name):
+        return get('director', name)
+    return default
+
+# Requests served at the same time. Further connections wait to be accepted.
+SERVE_CONNECTIONS = __option('SERVE_CONNECTIONS', 1000, common.config.getint)
+
+# Certificate and key to serve HTTPS directly, without a web server in front
+SERVE_CERTFILE = __option('SERVE_CERTFILE', None)
+SERVE_KEYFILE = __option('SERVE_KEYFILE', None)
+
+def make_server(host, port):
+    ssl_args = {}
+    if SERVE_CERTFILE:
+        ssl_args = { 'certfile': SERVE_CERTFILE, 'keyfile': SERVE_KEYFILE }
+
+    return WSGIServer((host, port), profiling.wrap(app.app),
+        spawn=Pool(SERVE_CONNECTIONS), **ssl_args)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--host', default=__option('SERVE_HOST', '0.0.0.0'),
+        help="address to listen on (default: %default)")
+    parser.add_option('--port', type='int',
+        default=__option('SERVE_PORT', 5000, common.config.getint),
+        help="port to listen on (default: %default)")
+    options, args = parser.parse_args()
+
+    app.db.create_all()
+
+    server = make_server(options.host, options.port)
+    print "Serving on %s:%d" % (options.host, options.port)
+    server.serve_forever()
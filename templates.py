@@ -0,0 +1,102 @@
+"""
+Cached, pre-compiled templates for manager contextualization files.
+
+The scripts and config files making up a context file are read once and
+split into literal text and %NAME% placeholders. Rendering a template is then
+a single join, without any disk I/O. Files are checked for changes at most
+every CHECK_INTERVAL seconds: templates are rebuilt when the mtime of any of
+their files changes, or when a file appears or disappears.
+"""
+
+import os
+import re
+import time
+import threading
+
+from conpaas.core.misc import file_get_contents
+
+# Seconds between checks for changes of the template files
+CHECK_INTERVAL = 5
+
+def placeholders(names):
+    """Return a regular expression matching the %NAME% placeholders of the
+    given names only: other %...% tokens must not consume their delimiters"""
+    return re.compile('%(' + '|'.join(map(re.escape, names)) + ')%')
+
+class Template(object):
+
+    def __init__(self, segments):
+        """'segments' is a list of (text, names) tuples. Only the %NAME%
+        placeholders whose NAME is listed in 'names' are substituted in the
+        corresponding text; everything else is kept as is."""
+        # List of (literal text, placeholder name or None)
+        self._parts = []
+
+        for text, names in segments:
+            pos = 0
+            if names:
+                for match in placeholders(names).finditer(text):
+                    self._parts.append((text[pos:match.start()],
+                        match.group(1)))
+                    pos = match.end()
+
+            self._parts.append((text[pos:], None))
+
+    def render(self, values):
+        """Return the template text with its placeholders replaced by the
+        corresponding items of 'values'"""
+        return "".join([ name and literal + values[name] or literal
+                         for literal, name in self._parts ])
+
+def mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        # Missing file
+        return None
+
+def read(path):
+    """Return the contents of 'path', None if it does not exist"""
+    try:
+        return file_get_contents(path)
+    except IOError:
+        return None
+
+class TemplateCache(object):
+
+    def __init__(self):
+        # key -> [ last check, paths, mtimes, template ]
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, paths, build):
+        """Return the Template cached under 'key'. 'paths' are the files it
+        is made of: build(contents) is called to compile it again when any
+        of them changes, with a dictionary mapping each path to its contents
+        (None for missing files)."""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry and now - entry[0] < CHECK_INTERVAL:
+            return entry[3]
+
+        mtimes = [ mtime(path) for path in paths ]
+
+        if entry and entry[1] == paths and entry[2] == mtimes:
+            entry[0] = now
+            return entry[3]
+
+        template = build(dict((path, read(path)) for path in paths))
+
+        with self._lock:
+            self._entries[key] = [ now, paths, mtimes, template ]
+
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+cache = TemplateCache()
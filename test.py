@@ -1,9 +1,42 @@
+import os
+import ssl
+import sys
+import time
+import shutil
+import socket
 import urllib
+import urllib2
+import urlparse
+import zipfile
+import subprocess
+import hashlib
+import httplib
+import tempfile
+import StringIO
 import unittest
+import threading
 import simplejson
+import BaseHTTPServer
+import sqlalchemy
+from OpenSSL import crypto
 
 import app
+import artifacts
+import cloud
+import common
+import database
+import proxy
+import billing
+import bench
+import cloudpool
 import actions
+import metrics
+import migrate
+import profiling
+import templates
+import vmwatcher
+import warmpool
+import x509cert
 
 class Common(unittest.TestCase):
 
@@ -11,6 +44,10 @@ class Common(unittest.TestCase):
         app.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///director-test.db"
         app.db.drop_all()
         app.db.create_all()
+        app.credentials.clear()
+        app.cert_bundles.clear()
+        # Start from a fresh (dummy) cloud
+        app.cloud.reset()
 
     def create_user(self):
         return app.create_user("ema", "Emanuele", "Rocca", "ema@linux.it", 
@@ -25,6 +62,33 @@ class DbTest(Common):
         self.assert_(app.auth_user("ema", "properpass") is not None)
         self.assertFalse(app.auth_user("wronguname", "properpass"))
 
+    def test_upgrade_md5_password(self):
+        user = self.create_user()
+        user.password = hashlib.md5("properpass").hexdigest()
+        app.db.session.commit()
+
+        self.assertFalse(app.auth_user("ema", "wrongpass"))
+        self.assert_(app.auth_user("ema", "properpass"))
+
+        # The legacy hash has been replaced on successful authentication
+        user = app.User.query.filter_by(username="ema").first()
+        self.assert_(user.password.startswith("pbkdf2_sha256$"))
+        self.assert_(app.auth_user("ema", "properpass"))
+
+    def test_credential_cache(self):
+        user = self.create_user()
+
+        self.assertEquals(user.uid, app.auth_uid("ema", "properpass"))
+        self.assertEquals(user.uid, 
+            app.credentials.lookup("ema", "properpass"))
+        self.assertEquals(None, app.credentials.lookup("ema", "wrongpass"))
+
+        # Changing the password invalidates the cached credentials
+        app.set_password(user, "newpass")
+        self.assertEquals(None, app.credentials.lookup("ema", "properpass"))
+        self.assertFalse(app.auth_user("ema", "properpass"))
+        self.assert_(app.auth_user("ema", "newpass"))
+
     def test_create_service(self):
         self.create_user()
 
@@ -59,6 +123,1119 @@ class DbTest(Common):
         user = app.auth_user("ema", "properpass")
         self.assertEquals(110, user.credit)
 
+class DatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def engine(self, pool_size):
+        saved = database.POOL_SIZE, database.MAX_OVERFLOW
+        database.POOL_SIZE, database.MAX_OVERFLOW = pool_size, 5
+        try:
+            options = {}
+            info = sqlalchemy.engine.url.make_url(
+                'sqlite:///' + os.path.join(self.tmpdir, 'director.db'))
+            database.DirectorSQLAlchemy().apply_driver_hacks(app.app, info, 
+                options)
+            return sqlalchemy.create_engine(info, **options)
+        finally:
+            database.POOL_SIZE, database.MAX_OVERFLOW = saved
+
+    def test_pool_size(self):
+        engine = self.engine(3)
+        self.assert_(isinstance(engine.pool, sqlalchemy.pool.QueuePool))
+        self.assertEquals(3, engine.pool.size())
+
+    def test_pool_size_zero(self):
+        # DB_POOL_SIZE = 0 keeps the NullPool of SQLite files
+        engine = self.engine(0)
+        self.assert_(isinstance(engine.pool, sqlalchemy.pool.NullPool))
+        self.assertEquals(1, engine.execute("SELECT 1").scalar())
+
+class KeyPoolTest(unittest.TestCase):
+
+    def test_keypool(self):
+        pool = x509cert.KeyPool(1, 2)
+
+        # Empty pool: the key is generated inline
+        self.assert_(pool.get() is not None)
+        self.assertEquals(0, pool.stats()['hits'])
+        self.assertEquals(1, pool.stats()['misses'])
+
+        # Meanwhile the pool is being refilled in the background
+        for _ in range(60):
+            if pool.stats()['size'] == 2:
+                break
+            time.sleep(1)
+
+        self.assert_(pool.get() is not None)
+        self.assertEquals(1, pool.stats()['hits'])
+
+class CertificateAuthorityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cert_dir = tempfile.mkdtemp()
+        self.write_ca("Test CA")
+
+    def tearDown(self):
+        shutil.rmtree(self.cert_dir)
+
+    def write_ca(self, cn):
+        key = x509cert.gen_rsa_keypair()
+        cert = crypto.X509()
+        cert.get_subject().CN = cn
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(60 * 60)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, "sha1")
+
+        open(os.path.join(self.cert_dir, "ca_cert.pem"), "w").write(
+            crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        open(os.path.join(self.cert_dir, "ca_key.pem"), "w").write(
+            crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+    def issuer(self, certs):
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, certs['cert'])
+        return cert.get_issuer().CN
+
+    def test_generate_certificate(self):
+        certs = x509cert.generate_certificate(self.cert_dir, "1", "0", 
+            "user", "ema@linux.it", "ema", "Contrail")
+
+        self.assertEquals("Test CA", self.issuer(certs))
+        self.assertEquals(x509cert.get_ca(self.cert_dir).cert_pem, 
+            certs['ca_cert'])
+
+    def test_reload_on_change(self):
+        ca = x509cert.get_ca(self.cert_dir)
+        self.assert_(ca is x509cert.get_ca(self.cert_dir))
+
+        self.write_ca("Renewed CA")
+        future = time.time() + 10
+        for name in ("ca_cert.pem", "ca_key.pem"):
+            os.utime(os.path.join(self.cert_dir, name), (future, future))
+        ca._checked = 0
+
+        certs = x509cert.generate_certificate(self.cert_dir, "1", "0", 
+            "user", "ema@linux.it", "ema", "Contrail")
+        self.assertEquals("Renewed CA", self.issuer(certs))
+
+class StubManager(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive HTTP server answering every request with its body"""
+
+    protocol_version = "HTTP/1.1"
+    clients = set()
+
+    def reply(self, body):
+        StubManager.clients.add(self.client_address)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(self.path)
+
+    def do_POST(self):
+        self.reply(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def log_message(self, *args):
+        pass
+
+class HTTPConnectionPool(proxy.ConnectionPool):
+
+    def _connect(self, host, port):
+        return httplib.HTTPConnection(host, port)
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        StubManager.clients = set()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubManager)
+        # Clients hanging up early are expected
+        self.server.handle_error = lambda *args: None
+        self.port = self.server.server_address[1]
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_keepalive(self):
+        pool = HTTPConnectionPool(2, 30)
+
+        for _ in range(5):
+            status, body = pool.jsonrpc_post('127.0.0.1', self.port, '/', 
+                'get_service_info', { 'sid': '1' })
+            self.assertEquals(200, status)
+            self.assertEquals('get_service_info', 
+                simplejson.loads(body)['method'])
+
+        status, body = pool.jsonrpc_get('127.0.0.1', self.port, '/', 
+            'get_service_info')
+        self.assert_('method=get_service_info' in body)
+
+        # All the requests went through the same connection
+        self.assertEquals(1, len(StubManager.clients))
+
+    def test_stream(self):
+        pool = HTTPConnectionPool(1, 30)
+        payload = "x" * (3 * proxy.CHUNK_SIZE + 1)
+
+        status, _, body = pool.stream('127.0.0.1', self.port, 'POST', '/', 
+            StringIO.StringIO(payload), length=len(payload))
+        self.assertEquals(200, status)
+
+        chunks = list(body)
+        self.assertEquals(4, len(chunks))
+        self.assertEquals(payload, "".join(chunks))
+
+        # The connection went back to the pool and gets reused
+        status, _, body = pool.stream('127.0.0.1', self.port, 'GET', 
+            pool.jsonrpc_url('/', 'get_service_info'))
+        self.assert_('method=get_service_info' in "".join(body))
+        self.assertEquals(1, len(StubManager.clients))
+
+    def test_stream_interrupted(self):
+        pool = HTTPConnectionPool(1, 30)
+        payload = "x" * (3 * proxy.CHUNK_SIZE)
+
+        _, _, body = pool.stream('127.0.0.1', self.port, 'POST', '/', 
+            StringIO.StringIO(payload), length=len(payload))
+        iter(body).next()
+        body.close()
+
+        # The half-read connection has been dropped, not reused
+        _, _, body = pool.stream('127.0.0.1', self.port, 'POST', '/', 
+            StringIO.StringIO(payload), length=len(payload))
+        self.assertEquals(payload, "".join(body))
+        self.assertEquals(2, len(StubManager.clients))
+
+    def test_idle_eviction(self):
+        pool = HTTPConnectionPool(2, 0)
+
+        pool.jsonrpc_get('127.0.0.1', self.port, '/', 'get_service_info')
+        pool._evicted = 0
+        pool.jsonrpc_get('127.0.0.1', self.port, '/', 'get_service_info')
+
+        self.assertEquals(2, len(StubManager.clients))
+
+class BrokenConnection(object):
+    """Connection failing when sending the request or when reading the
+    response"""
+
+    def __init__(self, attempts, error, on_send=False):
+        self.attempts = attempts
+        self.error = error
+        self.on_send = on_send
+
+    def request(self, method, url, body=None, headers={}):
+        self.attempts.append(method)
+        if self.on_send:
+            raise self.error
+
+    def getresponse(self):
+        raise self.error
+
+    def close(self):
+        pass
+
+class RetryTest(unittest.TestCase):
+
+    def attempts(self, method, error, on_send=False, idle=3):
+        """Return the number of attempts made by a request whose connection
+        fails, with 'idle' connections left in the pool"""
+        attempts = []
+        pool = proxy.ConnectionPool(5, 30)
+        pool._connect = lambda host, port: BrokenConnection(attempts, error,
+            on_send)
+        pool._idle[('manager', 80)] = [ (BrokenConnection(attempts, error,
+            on_send), time.time()) for _ in range(idle) ]
+
+        body = method == 'POST' and '{}' or None
+        self.assertRaises(type(error), pool.request, 'manager', 80, method,
+            '/', body)
+        return len(attempts)
+
+    def test_stale_get(self):
+        # Retried once, however many stale connections are idle
+        self.assertEquals(2, self.attempts('GET', httplib.BadStatusLine('')))
+        self.assertEquals(1, self.attempts('GET',
+            httplib.BadStatusLine(''), idle=0))
+
+    def test_post_not_replayed(self):
+        self.assertEquals(1, self.attempts('POST',
+            httplib.BadStatusLine('')))
+        # Not sent at all: nothing to fear
+        self.assertEquals(2, self.attempts('POST', socket.error(32,
+            'Broken pipe'), on_send=True))
+
+    def test_timeout_not_retried(self):
+        self.assertEquals(1, self.attempts('GET', socket.timeout()))
+
+def issue_cert(cn, issuer=None, issuer_key=None):
+    """Return a PEM encoded (key, certificate) signed by issuer_key, or
+    self-signed"""
+    key = x509cert.gen_rsa_keypair()
+    cert = crypto.X509()
+    cert.get_subject().CN = cn
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(60 * 60)
+    cert.set_issuer((issuer or cert).get_subject())
+    cert.set_pubkey(key)
+    cert.sign(issuer_key or key, "sha256")
+    return key, cert
+
+class TLSConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cert_dir = tempfile.mkdtemp()
+        ca_key, ca_cert = issue_cert("Test CA")
+        self.write("ca_cert.pem", ca_cert)
+        # Managers are not issued certificates for their address
+        self.write("server", *issue_cert("manager", ca_cert, ca_key))
+        self.write("client", *issue_cert("director", ca_cert, ca_key))
+        self.write("other_ca.pem", issue_cert("Other CA")[1])
+
+        StubManager.clients = set()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubManager)
+        self.server.socket = ssl.wrap_socket(self.server.socket,
+            server_side=True, certfile=self.path("server_cert.pem"),
+            keyfile=self.path("server_key.pem"),
+            ca_certs=self.path("ca_cert.pem"), cert_reqs=ssl.CERT_REQUIRED)
+        self.server.handle_error = lambda *args: None
+        self.port = self.server.server_address[1]
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.cert_dir)
+
+    def path(self, name):
+        return os.path.join(self.cert_dir, name)
+
+    def write(self, name, key_or_cert, cert=None):
+        if cert is None:
+            open(self.path(name), "w").write(
+                crypto.dump_certificate(crypto.FILETYPE_PEM, key_or_cert))
+            return
+
+        open(self.path(name + "_key.pem"), "w").write(
+            crypto.dump_privatekey(crypto.FILETYPE_PEM, key_or_cert))
+        open(self.path(name + "_cert.pem"), "w").write(
+            crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+    def pool(self, ca_file):
+        return proxy.ConnectionPool(1, 30,
+            key_file=self.path("client_key.pem"),
+            cert_file=self.path("client_cert.pem"),
+            ca_file=self.path(ca_file), timeout=10)
+
+    def test_trusted_manager(self):
+        status, body = self.pool("ca_cert.pem").jsonrpc_get('127.0.0.1',
+            self.port, '/', 'get_service_info')
+        self.assertEquals(200, status)
+        self.assert_('method=get_service_info' in body)
+
+    def test_untrusted_manager(self):
+        self.assertRaises(ssl.SSLError, self.pool("other_ca.pem").jsonrpc_get,
+            '127.0.0.1', self.port, '/', 'get_service_info')
+        self.assertEquals(0, len(StubManager.clients))
+
+class FakeCloud(object):
+    """Cloud whose VMs get an IP address after 'boot_polls' listings"""
+
+    def __init__(self, boot_polls):
+        self.boot_polls = boot_polls
+        self.listings = 0
+
+    def list_vms(self):
+        self.listings += 1
+        ip = ''
+        if self.listings >= self.boot_polls:
+            ip = '127.0.0.1'
+        return dict((vmid, { 'ip': ip }) for vmid in ('1', '2', '3'))
+
+class VMWatcherTest(unittest.TestCase):
+
+    def test_shared_polling(self):
+        cloud = FakeCloud(3)
+        watcher = vmwatcher.VMWatcher(cloud.list_vms, 0.01, 0.05)
+
+        done = []
+        futures = [ watcher.watch(vmid, 10, done.append) 
+                    for vmid in ('1', '2', '3') ]
+
+        for future in futures:
+            self.assertEquals('127.0.0.1', future.result(10))
+
+        # One listing per round for all the VMs
+        self.assertEquals(3, cloud.listings)
+        self.assertEquals(futures, sorted(done, key=futures.index))
+        self.assertEquals(0, watcher.pending())
+
+    def test_deadline(self):
+        cloud = FakeCloud(1000)
+        watcher = vmwatcher.VMWatcher(cloud.list_vms, 0.01, 0.05)
+
+        future = watcher.watch('1', 0.2)
+        self.assertRaises(Exception, future.result, 10)
+        self.assert_(future.done())
+
+        # Unknown VMs time out as well
+        future = watcher.watch('42', 0.2)
+        self.assertRaises(Exception, future.result, 10)
+
+class ActionsTest(unittest.TestCase):
+
+    def test_shared_watcher(self):
+        shared_cloud = getattr(actions, '__shared_cloud')
+        c, watcher = shared_cloud()
+
+        ip, vmid = actions.start('php', 1)
+        self.assertEquals(c.list_vms()[vmid]['ip'], ip)
+        actions.start('php', 2)
+
+        # Reused by every call, along with its polling thread
+        self.assert_(shared_cloud()[0] is c)
+        self.assert_(shared_cloud()[1] is watcher)
+        self.assertEquals(0, watcher.pending())
+
+        actions.stop(vmid)
+        self.failIf(vmid in c.list_vms())
+
+class HandlePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.broken = set()
+
+    def create(self):
+        handle = len(self.created)
+        self.created.append(handle)
+        return handle
+
+    def check(self, handle):
+        if handle in self.broken:
+            raise Exception("Connection lost")
+
+    def test_reuse(self):
+        pool = cloudpool.HandlePool(self.create, self.check, 2)
+
+        for i in range(10):
+            with pool.handle() as handle:
+                self.assertEquals(0, handle)
+
+        self.assertEquals([ 0 ], self.created)
+
+    def test_bounded(self):
+        pool = cloudpool.HandlePool(self.create, self.check, 2)
+        in_use = []
+        peak = []
+
+        def work():
+            with pool.handle() as handle:
+                in_use.append(handle)
+                peak.append(len(in_use))
+                time.sleep(0.05)
+                in_use.remove(handle)
+
+        threads = [ threading.Thread(target=work) for i in range(6) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(2, max(peak))
+        self.assertEquals([ 0, 1 ], self.created)
+        self.assertEquals({ 'handles': 2, 'idle': 2 }, pool.stats())
+
+    def test_reconnect(self):
+        pool = cloudpool.HandlePool(self.create, self.check, 1)
+
+        # Failures make the handle checked before its next use...
+        def fail():
+            with pool.handle() as handle:
+                self.broken.add(handle)
+                raise Exception("Request failed")
+        self.assertRaises(Exception, fail)
+
+        # ...and replaced if the check fails too
+        with pool.handle() as handle:
+            self.assertEquals(1, handle)
+
+        # Healthy handles are checked only after check_interval seconds
+        pool.check_interval = 0
+        self.broken.add(1)
+        time.sleep(0.01)
+        with pool.handle() as handle:
+            self.assertEquals(2, handle)
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class WarmPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.booted = []
+        self.destroyed = []
+
+    def boot(self):
+        vmid = str(len(self.booted))
+        self.booted.append(vmid)
+        return "127.0.0.%s" % vmid, vmid
+
+    def test_claim_and_refill(self):
+        pool = warmpool.WarmPool(2, 3600, self.boot, self.destroyed.append)
+        self.assertEquals(None, pool.claim())
+
+        self.assert_(wait_for(lambda: pool.stats()['ready'] == 2))
+        self.assertEquals(("127.0.0.0", "0"), pool.claim())
+
+        # Refilled in the background
+        self.assert_(wait_for(lambda: pool.stats()['ready'] == 2))
+        self.assertEquals(3, len(self.booted))
+
+        stats = pool.stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(1, stats['misses'])
+
+    def test_expire(self):
+        pool = warmpool.WarmPool(1, 3600, self.boot, self.destroyed.append, 
+            hourly_cost=2)
+        pool.adopt("127.0.0.9", "9", time.time() - 1800)
+        # Already in the pool
+        pool.adopt("127.0.0.9", "9")
+        self.assertEquals(1, pool.stats()['ready'])
+
+        self.assertEquals(1, pool.stats()['idle_cost'] // 1)
+
+        pool.max_idle = 60
+        pool.expire()
+        self.assertEquals([ "9" ], self.destroyed)
+
+        # Not replaced until somebody needs a manager
+        self.assertEquals(0, pool.stats()['ready'])
+        self.assertEquals([], self.booted)
+
+    def test_unsupported(self):
+        def boot():
+            self.booted.append(None)
+            raise warmpool.Unsupported("no set_service_config")
+
+        pool = warmpool.WarmPool(2, 3600, boot, self.destroyed.append)
+        pool.fill()
+
+        self.assert_(wait_for(lambda: pool.stats()['disabled'] and
+                                      pool.stats()['booting'] == 0))
+        self.assertEquals(2, len(self.booted))
+
+        # Not retried
+        pool.fill()
+        self.assertEquals(None, pool.claim())
+        self.assertEquals(2, len(self.booted))
+
+    def test_disable(self):
+        pool = warmpool.WarmPool(2, 3600, self.boot, self.destroyed.append)
+        pool.adopt("127.0.0.9", "9")
+
+        pool.disable()
+        self.assertEquals([ "9" ], self.destroyed)
+        self.assertEquals(None, pool.claim())
+
+        # Neither refilled nor handing out managers any more
+        pool.adopt("127.0.0.8", "8")
+        self.assertEquals(None, pool.claim())
+        self.assertEquals([], self.booted)
+        self.assertEquals(True, pool.stats()['disabled'])
+
+class ArtifactTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, "0123456789" * 10000)
+        os.close(fd)
+
+        self.artifact = artifacts.Artifact(self.path)
+        self.etag = hashlib.sha256("0123456789" * 10000).hexdigest()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def get(self, headers={}, offload=None):
+        with app.app.test_request_context(headers=headers) as ctx:
+            response = self.artifact.response(ctx.request, offload)
+            return response, "".join(response.response)
+
+    def test_full(self):
+        response, body = self.get()
+        self.assertEquals(200, response.status_code)
+        self.assertEquals("0123456789" * 10000, body)
+        self.assertEquals('"%s"' % self.etag, response.headers['ETag'])
+        self.assertEquals(self.etag, self.artifact.hexdigest())
+
+        response, body = self.get({ 'If-None-Match': '"%s"' % self.etag })
+        self.assertEquals(304, response.status_code)
+
+    def test_range(self):
+        response, body = self.get({ 'Range': 'bytes=5-14' })
+        self.assertEquals(206, response.status_code)
+        self.assertEquals("5678901234", body)
+        self.assertEquals('bytes 5-14/100000', 
+            response.headers['Content-Range'])
+
+        response, body = self.get({ 'Range': 'bytes=-3' })
+        self.assertEquals("789", body)
+
+        # Resuming the download of another version
+        response, body = self.get({ 'Range': 'bytes=5-14', 
+                                    'If-Range': '"outdated"' })
+        self.assertEquals(200, response.status_code)
+
+        response, body = self.get({ 'Range': 'bytes=200000-' })
+        self.assertEquals(416, response.status_code)
+
+    def test_changed(self):
+        self.get()
+        with open(self.path, 'w') as f:
+            f.write("new version")
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+
+        response, body = self.get({ 'If-None-Match': '"%s"' % self.etag })
+        self.assertEquals(200, response.status_code)
+        self.assertEquals("new version", body)
+
+    def test_offload(self):
+        response, body = self.get(offload='x-sendfile')
+        self.assertEquals(self.path, response.headers['X-Sendfile'])
+        self.assertEquals("", body)
+
+        response, body = self.get(offload='x-accel-redirect')
+        self.assertEquals('/internal/' + os.path.basename(self.path), 
+            response.headers['X-Accel-Redirect'])
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', "Test", ('result',))
+        counter.inc(result='ok')
+        counter.inc(2, result='ok')
+        counter.inc(result='failed')
+        self.assertEquals(3, counter.value(result='ok'))
+
+        self.assertEquals('# HELP test_total Test\n'
+                          '# TYPE test_total counter\n'
+                          'test_total{result="failed"} 1\n'
+                          'test_total{result="ok"} 3', counter.render())
+
+    def test_gauge_func(self):
+        gauge = metrics.Gauge('test_jobs', "Test", ('pool',),
+            lambda: { ('provisioning',): 2, ('terminating',): 0 })
+        self.assertTrue('test_jobs{pool="provisioning"} 2' in gauge.render())
+
+        gauge = metrics.Gauge('test_keys', "Test", func=lambda: 5)
+        self.assertTrue('\ntest_keys 5' in gauge.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', "Test", ('span',),
+            (0.1, 1))
+        histogram.observe(0.05, span='a')
+        histogram.observe(0.1, span='a')
+        histogram.observe(5, span='a')
+        self.assertEquals(3, histogram.count(span='a'))
+        self.assertEquals(0, histogram.count(span='b'))
+
+        lines = histogram.render().split('\n')
+        self.assertTrue('test_seconds_bucket{span="a",le="0.1"} 2' in lines)
+        self.assertTrue('test_seconds_bucket{span="a",le="1"} 2' in lines)
+        self.assertTrue('test_seconds_bucket{span="a",le="+Inf"} 3' in lines)
+        self.assertTrue('test_seconds_count{span="a"} 3' in lines)
+
+    def test_timed(self):
+        before = metrics.spans.count(span='test_timed')
+
+        @metrics.timed('test_timed')
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEquals(before + 1, metrics.spans.count(span='test_timed'))
+
+class BenchTest(unittest.TestCase):
+
+    def test_fake_driver(self):
+        driver = bench.FakeDriver(0.2, 0)
+        vmid = driver.new_instances(1)[0]['id']
+        self.assertEquals({ vmid: { 'ip': '' } }, driver.list_vms())
+
+        self.assert_(wait_for(
+            lambda: driver.list_vms()[vmid]['ip'] == '127.0.0.1'))
+
+        class Node: pass
+        node = Node()
+        node.id = vmid
+        driver.kill_instance(node)
+        self.assertEquals({}, driver.list_vms())
+
+        driver.failure_rate = 1
+        self.assertRaises(Exception, driver.new_instances, 1)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(50, bench.percentile(values, 0.5))
+        self.assertEquals(99, bench.percentile(values, 0.99))
+        self.assertEquals(1, bench.percentile([ 1 ], 0.99))
+        self.assertEquals(None, bench.percentile([], 0.5))
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def app(self, environ, start_response):
+        query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        time.sleep(float(query.get('sleep', [ 0 ])[0]))
+        start_response('200 OK', [ ('Content-Type', 'text/plain') ])
+        return [ 'ok' ]
+
+    def get(self, middleware, url, headers={}):
+        with app.app.test_request_context(url, headers=headers) as ctx:
+            status = []
+            body = "".join(middleware(ctx.request.environ,
+                lambda *args: status.append(args)))
+            self.assertEquals('ok', body)
+            return dict(status[0][1])
+
+    def test_disabled(self):
+        config = common.ConfigOverlay(common.config)
+        self.assertEquals(self.app, profiling.wrap(self.app, config))
+
+        config.set('director', 'PROFILER', 'sampling')
+        config.set('director', 'PROFILE_DIR', self.dir)
+        config.set('director', 'PROFILE_ROUTES', '/start:1, /list:0.1')
+        middleware = profiling.wrap(self.app, config)
+        self.assertEquals('sampling', middleware.profiler)
+        self.assertEquals([ ('/start', 1), ('/list', 0.1) ],
+            middleware.routes)
+
+    def test_routes(self):
+        middleware = profiling.ProfilingMiddleware(self.app, self.dir,
+            routes={ '/start': 1, '/start/php': 0 })
+        self.get(middleware, '/list')
+        self.get(middleware, '/start/php')
+        self.assertEquals([], os.listdir(self.dir))
+
+        self.get(middleware, '/start/java')
+        self.assertEquals(1, len(os.listdir(self.dir)))
+
+    def test_rotation(self):
+        middleware = profiling.ProfilingMiddleware(self.app, self.dir,
+            rate=1, keep=2)
+        for delay in (0.05, 0.01, 0.1, 0):
+            self.get(middleware, '/list?sleep=%s' % delay)
+
+        durations = sorted(int(name.split('ms')[0])
+                           for name in os.listdir(self.dir))
+        self.assertEquals(2, len(durations))
+        self.assert_(durations[0] >= 50)
+
+        # Size cap: only the profile just written is left
+        middleware = profiling.ProfilingMiddleware(self.app, self.dir,
+            rate=1, keep=2, max_size=0)
+        self.assertEquals(2, len(middleware._profiles))
+        self.get(middleware, '/list?sleep=0.2')
+        self.assertEquals(1, len(os.listdir(self.dir)))
+        self.assert_(int(os.listdir(self.dir)[0].split('ms')[0]) >= 200)
+
+    def test_on_demand(self):
+        middleware = profiling.ProfilingMiddleware(self.app, self.dir,
+            profiler='sampling', token='secret')
+        self.assert_(profiling.HEADER not in self.get(middleware,
+            '/list?_profile=wrong'))
+
+        headers = self.get(middleware, '/list?sleep=0.05&_profile=secret')
+        stacks = open(os.path.join(self.dir,
+            headers[profiling.HEADER])).read()
+        self.assert_('app (' in stacks)
+
+        headers = self.get(middleware, '/list',
+            { profiling.HEADER: 'secret' })
+        self.assertEquals(2, len(os.listdir(self.dir)))
+
+# Serves the director with gevent on an ephemeral port, printed on stdout
+SERVE_SCRIPT = """
+import sys
+import serve
+serve.app.app.config['SQLALCHEMY_DATABASE_URI'] = sys.argv[1]
+serve.app.db.create_all()
+server = serve.make_server('127.0.0.1', 0)
+server.start()
+print server.server_port
+sys.stdout.flush()
+server.serve_forever()
+"""
+
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        # Monkey-patching must not leak into the tests: use another process
+        self.tmpdir = tempfile.mkdtemp()
+        self.devnull = open(os.devnull, 'w')
+        self.server = subprocess.Popen([ sys.executable, '-c', SERVE_SCRIPT,
+            'sqlite:///' + os.path.join(self.tmpdir, 'director.db') ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=self.devnull)
+
+    def tearDown(self):
+        self.server.kill()
+        self.server.wait()
+        self.devnull.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_list(self):
+        port = int(self.server.stdout.readline())
+        response = urllib2.urlopen('http://127.0.0.1:%d/list' % port,
+            timeout=30)
+
+        self.assertEquals(200, response.getcode())
+        self.assertEquals(False, simplejson.load(response))
+
+class TemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "manager.cfg")
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self, files):
+        self.builds += 1
+        return templates.Template([ 
+            (files[self.filename] or "", ('CONPAAS_SERVICE_ID',)) ])
+
+    def test_render(self):
+        template = templates.Template([ 
+            ("id=%CONPAAS_SERVICE_ID% url=%FRONTEND_URL%", 
+                ('CONPAAS_SERVICE_ID',)),
+            (" %CLOUD%", ('CLOUD',)) ])
+
+        # Only the placeholders listed for each segment are substituted
+        self.assertEquals("id=3 url=%FRONTEND_URL% dummy", 
+            template.render({ 'CONPAAS_SERVICE_ID': '3', 'CLOUD': 'dummy',
+                              'FRONTEND_URL': 'https://localhost' }))
+
+    def test_render_like_replace(self):
+        text = "date +%Y%CONPAAS_SERVICE_ID% %%CLOUD%% 100%"
+        values = { 'CONPAAS_SERVICE_ID': '3', 'CLOUD': 'dummy' }
+
+        # Unlisted %...% tokens do not hide the listed placeholders
+        expected = text
+        for name, value in values.items():
+            expected = expected.replace('%' + name + '%', value)
+        self.assertEquals(expected, templates.Template([
+            (text, ('CONPAAS_SERVICE_ID', 'CLOUD')) ]).render(values))
+
+    def test_reload_on_change(self):
+        cache = templates.TemplateCache()
+        open(self.filename, "w").write("SID = %CONPAAS_SERVICE_ID%")
+
+        for sid in ('1', '2'):
+            template = cache.get('php', [ self.filename ], self.build)
+            self.assertEquals("SID = " + sid, 
+                template.render({ 'CONPAAS_SERVICE_ID': sid }))
+        self.assertEquals(1, self.builds)
+
+        open(self.filename, "w").write("ID = %CONPAAS_SERVICE_ID%")
+        future = time.time() + 10
+        os.utime(self.filename, (future, future))
+
+        # Not checked again before CHECK_INTERVAL seconds
+        template = cache.get('php', [ self.filename ], self.build)
+        self.assertEquals(1, self.builds)
+
+        cache._entries['php'][0] = 0
+        template = cache.get('php', [ self.filename ], self.build)
+        self.assertEquals("ID = 3", 
+            template.render({ 'CONPAAS_SERVICE_ID': '3' }))
+        self.assertEquals(2, self.builds)
+
+class ConfigOverlayTest(unittest.TestCase):
+
+    def test_overlay(self):
+        overlay = common.ConfigOverlay(common.config, 
+            { 'manager': { 'FE_SERVICE_ID': '3' }, 
+              'director': { 'DIRECTOR_URL': 'https://example.org' } })
+
+        self.assertEquals('3', overlay.get('manager', 'FE_SERVICE_ID'))
+        self.assertEquals('https://example.org', 
+            overlay.get('director', 'DIRECTOR_URL'))
+        self.assertEquals(common.config.get('director', 'DATABASE_URI'), 
+            overlay.get('director', 'DATABASE_URI'))
+        self.assert_(('fe_service_id', '3') in overlay.items('manager'))
+
+        # Writes do not reach the underlying config
+        overlay.set('director', 'DATABASE_URI', 'sqlite://')
+        self.assertEquals('sqlite://', overlay.get('director', 'DATABASE_URI'))
+        self.assertNotEquals('sqlite://', 
+            common.config.get('director', 'DATABASE_URI'))
+        self.assertFalse(common.config.has_section('manager'))
+
+    def test_concurrent_service_configs(self):
+        configs = {}
+
+        def get_config(sid):
+            configs[sid] = cloud.get_service_config(str(sid), str(sid * 10))
+
+        threads = [ threading.Thread(target=get_config, args=(sid,)) 
+                    for sid in range(20) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for sid, config in configs.items():
+            self.assertEquals(str(sid), config.get('manager', 'FE_SERVICE_ID'))
+            self.assertEquals(str(sid * 10), 
+                config.get('manager', 'FE_USER_ID'))
+
+        self.assertFalse(common.config.has_section('manager'))
+
+class CreditTest(Common):
+
+    def test_coalesced_decrements(self):
+        user = self.create_user()
+
+        verdicts = app.apply_credit_decrements([ (user.uid, 1, 100), 
+            (user.uid, 1, 30), (user.uid, 2, 20) ])
+        self.assertEquals([ True, False, True ], verdicts)
+
+        user = app.auth_user("ema", "properpass")
+        self.assertEquals(0, user.credit)
+
+        # Only applied decrements are recorded
+        ledger = app.CreditLedger.query.order_by(app.CreditLedger.lid).all()
+        self.assertEquals([ (1, 100), (2, 20) ], 
+            [ (entry.sid, entry.decrement) for entry in ledger ])
+
+    def test_batched_callbacks(self):
+        self.create_user()
+        service = app.Service(name="New php service", type="php", 
+            user=app.auth_user("ema", "properpass"))
+        app.db.session.add(service)
+        app.db.session.commit()
+
+        verdicts = []
+        def callback():
+            response = app.app.test_client().post(
+                '/callback/decrementUserCredit.php', 
+                data={ 'sid': 1, 'decrement': 25 })
+            verdicts.append(simplejson.loads(response.data)['error'])
+
+        app.credit_batcher = billing.CreditBatcher(0.1, 
+            app.apply_credit_decrements)
+        try:
+            threads = [ threading.Thread(target=callback) for _ in range(6) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            app.credit_batcher = None
+
+        # 120 credits are enough for 4 decrements of 25, not for 6
+        self.assertEquals(4, verdicts.count(False))
+        self.assertEquals(2, verdicts.count(True))
+
+        user = app.auth_user("ema", "properpass")
+        self.assertEquals(20, user.credit)
+        self.assertEquals(4, app.CreditLedger.query.count())
+
+    def test_batcher_error(self):
+        def apply(decrements):
+            raise Exception("database is locked")
+        batcher = billing.CreditBatcher(0.01, apply)
+
+        # Each caller gets the error, not a lack of credit
+        self.assertRaises(Exception, batcher.submit, 1, 1, 10)
+
+        self.create_user()
+        app.db.session.add(app.Service(name="s", type="php", user_id=1))
+        app.db.session.commit()
+
+        testing = app.app.testing
+        app.app.testing = False
+        app.credit_batcher = batcher
+        try:
+            response = app.app.test_client().post(
+                '/callback/decrementUserCredit.php',
+                data={ 'sid': 1, 'decrement': 25 })
+            self.assertEquals(500, response.status_code)
+        finally:
+            app.credit_batcher = None
+            app.app.testing = testing
+
+    def test_credit_batch_callback(self):
+        self.create_user()
+        client = app.app.test_client()
+
+        user = app.auth_user("ema", "properpass")
+        for _ in range(2):
+            app.db.session.add(app.Service(name="New php service", 
+                type="php", user=user))
+        app.db.session.commit()
+
+        # Malformed input
+        for decrements in ('garbage', 
+                simplejson.dumps([ { 'sid': 1, 'decrement': 1, 
+                                     'timestamp': 1e20 } ]),
+                simplejson.dumps([ { 'sid': 1, 'decrement': 1, 
+                                     'timestamp': 'yesterday' } ]),
+                simplejson.dumps([ { 'sid': 1, 'decrement': -100 } ]),
+                simplejson.dumps([ { 'sid': 1, 'decrement': 0 } ]),
+                simplejson.dumps([ { 'sid': sid, 'decrement': 1 }
+                    for sid in range(app.MAX_CREDIT_BATCH_SIZE + 1) ])):
+            response = client.post('/callback/decrementUserCreditBatch.php', 
+                data={ 'decrements': decrements })
+            self.assertEquals(200, response.status_code)
+            self.assertEquals({ 'error': True }, 
+                simplejson.loads(response.data))
+
+        decrements = [ 
+            { 'sid': 2, 'decrement': 100, 'timestamp': 1000 },
+            { 'sid': 1, 'decrement': 15, 'timestamp': 900 },
+            { 'sid': 42, 'decrement': 1, 'timestamp': 950 },
+            { 'sid': 1, 'decrement': 10, 'timestamp': 1100 },
+        ]
+        response = client.post('/callback/decrementUserCreditBatch.php', 
+            data={ 'decrements': simplejson.dumps(decrements) })
+        result = simplejson.loads(response.data)
+
+        # Applied in timestamp order: 15, then 100, then 10 is too much
+        self.assertEquals(False, result['error'])
+        self.assertEquals([ (2, False), (1, False), (42, True), (1, True) ], 
+            [ (item['sid'], item['error']) for item in result['results'] ])
+
+        user = app.auth_user("ema", "properpass")
+        self.assertEquals(5, user.credit)
+        self.assertEquals(2, app.CreditLedger.query.count())
+
+class SchemaTest(Common):
+
+    def query_plan(self, query):
+        compiled = query.statement.compile(dialect=app.db.engine.dialect)
+        params = [ compiled.params[name] for name in compiled.positiontup ]
+        return [ list(row)[-1] for row in app.db.engine.execute(
+            "EXPLAIN QUERY PLAN " + str(compiled), params) ]
+
+    def assertIndexed(self, query):
+        for detail in self.query_plan(query):
+            # eg: "SCAN TABLE service" (or "SCAN service" on newer SQLite)
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                self.fail("Full table scan: %s" % detail)
+
+    def test_hot_queries_use_indexes(self):
+        Service, User = app.Service, app.User
+
+        self.assertIndexed(User.query.filter_by(username="ema"))
+        self.assertIndexed(app.db.session.query(Service.sid, Service.name
+            ).filter(Service.user_id == 1, Service.sid > 10
+            ).order_by(Service.sid).limit(10))
+        self.assertIndexed(Service.query.filter_by(state="RUNNING"))
+        self.assertIndexed(Service.query.filter_by(vmid="3"))
+        self.assertIndexed(Service.query.filter_by(manager="10.0.0.1"))
+        self.assertIndexed(app.CreditLedger.query.filter_by(user_id=1
+            ).order_by(app.CreditLedger.created))
+
+        # Make sure the check itself works
+        self.assertRaises(AssertionError, self.assertIndexed, 
+            Service.query.filter_by(name="New php service"))
+
+    def test_sqlite_wal(self):
+        self.assertEquals('wal', 
+            app.db.engine.execute("PRAGMA journal_mode").scalar())
+
+    def test_concurrent_writers(self):
+        user = self.create_user()
+        user.credit = 1000
+        app.db.session.commit()
+        app.db.session.remove()
+
+        errors = []
+
+        def writer(index):
+            try:
+                for i in range(20):
+                    app.db.session.add(app.Service(name="Service %d" % i, 
+                        type='php', user_id=1))
+                    app.db.session.commit()
+
+                    self.assertEquals([ True ], 
+                        app.apply_credit_decrements([ (1, i, 1) ]))
+            except Exception, e:
+                errors.append(e)
+            finally:
+                app.db.session.remove()
+
+        threads = [ threading.Thread(target=writer, args=(index,)) 
+                    for index in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([], errors)
+        self.assertEquals(160, app.Service.query.count())
+        self.assertEquals(1000 - 160, app.User.query.get(1).credit)
+        self.assertEquals(160, app.CreditLedger.query.count())
+
+    def test_migration(self):
+        # Schema of databases created before credit ledger and indexes
+        app.db.drop_all()
+        app.db.engine.execute("DROP TABLE IF EXISTS schema_version")
+        app.db.engine.execute("""CREATE TABLE user (
+            uid INTEGER NOT NULL, username VARCHAR(80) NOT NULL, 
+            fname VARCHAR(256), lname VARCHAR(256), email VARCHAR(256), 
+            affiliation VARCHAR(256), password VARCHAR(256), 
+            created DATETIME, credit INTEGER, 
+            PRIMARY KEY (uid), UNIQUE (username), UNIQUE (email))""")
+        app.db.engine.execute("""CREATE TABLE service (
+            sid INTEGER NOT NULL, name VARCHAR(256), type VARCHAR(32), 
+            state VARCHAR(32), created DATETIME, manager VARCHAR(512), 
+            vmid VARCHAR(256), user_id INTEGER, 
+            PRIMARY KEY (sid), FOREIGN KEY(user_id) REFERENCES user (uid))""")
+        app.db.engine.execute("""INSERT INTO user (uid, username, credit) 
+            VALUES (1, 'ema', 120)""")
+
+        self.assertEquals([ 1, 2, 3, 4 ], migrate.upgrade(app.db.engine))
+        self.assertEquals([], migrate.upgrade(app.db.engine))
+
+        self.assertEquals(0, app.User.query.get(1).services_version)
+
+        # Pooled connections may hold query plans for the old schema
+        app.db.session.remove()
+        app.db.engine.dispose()
+        self.assertIndexed(app.Service.query.filter_by(state="RUNNING"))
+        self.assertIndexed(app.CreditLedger.query.filter_by(user_id=1))
+
+        app.db.engine.execute("DROP TABLE schema_version")
+
 class DirectorTest(Common):
     
     def setUp(self):
@@ -77,6 +1254,10 @@ class DirectorTest(Common):
         response = self.app.post('/stop/1')
         self.assertEquals(200, response.status_code)
 
+    def test_200_on_job(self):
+        response = self.app.get('/job/1')
+        self.assertEquals(200, response.status_code)
+
     def test_200_on_list(self):
         response = self.app.get('/list')
         self.assertEquals(200, response.status_code)
@@ -85,6 +1266,88 @@ class DirectorTest(Common):
         response = self.app.get('/download/ConPaaS.tar.gz')
         self.assertEquals(200, response.status_code)
 
+    def test_download_hash(self):
+        response = self.app.get('/download/ConPaaS.tar.gz.sha256')
+        digest = response.data.split()[0]
+        self.assertEquals(app.conpaas_tarball.hexdigest(), digest)
+
+        response = self.app.get('/download/ConPaaS.tar.gz', 
+            headers={ 'If-None-Match': '"%s"' % digest })
+        self.assertEquals(304, response.status_code)
+
+    def test_metrics_failed_request(self):
+        def fail():
+            raise Exception("Database is gone")
+        list_services = app.app.view_functions['list_services']
+        app.app.view_functions['list_services'] = fail
+
+        # Turned into a 500 response, unless exceptions propagate in testing
+        testing = app.app.testing
+        app.app.testing = False
+        try:
+            self.assertEquals(500, self.app.get('/list').status_code)
+        finally:
+            app.app.view_functions['list_services'] = list_services
+            app.app.testing = testing
+
+        response = self.app.get('/metrics')
+        self.assertTrue('director_request_seconds_count{endpoint="list_services",'
+            'method="GET",status="500"} 1' in response.data)
+
+    def test_metrics(self):
+        self.create_user()
+        self.app.get('/list', data={ 'username': "ema",
+                                     'password': "properpass" })
+
+        response = self.app.get('/metrics')
+        self.assertEquals(200, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertTrue('director_request_seconds_count{endpoint="list_services",'
+            'method="GET",status="200"}' in response.data)
+        self.assertTrue('director_span_seconds_count{span="auth"}' in 
+            response.data)
+        self.assertTrue('director_span_seconds_count{span="db_commit"}' in 
+            response.data)
+        self.assertTrue('director_jobs{pool="provisioning",state="queued"} 0'
+            in response.data)
+
+    def test_health_sweep(self):
+        self.create_user()
+        for manager, state in (('127.0.0.1', 'RUNNING'),
+                               ('127.0.0.2', 'RUNNING'),
+                               (None, 'PROVISIONING')):
+            app.db.session.add(app.Service(name="s", type="php",
+                state=state, manager=manager, user_id=1))
+        app.db.session.commit()
+
+        server = bench.start_server(bench.StubManager)
+        connections = app.health_connections
+        # Nothing listens on 127.0.0.2
+        app.health_connections = bench.StubConnectionPool(
+            server.server_port, 1, 30, timeout=5)
+        try:
+            data = urllib.urlencode({ 'username': "ema",
+                                      'password': "properpass" })
+            etag = self.app.get('/list?' + data).headers['ETag']
+
+            self.assertEquals(2, app.health_sweep())
+            self.assertEquals(0, app.health_sweep())
+        finally:
+            app.health_connections = connections
+            server.shutdown()
+
+        self.assertNotEquals(etag,
+            self.app.get('/list?' + data).headers['ETag'])
+
+        status = simplejson.loads(self.app.get('/status?' + data).data)
+        self.assert_(status['checked'])
+        self.assertEquals([ 'RUNNING', 'UNREACHABLE', None ],
+            [ s['manager_state'] for s in status['services'] ])
+
+        response = self.app.get('/list?manager_state=UNREACHABLE&' + data)
+        self.assertEquals([ 2 ], [ s['sid'] for s in
+            simplejson.loads(response.data) ])
+
     def test_200_on_credit(self):
         response = self.app.post('/callback/decrementUserCredit.php')
         self.assertEquals(200, response.status_code)
@@ -109,10 +1372,32 @@ class DirectorTest(Common):
         self.assertEquals('php', servicedict['type'])
         self.assertEquals(1, servicedict['user_id'])
 
+        # The manager is started in the background
+        job_url = '/job/1?wait=30&' + urllib.urlencode(data)
+        response = self.app.get(job_url)
+        servicedict = simplejson.loads(response.data)
+        self.assertEquals('RUNNING', servicedict['state'])
+
         # Values returned by libcloud's dummy driver
         self.assertEquals('3', servicedict['vmid'])
         self.assertEquals('127.0.0.3', servicedict['manager'])
 
+    def test_false_job(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        # No service with id 1
+        response = self.app.get('/job/1?' + urllib.urlencode(data))
+        self.assertEquals(False, simplejson.loads(response.data))
+
+        response = self.app.post('/start/php', data=data)
+        self.assertEquals(1, simplejson.loads(response.data)['sid'])
+
+        # Wrong credentials
+        data = { 'username': "ema", 'password': "wrongpass" }
+        response = self.app.get('/job/1?' + urllib.urlencode(data))
+        self.assertEquals(False, simplejson.loads(response.data))
+
     def test_false_stop(self):
         data = { 'username': "wronguser", 'password': "properpass" }
 
@@ -132,10 +1417,392 @@ class DirectorTest(Common):
         servicedict = simplejson.loads(response.data)
         self.assertEquals(1, servicedict['sid'])
 
+        # Wait for the manager to be running and look up its address
+        self.app.get('/job/1?wait=30&' + urllib.urlencode(data))
+        self.assertEquals('127.0.0.3', app.manager_address(1))
+
         # Now /stop/1 should return True
         response = self.app.post('/stop/1', data=data)
         self.assertEquals(True, simplejson.loads(response.data))
 
+        # The cached manager address is gone as well
+        self.assertEquals(None, app.manager_address(1))
+
+        # The service is deleted once its VM has been terminated
+        response = self.app.get('/job/1?wait=30&' + urllib.urlencode(data))
+        self.assertEquals(False, simplejson.loads(response.data))
+        self.failIf('3' in cloud.list_vms())
+
+    def test_stop_twice(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        self.app.post('/start/php', data=data)
+        self.app.get('/job/1?wait=30&' + urllib.urlencode(data))
+
+        # Hold the termination until both requests have been served
+        release = threading.Event()
+        stop_batch = cloud.stop_batch
+        calls = []
+        def slow_stop_batch(*args):
+            calls.append(args[0])
+            release.wait(30)
+            return stop_batch(*args)
+        cloud.stop_batch = slow_stop_batch
+
+        try:
+            for i in range(2):
+                response = self.app.post('/stop/1', data=data)
+                self.assertEquals(True, simplejson.loads(response.data))
+        finally:
+            release.set()
+
+        response = self.app.get('/job/1?wait=30&' + urllib.urlencode(data))
+        cloud.stop_batch = stop_batch
+        self.assertEquals(False, simplejson.loads(response.data))
+        self.assertEquals([ [ '3' ] ], calls)
+
+        # Already gone
+        response = self.app.post('/stop/1', data=data)
+        self.assertEquals(False, simplejson.loads(response.data))
+
+    def test_stop_while_provisioning(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        # Keep the provisioning worker busy until the service is stopped
+        started = threading.Event()
+        release = threading.Event()
+        def busy():
+            started.set()
+            release.wait(30)
+        start_batch = cloud.start_batch
+        def slow_start_batch(*args):
+            busy()
+            return start_batch(*args)
+        cloud.start_batch = slow_start_batch
+
+        try:
+            self.app.post('/start/php', data=data)
+            started.wait(30)
+
+            response = self.app.post('/stop/1', data=data)
+            self.assertEquals(True, simplejson.loads(response.data))
+            self.assertEquals('STOPPING', app.Service.query.get(1).state)
+        finally:
+            release.set()
+            cloud.start_batch = start_batch
+
+        # The provisioning job tears the manager down once it is up
+        response = self.app.get('/job/1?wait=30&' + urllib.urlencode(data))
+        self.assertEquals(False, simplejson.loads(response.data))
+        self.failIf('3' in cloud.list_vms())
+
+    def test_start_from_warm_pool(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        configured = []
+        configure_manager = app.configure_manager
+        app.configure_manager = lambda *args: configured.append(args)
+        manager_capabilities = app.manager_capabilities
+        app.manager_capabilities = lambda address: [ 'set_service_config' ]
+
+        pool = warmpool.WarmPool(1, 3600, 
+            lambda: app.boot_warm_manager('php'), app.destroy_warm_manager)
+        app.warm_pools = { 'php': pool }
+
+        try:
+            pool.fill()
+            self.assert_(wait_for(lambda: pool.stats()['ready'] == 1))
+            warm = app.Service.query.filter_by(state='WARM').one().to_dict()
+
+            self.app.post('/start/php', data=data)
+            response = self.app.get('/job/2?wait=30&' + urllib.urlencode(data))
+            servicedict = simplejson.loads(response.data)
+
+            self.assertEquals('RUNNING', servicedict['state'])
+            self.assertEquals(warm['vmid'], servicedict['vmid'])
+            self.assertEquals([ (warm['manager'], 2, 1) ], configured)
+
+            # Another manager is booted for the next one
+            self.assert_(wait_for(lambda: pool.stats()['ready'] == 1))
+            self.assertNotEquals(warm['vmid'], 
+                app.Service.query.filter_by(state='WARM').one().vmid)
+        finally:
+            app.configure_manager = configure_manager
+            app.manager_capabilities = manager_capabilities
+            app.warm_pools = {}
+
+    def test_warm_pool_unsupported(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        # Stock managers do not list set_service_config
+        manager_capabilities = app.manager_capabilities
+        app.manager_capabilities = lambda address: []
+        vms = len(cloud.list_vms())
+
+        pool = warmpool.WarmPool(2, 3600,
+            lambda: app.boot_warm_manager('php'), app.destroy_warm_manager)
+        app.warm_pools = { 'php': pool }
+
+        try:
+            pool.fill()
+            self.assert_(wait_for(lambda: pool.stats()['booting'] == 0))
+            self.assertEquals(True, pool.stats()['disabled'])
+            self.assertEquals(0, pool.stats()['ready'])
+            self.assertEquals(0,
+                app.Service.query.filter_by(state='WARM').count())
+            self.assertEquals(vms, len(cloud.list_vms()))
+
+            # Services are started cold
+            self.app.post('/start/php', data=data)
+            response = self.app.get('/job/1?wait=30&' + urllib.urlencode(data))
+            self.assertEquals('RUNNING',
+                simplejson.loads(response.data)['state'])
+        finally:
+            app.manager_capabilities = manager_capabilities
+            app.warm_pools = {}
+
+    def test_destroy_warm_manager_session(self):
+        user = self.create_user()
+        app.db.session.add(app.Service(name="Warm php manager", type="php",
+            state='WARM', manager="127.0.0.3", vmid="3"))
+        service = app.Service(name="New php service", type="php", user=user)
+        app.db.session.add(service)
+        app.db.session.commit()
+
+        app.destroy_warm_manager("3")
+
+        # The session of the caller (eg: a provisioning job) is left alone
+        self.assert_(service in app.db.session)
+        self.assertEquals(0,
+            app.Service.query.filter_by(state='WARM').count())
+
+    def test_warm_pool_configure_failure(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        configured = []
+        def configure_manager(*args):
+            configured.append(args)
+            raise Exception("Connection refused")
+        saved_configure_manager = app.configure_manager
+        app.configure_manager = configure_manager
+        manager_capabilities = app.manager_capabilities
+        app.manager_capabilities = lambda address: [ 'set_service_config' ]
+
+        pool = warmpool.WarmPool(2, 3600,
+            lambda: app.boot_warm_manager('php'), app.destroy_warm_manager)
+        app.warm_pools = { 'php': pool }
+
+        cold = []
+        start_batch = cloud.start_batch
+        def cold_start_batch(servicetype, sids, uid):
+            cold.extend(sids)
+            return start_batch(servicetype, sids, uid)
+
+        try:
+            pool.fill()
+            self.assert_(wait_for(lambda: pool.stats()['ready'] == 2))
+            cloud.start_batch = cold_start_batch
+
+            self.app.post('/start/php', data=data)
+            response = self.app.get('/job/3?wait=30&' + urllib.urlencode(data))
+            servicedict = simplejson.loads(response.data)
+
+            # One failure disables the pool: the service is started cold
+            self.assertEquals(1, len(configured))
+            self.assertEquals([ 3 ], [ sid for sid in cold if sid ])
+            self.assertEquals('RUNNING', servicedict['state'])
+
+            # The warm managers are gone, including any refill booting
+            # when the pool got disabled
+            self.assertEquals(True, pool.stats()['disabled'])
+            self.assert_(wait_for(lambda: pool.stats()['booting'] == 0))
+            self.assertEquals(0, pool.stats()['ready'])
+            self.assertEquals(0,
+                app.Service.query.filter_by(state='WARM').count())
+        finally:
+            app.configure_manager = saved_configure_manager
+            app.manager_capabilities = manager_capabilities
+            cloud.start_batch = start_batch
+            app.warm_pools = {}
+
+    def test_reconcile(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        data['services'] = simplejson.dumps([
+            { 'servicetype': 'php', 'count': 3 } ])
+        self.app.post('/start_batch', data=data)
+        for sid in (1, 2, 3):
+            self.app.get('/job/%d?wait=30&' % sid + urllib.urlencode(data))
+
+        # Stop requests interrupted (eg: by a restart of the director)...
+        services = app.Service.query.all()
+        vmids = [ s.vmid for s in services ]
+        for s in services:
+            s.state = 'STOPPING'
+        app.db.session.commit()
+
+        # ...after one of the VMs had been terminated already
+        cloud.stop(vmids[0])
+
+        app.reconcile()
+        self.assertEquals(None, app.Service.query.get(1))
+
+        # The others are terminated in the background
+        for sid in (2, 3):
+            self.app.get('/job/%d?wait=30&' % sid + urllib.urlencode(data))
+
+        self.assertEquals(0, app.Service.query.count())
+        for vmid in vmids:
+            self.failIf(vmid in cloud.list_vms())
+
+    def test_getcerts(self):
+        user = self.create_user()
+        certs_url = '/getcerts?username=ema&password=properpass'
+
+        response = self.app.get(certs_url)
+        archive = zipfile.ZipFile(StringIO.StringIO(response.data))
+        self.assertEquals([ 'ca_cert.pem', 'cert.pem', 'key.pem' ], 
+            sorted(archive.namelist()))
+
+        # Handed out again...
+        self.assertEquals(response.data, self.app.get(certs_url).data)
+
+        # ...unless new ones are requested
+        renewed = self.app.get(certs_url + '&renew=1').data
+        self.assertNotEquals(response.data, renewed)
+        self.assertEquals(renewed, self.app.get(certs_url).data)
+
+        # Changing password revokes them
+        app.set_password(app.User.query.get(1), "newpass")
+        certs_url = '/getcerts?username=ema&password=newpass'
+        self.assertNotEquals(renewed, self.app.get(certs_url).data)
+
+    def test_cached_credentials(self):
+        self.create_user()
+        data = urllib.urlencode({ 'username': "ema",
+                                  'password': "properpass" })
+        app.db.session.add(app.Service(name="s", type="php", user_id=1))
+        app.db.session.commit()
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        sqlalchemy.event.listen(app.db.engine, 'before_cursor_execute',
+            record)
+        try:
+            self.assertEquals(1, simplejson.loads(
+                self.app.get('/job/1?' + data).data)['sid'])
+            self.assert_([ st for st in statements if 'FROM user' in st ])
+
+            # Recently verified credentials do not touch the user table
+            del statements[:]
+            self.assertEquals(1, simplejson.loads(
+                self.app.get('/job/1?' + data).data)['sid'])
+            self.assertEquals([],
+                [ st for st in statements if 'FROM user' in st ])
+        finally:
+            sqlalchemy.event.remove(app.db.engine, 'before_cursor_execute',
+                record)
+
+    def test_start_batch(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        data['services'] = simplejson.dumps([
+            { 'servicetype': 'php', 'count': 2 },
+            { 'servicetype': 'unknown', 'count': 1 },
+        ])
+        response = self.app.post('/start_batch', data=data)
+        result = simplejson.loads(response.data)
+
+        self.assertEquals(2, len(result))
+        self.assertEquals(False, result[0]['error'])
+        self.assertEquals([ 1, 2 ], 
+            [ ser['sid'] for ser in result[0]['services'] ])
+        self.assertEquals(True, result[1]['error'])
+
+        for sid in (1, 2):
+            job_url = '/job/%d?wait=30&username=ema&password=properpass' % sid
+            servicedict = simplejson.loads(self.app.get(job_url).data)
+            self.assertEquals('RUNNING', servicedict['state'])
+
+    def test_start_batch_invalid_count(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        for count in (-5, 0, "many", None, 1):
+            data['services'] = simplejson.dumps([
+                { 'servicetype': 'php', 'count': app.MAX_BATCH_SIZE },
+                { 'servicetype': 'php', 'count': count } ])
+            response = self.app.post('/start_batch', data=data)
+            self.assertEquals(200, response.status_code)
+            self.assertEquals(False, simplejson.loads(response.data))
+
+        self.assertEquals(0, app.Service.query.count())
+
+        # Parsed as /start does
+        data['services'] = simplejson.dumps([
+            { 'servicetype': 'php', 'count': "2" } ])
+        result = simplejson.loads(self.app.post('/start_batch',
+            data=data).data)
+        self.assertEquals(2, len(result[0]['services']))
+        for sid in (1, 2):
+            self.app.get('/job/%d?wait=30&' % sid + urllib.urlencode(data))
+
+    def test_stop_batch(self):
+        self.create_user()
+        data = { 'username': "ema", 'password': "properpass" }
+
+        data['services'] = simplejson.dumps([
+            { 'servicetype': 'php', 'count': 2 } ])
+        response = self.app.post('/start_batch', data=data)
+        self.assertEquals(False, simplejson.loads(response.data)[0]['error'])
+
+        del data['services']
+        data['sids'] = simplejson.dumps([ 1, 2, 3 ])
+        response = self.app.post('/stop_batch', data=data)
+        self.assertEquals({ '1': True, '2': True, '3': False }, 
+            simplejson.loads(response.data))
+
+        # Both are deleted once their managers are up and terminated
+        for sid in (1, 2):
+            response = self.app.get('/job/%d?wait=30&' % sid + 
+                urllib.urlencode(data))
+            self.assertEquals(False, simplejson.loads(response.data))
+
+    def test_stop_batch_failed(self):
+        self.create_user()
+        for i in range(20):
+            app.db.session.add(app.Service(name="s", type="php", 
+                state='FAILED', user_id=1))
+        app.db.session.commit()
+
+        # The termination job deletes them before /stop_batch returns
+        submit_batch = app.terminating.submit_batch
+        def submit_batch_and_wait(keys, func, *args):
+            submit_batch(keys, func, *args)
+            for key in keys:
+                app.terminating.wait(key, 30)
+        app.terminating.submit_batch = submit_batch_and_wait
+
+        data = { 'username': "ema", 'password': "properpass", 
+                 'sids': simplejson.dumps(range(1, 21)) }
+        try:
+            response = self.app.post('/stop_batch', data=data)
+        finally:
+            app.terminating.submit_batch = submit_batch
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(dict((str(sid), True) for sid in range(1, 21)), 
+            simplejson.loads(response.data))
+        self.assertEquals(0, app.Service.query.count())
+
     def test_list(self):
         self.create_user()
 
@@ -157,6 +1824,99 @@ class DirectorTest(Common):
         self.assertEquals(1, len(result))
         self.assertEquals('New php service', result[0]['name'])
 
+    def add_services(self, user, types):
+        for servicetype in types:
+            app.db.session.add(app.Service(name="New %s service" % 
+                servicetype, type=servicetype, user=user))
+        app.db.session.commit()
+
+    def test_list_pagination(self):
+        self.add_services(self.create_user(), [ 'php', 'java', 'php' ])
+
+        data = { 'username': "ema", 'password': "properpass", 'limit': 2 }
+        response = self.app.get('/list?' + urllib.urlencode(data))
+        result = simplejson.loads(response.data)
+        self.assertEquals([ 1, 2 ], [ service['sid'] for service in result ])
+        self.assertEquals('2', response.headers['X-Next-Cursor'])
+
+        data['cursor'] = 2
+        response = self.app.get('/list?' + urllib.urlencode(data))
+        result = simplejson.loads(response.data)
+        self.assertEquals([ 3 ], [ service['sid'] for service in result ])
+        self.failIf('X-Next-Cursor' in response.headers)
+
+        # Wrong parameters
+        data['limit'] = 0
+        response = self.app.get('/list?' + urllib.urlencode(data))
+        self.assertEquals(False, simplejson.loads(response.data))
+
+    def test_list_filters(self):
+        self.add_services(self.create_user(), [ 'php', 'java', 'php' ])
+        app.Service.query.get(3).state = "RUNNING"
+        app.db.session.commit()
+
+        data = { 'username': "ema", 'password': "properpass", 
+                 'type': 'php', 'fields': 'sid,state' }
+        response = self.app.get('/list?' + urllib.urlencode(data))
+        self.assertEquals([ { 'sid': 1, 'state': 'INIT' }, 
+                            { 'sid': 3, 'state': 'RUNNING' } ], 
+            simplejson.loads(response.data))
+
+        data['state'] = 'INIT,STOPPED'
+        response = self.app.get('/list?' + urllib.urlencode(data))
+        self.assertEquals([ { 'sid': 1, 'state': 'INIT' } ], 
+            simplejson.loads(response.data))
+
+        data['fields'] = 'sid,password'
+        response = self.app.get('/list?' + urllib.urlencode(data))
+        self.assertEquals(False, simplejson.loads(response.data))
+
+    def test_list_etag(self):
+        self.add_services(self.create_user(), [ 'php' ])
+
+        list_url = '/list?' + urllib.urlencode({ 'username': "ema", 
+            'password': "properpass" })
+        response = self.app.get(list_url)
+        etag = response.headers['ETag']
+
+        # Unchanged
+        response = self.app.get(list_url, headers={ 'If-None-Match': etag })
+        self.assertEquals(304, response.status_code)
+
+        # Any change to the user's services invalidates the ETag
+        app.Service.query.get(1).state = "RUNNING"
+        app.db.session.commit()
+
+        response = self.app.get(list_url, headers={ 'If-None-Match': etag })
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('RUNNING', 
+            simplejson.loads(response.data)[0]['state'])
+        self.assertNotEquals(etag, response.headers['ETag'])
+
+    def test_stop_batch_retries(self):
+        # The VM survives the first attempt only
+        attempts = []
+        kill = getattr(cloud, '__kill')
+        def flaky_kill(vmid):
+            attempts.append(vmid)
+            if len(attempts) == 1:
+                raise Exception("Temporary failure")
+            kill(vmid)
+        setattr(cloud, '__kill', flaky_kill)
+
+        try:
+            vmid = cloud.start('php', 1, 1)[1]
+
+            self.assertEquals({ vmid: True }, 
+                cloud.stop_batch([ vmid ], retries=2, backoff=0))
+            self.assertEquals([ vmid, vmid ], attempts)
+
+            # VMs already gone count as terminated, whatever the cloud says
+            setattr(cloud, '__kill', lambda vmid: flaky_kill(None))
+            self.assertEquals({ vmid: True }, cloud.stop_batch([ vmid ]))
+        finally:
+            setattr(cloud, '__kill', kill)
+
     def test_credit(self):
         self.create_user()
         data = { 'username': "ema", 'password': "properpass" }
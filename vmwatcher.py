@@ -0,0 +1,178 @@
+"""
+Shared watcher for VMs waiting to get an IP address.
+
+Rather than having every pending start poll the whole cloud inventory once
+per second, a single thread per cloud calls list_vms() on behalf of all the
+waiters. The polling interval starts at MIN_INTERVAL seconds and doubles (up
+to MAX_INTERVAL) as long as no VM becomes ready. It goes back to
+MIN_INTERVAL when a new VM is watched or a VM becomes ready.
+"""
+
+import time
+import threading
+import traceback
+
+MIN_INTERVAL = 1
+MAX_INTERVAL = 30
+
+class VMFuture(object):
+    """Pending result of VMWatcher.watch()"""
+
+    def __init__(self, vmid, deadline, callback=None):
+        self.vmid = vmid
+        self.deadline = deadline
+        self.ip = None
+        self.error = None
+
+        self._callback = callback
+        self._event = threading.Event()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the VM to be ready and return its IP address. Raise an
+        exception if it did not get one before its deadline."""
+        if not self._event.wait(timeout):
+            raise Exception("Timeout waiting for VM %s" % self.vmid)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.ip
+
+    def _set(self, ip=None, error=None):
+        self.ip = ip
+        self.error = error
+        self._event.set()
+
+        if self._callback is not None:
+            try:
+                self._callback(self)
+            except Exception:
+                traceback.print_exc()
+
+class VMWatcher(object):
+
+    def __init__(self, list_vms, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL):
+        """list_vms() must return the cloud inventory as a dictionary
+        mapping VM ids to dictionaries with an 'ip' key, as the list_vms()
+        method of ConPaaS clouds does."""
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self._list_vms = list_vms
+        self._waiters = {}
+        self._interval = min_interval
+        self._next_poll = float('inf')
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def watch(self, vmid, timeout, callback=None):
+        """Start watching 'vmid'. Return a VMFuture, completed once the VM
+        has an IP address or 'timeout' seconds have passed. If given,
+        callback(future) is called from the watcher thread at that time."""
+        future = VMFuture(vmid, time.time() + timeout, callback)
+
+        with self._cond:
+            self._waiters.setdefault(vmid, []).append(future)
+            self._interval = self.min_interval
+            self._next_poll = min(self._next_poll,
+                time.time() + self.min_interval)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name="vmwatcher")
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                self._cond.notify()
+
+        return future
+
+    def pending(self):
+        with self._cond:
+            return sum(len(futures) for futures in self._waiters.values())
+
+    def _poll(self):
+        """List the VMs once and complete the futures of those which are
+        ready. Return True if any was."""
+        try:
+            vms = self._list_vms()
+        except Exception:
+            traceback.print_exc()
+            vms = {}
+
+        now = time.time()
+        completed = []
+
+        with self._cond:
+            for vmid, futures in self._waiters.items():
+                ip = vmid in vms and vms[vmid]['ip']
+
+                for future in futures[:]:
+                    if ip:
+                        completed.append((future, ip, None))
+                    elif future.deadline < now:
+                        completed.append((future, None, Exception(
+                            "VM %s did not get an IP address in time" % vmid)))
+                    else:
+                        continue
+
+                    futures.remove(future)
+
+                if not futures:
+                    del self._waiters[vmid]
+
+        # Callbacks are run without holding the lock
+        for future, ip, error in completed:
+            future._set(ip, error)
+
+        return any(ip for _, ip, _ in completed)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._waiters:
+                        self._thread = None
+                        self._next_poll = float('inf')
+                        return
+
+                    # Do not sleep past the earliest deadline either
+                    wakeup = min([ self._next_poll ] + [ future.deadline 
+                        for futures in self._waiters.values() 
+                        for future in futures ])
+
+                    now = time.time()
+                    if wakeup <= now:
+                        # Set again by watch() if needed while polling
+                        self._next_poll = float('inf')
+                        break
+
+                    self._cond.wait(wakeup - now)
+
+            ready = self._poll()
+
+            with self._cond:
+                if ready:
+                    self._interval = self.min_interval
+                else:
+                    self._interval = min(self._interval * 2, 
+                        self.max_interval)
+
+                self._next_poll = min(self._next_poll, 
+                    time.time() + self._interval)
+
+__watchers = {}
+__watchers_lock = threading.Lock()
+
+def get_watcher(key, list_vms):
+    """Return the VMWatcher shared by everybody using the cloud identified by
+    'key' (eg: the IaaS driver name), creating it with list_vms if needed."""
+    with __watchers_lock:
+        if key not in __watchers:
+            __watchers[key] = VMWatcher(list_vms)
+
+        return __watchers[key]
@@ -0,0 +1,161 @@
+"""
+Warm pool of pre-booted manager VMs.
+
+Booting a manager VM takes minutes. A WarmPool keeps up to 'size' managers
+of a given service type booted in advance, without any service assigned:
+starting a service then only takes claiming one of them and pushing the
+service configuration to it. The pool is refilled in the background after
+each claim. Managers nobody claimed within 'max_idle' seconds are terminated
+and not replaced until the next claim, so that an unused pool drains
+instead of costing money forever. A disabled pool terminates its managers
+and neither boots nor hands out any more of them. A pool disables itself
+when boot() raises Unsupported.
+"""
+
+import time
+import threading
+import traceback
+
+import jobs
+
+class Unsupported(Exception):
+    """Raised by boot() when the managers it starts cannot be claimed"""
+
+class WarmPool(object):
+
+    def __init__(self, size, max_idle, boot, destroy, hourly_cost=0,
+                 name="warmpool"):
+        """boot() must start a manager and return an (ip, vmid) tuple once
+        it is running. destroy(vmid) must terminate it."""
+        self.name = name
+        self.size = size
+        self.max_idle = max_idle
+        self.hourly_cost = hourly_cost
+
+        self._boot = boot
+        self._destroy = destroy
+        # [ (ip, vmid, ready since), ... ], oldest first
+        self._ready = []
+        self._booting = 0
+        self._workers = jobs.WorkerPool(size, name)
+        self._lock = threading.Lock()
+
+        self.disabled = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        # VM-seconds spent by claimed or expired managers waiting in the pool
+        self._idle_seconds = 0
+
+    def adopt(self, ip, vmid, since=None):
+        """Add a manager booted earlier (eg: before a restart) to the pool,
+        unless it is already there"""
+        with self._lock:
+            if vmid in [ entry[1] for entry in self._ready ]:
+                return
+            self._ready.append((ip, vmid, since or time.time()))
+            self._ready.sort(key=lambda entry: entry[2])
+
+    def fill(self):
+        """Boot managers in the background until 'size' of them are ready or
+        booting"""
+        with self._lock:
+            if self.disabled:
+                return
+            missing = self.size - len(self._ready) - self._booting
+            self._booting += max(missing, 0)
+
+        for i in range(missing):
+            self._workers.submit(object(), self._boot_one)
+
+    def _boot_one(self):
+        try:
+            ip, vmid = self._boot()
+        except Exception, err:
+            if isinstance(err, Unsupported):
+                print "Disabling %s: %s" % (self.name, err)
+                self.disable()
+            else:
+                traceback.print_exc()
+            with self._lock:
+                self._booting -= 1
+            return
+
+        with self._lock:
+            self._booting -= 1
+            if not self.disabled:
+                self._ready.append((ip, vmid, time.time()))
+                return
+
+        # Disabled while booting
+        self._terminate([ vmid ])
+
+    def claim(self):
+        """Return the (ip, vmid) tuple of a ready manager, removed from the
+        pool, or None if there is none. The pool is refilled in the
+        background."""
+        self.expire()
+
+        with self._lock:
+            if self._ready and not self.disabled:
+                ip, vmid, since = self._ready.pop(0)
+                self._idle_seconds += time.time() - since
+                self.hits += 1
+                claimed = ip, vmid
+            else:
+                self.misses += 1
+                claimed = None
+
+        self.fill()
+        return claimed
+
+    def expire(self):
+        """Terminate the managers which have been waiting for more than
+        max_idle seconds"""
+        now = time.time()
+
+        with self._lock:
+            expired = [ entry for entry in self._ready
+                        if now - entry[2] > self.max_idle ]
+            for entry in expired:
+                self._ready.remove(entry)
+                self._idle_seconds += now - entry[2]
+                self.expired += 1
+
+        self._terminate([ vmid for _, vmid, _ in expired ])
+
+    def disable(self):
+        """Terminate the ready managers and stop booting new ones. claim()
+        returns None from now on."""
+        now = time.time()
+
+        with self._lock:
+            self.disabled = True
+            drained, self._ready = self._ready, []
+            for entry in drained:
+                self._idle_seconds += now - entry[2]
+
+        self._terminate([ vmid for _, vmid, _ in drained ])
+
+    def _terminate(self, vmids):
+        for vmid in vmids:
+            try:
+                self._destroy(vmid)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        """Return a dictionary describing the state of the pool. idle_cost
+        is what the time spent by managers waiting in the pool, including
+        the ready ones, costs at hourly_cost per VM-hour."""
+        now = time.time()
+
+        with self._lock:
+            idle_hours = (self._idle_seconds + sum(now - since
+                for _, _, since in self._ready)) / 3600.0
+
+            return { 'ready': len(self._ready), 'booting': self._booting,
+                     'disabled': self.disabled,
+                     'hits': self.hits, 'misses': self.misses,
+                     'expired': self.expired, 'idle_hours': idle_hours,
+                     'idle_cost': idle_hours * self.hourly_cost }
@@ -1,18 +1,90 @@
 import os
+import time
 import random
+import threading
+from collections import deque
 
 from OpenSSL import crypto
 
 import common
+import metrics
 common.extend_path()
 
 from conpaas.core.misc import file_get_contents
 
+# Seconds between checks for changes of the CA certificate and key files
+CA_CHECK_INTERVAL = 5
+
+@metrics.timed('rsa_keygen')
 def gen_rsa_keypair():
     pkey = crypto.PKey()
     pkey.generate_key(crypto.TYPE_RSA, 2048)
     return pkey
-    
+
+class KeyPool(object):
+    """Pool of pre-generated RSA keypairs.
+
+    A background thread refills the pool up to 'high' keypairs whenever it
+    drops below 'low'. Keys are generated inline only if the pool is empty.
+    """
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.hits = 0
+        self.misses = 0
+
+        self._keys = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._thread = None
+
+    def _fill(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+
+            while len(self._keys) < self.high:
+                self._keys.append(gen_rsa_keypair())
+
+    def get(self):
+        """Return a RSA keypair, from the pool if possible"""
+        key = None
+
+        with self._lock:
+            if self._thread is None and self.high > 0:
+                # Started on first use, not at import time
+                self._thread = threading.Thread(target=self._fill,
+                    name="keypool")
+                self._thread.daemon = True
+                self._thread.start()
+
+            if self._keys:
+                key = self._keys.popleft()
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if len(self._keys) < self.low or not self._keys:
+            self._refill.set()
+
+        if key is None:
+            key = gen_rsa_keypair()
+
+        return key
+
+    def stats(self):
+        return { 'size': len(self._keys), 'low': self.low, 'high': self.high,
+                 'hits': self.hits, 'misses': self.misses }
+
+def __keypool_option(name, default):
+    if common.config.has_option('director', name):
+        return common.config.getint('director', name)
+    return default
+
+keypool = KeyPool(__keypool_option('KEYPOOL_LOW', 2),
+                  __keypool_option('KEYPOOL_HIGH', 8))
+
 def create_x509_req(req_key, uid, sid, org, email, cn, role):
     req = crypto.X509Req()
     subj = req.get_subject()
@@ -28,35 +100,91 @@ def create_x509_req(req_key, uid, sid, org, email, cn, role):
     req.sign(req_key, "md5")
     return req
 
+class CertificateAuthority(object):
+    """The CA certificate and private key found in cert_dir.
+
+    Both are parsed once and kept in memory. The files are checked for
+    changes at most every CA_CHECK_INTERVAL seconds, and reloaded only if
+    their mtime changed."""
+
+    def __init__(self, cert_dir):
+        self.cert_pem = None
+        self.cert = None
+        self.key = None
+
+        self._cert_file = os.path.join(cert_dir, "ca_cert.pem")
+        self._key_file = os.path.join(cert_dir, "ca_key.pem")
+        self._mtimes = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Reload the CA certificate and key if they changed on disk"""
+        now = time.time()
+
+        with self._lock:
+            if self._mtimes and now - self._checked < CA_CHECK_INTERVAL:
+                return
+
+            self._checked = now
+            mtimes = (os.path.getmtime(self._cert_file),
+                      os.path.getmtime(self._key_file))
+
+            if mtimes == self._mtimes:
+                return
+
+            cert_pem = file_get_contents(self._cert_file)
+            self.cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_pem)
+            self.key = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                file_get_contents(self._key_file))
+            self.cert_pem = cert_pem
+            self._mtimes = mtimes
+
+    @metrics.timed('x509_sign')
+    def sign(self, x509_req):
+        """Issue a certificate for the given request. Return it PEM encoded."""
+        self.refresh()
+
+        with self._lock:
+            ca_cert, ca_key = self.cert, self.key
+
+        # Create new certificate
+        newcert = crypto.X509()
+
+        # Generate serial number
+        serial = random.randint(1, 2048)
+        newcert.set_serial_number(serial)
+        
+        # Valid for one year starting from now 
+        newcert.gmtime_adj_notAfter(60 * 60 * 24 * 365)
+        newcert.gmtime_adj_notBefore(0)
+
+        # Issuer, subject and public key
+        newcert.set_issuer(ca_cert.get_subject())
+        newcert.set_subject(x509_req.get_subject())
+        newcert.set_pubkey(x509_req.get_pubkey())
+
+        # Sign
+        newcert.sign(ca_key, "md5")
+
+        return crypto.dump_certificate(crypto.FILETYPE_PEM, newcert)
+
+__authorities = {}
+__authorities_lock = threading.Lock()
+
+def get_ca(cert_dir):
+    """Return the CertificateAuthority for cert_dir, loaded once per process"""
+    with __authorities_lock:
+        if cert_dir not in __authorities:
+            __authorities[cert_dir] = CertificateAuthority(cert_dir)
+
+        ca = __authorities[cert_dir]
+
+    ca.refresh()
+    return ca
+
 def create_x509_cert(cert_dir, x509_req):
-    # Load the CA cert
-    ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, 
-        file_get_contents(os.path.join(cert_dir, "ca_cert.pem")))
-    
-    # Load private key
-    key = crypto.load_privatekey(crypto.FILETYPE_PEM, 
-        file_get_contents(os.path.join(cert_dir, "ca_key.pem")))
-
-    # Create new certificate
-    newcert = crypto.X509()
-
-    # Generate serial number
-    serial = random.randint(1, 2048)
-    newcert.set_serial_number(serial)
-    
-    # Valid for one year starting from now 
-    newcert.gmtime_adj_notAfter(60 * 60 * 24 * 365)
-    newcert.gmtime_adj_notBefore(0)
-
-    # Issuer, subject and public key
-    newcert.set_issuer(ca_cert.get_subject())
-    newcert.set_subject(x509_req.get_subject())
-    newcert.set_pubkey(x509_req.get_pubkey())
-
-    # Sign
-    newcert.sign(key, "md5")
-
-    return crypto.dump_certificate(crypto.FILETYPE_PEM, newcert)
+    return get_ca(cert_dir).sign(x509_req)
 
 def generate_certificate(cert_dir, uid, sid, role, email, cn, org):
     """Generates a new x509 certificate for a manager from scratch.
@@ -64,17 +192,17 @@ def generate_certificate(cert_dir, uid, sid, role, email, cn, org):
     Creates a key, a request and then the certificate."""
 
     # Get CA cert
-    ca_cert = file_get_contents(os.path.join(cert_dir, "ca_cert.pem"))
+    ca = get_ca(cert_dir)
 
-    # Generate keypair
-    req_key  = gen_rsa_keypair()
+    # Get a keypair, pre-generated if possible
+    req_key  = keypool.get()
 
     # Generate certificate request
     x509_req = create_x509_req(req_key, uid, sid, org, email, cn, role)
 
     # Sign the request
-    certificate = create_x509_cert(cert_dir, x509_req)
+    certificate = ca.sign(x509_req)
 
-    return { 'ca_cert': ca_cert, 
+    return { 'ca_cert': ca.cert_pem, 
              'key': crypto.dump_privatekey(crypto.FILETYPE_PEM, req_key), 
              'cert': certificate }